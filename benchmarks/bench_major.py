@@ -0,0 +1,83 @@
+"""
+`MajorAggregation` / `PercentageAggregation` against the naive `mode().first()` and `value_counts()` versions
+
+    python -m benchmarks.bench_major --rows 5000000 --cells 1000000 --categories 20
+"""
+import argparse
+import time
+from typing import Callable
+
+import numpy as np
+import polars as pl
+
+from h3_toolkit.aggregation.strategy import MajorAggregation, PercentageAggregation
+
+def synthetic_cells(n_rows:int, n_cells:int, n_categories:int, seed:int=0)->pl.DataFrame:
+    rng = np.random.default_rng(seed)
+    return pl.DataFrame({
+        'cell': pl.Series(rng.integers(0, n_cells, n_rows), dtype=pl.UInt64),
+        'land_use': pl.Series(rng.integers(0, n_categories, n_rows)).cast(pl.String),
+    })
+
+def naive_major(df:pl.LazyFrame, target_cols:list[str])->pl.DataFrame:
+    # 以前的作法，平手的時候回傳哪一個不固定
+    return df.group_by('cell').agg(pl.col(target_cols).mode().first()).collect()
+
+def naive_percentage(df:pl.LazyFrame, target_cols:list[str])->pl.DataFrame:
+    col = target_cols[0]
+    return (
+        df
+        .group_by('cell')
+        .agg(pl.col(col).value_counts(normalize=True))
+        .explode(col)
+        .unnest(col)
+        .collect()
+        .pivot(index='cell', on=col, values='proportion')
+    )
+
+def _time(run:Callable[[], pl.DataFrame])->tuple[float, pl.DataFrame]:
+    start = time.perf_counter()
+    result = run()
+    return time.perf_counter() - start, result
+
+def run(n_rows:int, n_cells:int, n_categories:int)->None:
+    df = synthetic_cells(n_rows, n_cells, n_categories).lazy()
+    cols = ['land_use']
+    major = MajorAggregation().prepare(df, cols, None)
+    percentage = PercentageAggregation().prepare(df, cols, None)
+
+    cases = [
+        ('major naive', lambda: naive_major(df, cols)),
+        ('major kernel', lambda: major.apply(df, cols, None).collect()),
+        ('percentage naive', lambda: naive_percentage(df, cols)),
+        ('percentage kernel', lambda: percentage.apply(df, cols, None).collect()),
+    ]
+    print(f"{'case':<20} {'seconds':>9} {'rows/s':>12}")
+    results = {}
+    for name, run_case in cases:
+        seconds, results[name] = _time(run_case)
+        print(f"{name:<20} {seconds:>9.3f} {n_rows / seconds:>12.0f}")
+
+    # 沒有平手的cell，兩種作法的major要一樣
+    counts = df.group_by('cell', 'land_use').len().collect()
+    no_tie = (
+        counts
+        .filter(pl.col('len') == pl.col('len').max().over('cell'))
+        .group_by('cell').len()
+        .filter(pl.col('len') == 1)
+        .select('cell')
+    )
+    compared = (
+        results['major naive'].join(no_tie, on='cell')
+        .join(results['major kernel'], on='cell', suffix='_kernel')
+    )
+    agree = (compared['land_use'] == compared['land_use_kernel']).mean()
+    print(f"major agrees on {agree:.2%} of the {compared.height} cells without a tie")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=5_000_000)
+    parser.add_argument('--cells', type=int, default=1_000_000)
+    parser.add_argument('--categories', type=int, default=20)
+    args = parser.parse_args()
+    run(args.rows, args.cells, args.categories)
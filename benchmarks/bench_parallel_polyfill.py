@@ -0,0 +1,40 @@
+"""
+Scaling of the process pool polyfill (`H3Aggregator.set_workers`)
+
+    python -m benchmarks.bench_parallel_polyfill --polygons 20000 --resolution 11
+"""
+import argparse
+import os
+import time
+
+from h3_toolkit.core import H3Aggregator
+from benchmarks.synthetic import synthetic_polygons
+
+def run(n_polygons:int, resolution:int, workers:list[int], partition_bytes:int)->None:
+    gdf = synthetic_polygons(n_polygons)
+    baseline = None
+    print(f"{'workers':>8} {'seconds':>10} {'speedup':>8} {'efficiency':>10}")
+    for n in workers:
+        aggregator = (
+            H3Aggregator()
+            .set_geometry('geometry')
+            .set_resolution(resolution)
+            .set_workers(n, partition_bytes)
+            .avg(['value'])
+        )
+        aggregator.process(gdf.head(100))  # warm up the process pool
+        start = time.perf_counter()
+        aggregator.process(gdf)
+        seconds = time.perf_counter() - start
+        baseline = baseline or seconds
+        print(f"{n:>8} {seconds:>10.2f} {baseline / seconds:>8.2f} {baseline / seconds / n:>10.2f}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--polygons', type=int, default=20000)
+    parser.add_argument('--resolution', type=int, default=11)
+    parser.add_argument('--partition-bytes', type=int, default=256 * 1024)
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=[n for n in (1, 2, 4, 8, 16, 32) if n <= (os.cpu_count() or 1)])
+    args = parser.parse_args()
+    run(args.polygons, args.resolution, args.workers, args.partition_bytes)
@@ -0,0 +1,139 @@
+"""
+Benchmark suite, every scenario runs in a fresh process and reports wall time, rows per second and peak memory
+
+    python -m benchmarks.run                         # quick profile
+    python -m benchmarks.run --profile full          # resolutions 7-13, polygon counts and sizes
+    python -m benchmarks.run --save-baseline         # store the results as the baseline of this machine
+    python -m benchmarks.run --check                 # exit 1 when a scenario is slower than the baseline
+
+baselines are stored per machine in `benchmarks/baselines.json`, timings from different machines are not comparable
+"""
+import argparse
+import concurrent.futures
+import fnmatch
+import json
+import multiprocessing
+import platform
+import resource
+import sys
+import time
+from pathlib import Path
+
+from benchmarks.scenarios import PROFILES, SCENARIOS
+
+BASELINE_PATH = Path(__file__).parent / 'baselines.json'
+
+def _measure(kind:str, params:dict, repeat:int)->dict:
+    """
+    run in the child process, the setup is not timed, the best of `repeat` runs is reported
+    """
+    run = SCENARIOS[kind](**params)
+    run()  # warm up
+    seconds, rows = float('inf'), 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows = run()
+        seconds = min(seconds, time.perf_counter() - start)
+    # linux的ru_maxrss單位是KB, macOS是bytes
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_mb = max_rss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    return {
+        'seconds': seconds,
+        'rows': rows,
+        'rows_per_second': rows / seconds if seconds else 0.0,
+        'peak_mb': peak_mb,
+    }
+
+def run_scenario(kind:str, params:dict, repeat:int=3)->dict:
+    """
+    run one scenario in a new spawned process, so the peak memory is not shared between scenarios
+    """
+    context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(_measure, kind, params, repeat).result()
+
+def machine_key()->str:
+    return f"{platform.node()}-{platform.machine()}-py{platform.python_version()}"
+
+def load_baselines(path:Path=BASELINE_PATH)->dict:
+    if not path.exists():
+        return {}
+    return json.loads(path.read_text())
+
+def save_baseline(results:dict[str, dict], path:Path=BASELINE_PATH)->None:
+    baselines = load_baselines(path)
+    baselines.setdefault(machine_key(), {}).update(results)
+    path.write_text(json.dumps(baselines, indent=2, sort_keys=True) + '\n')
+
+def compare(results:dict[str, dict],
+            baseline:dict[str, dict],
+            time_tolerance:float,
+            memory_tolerance:float,
+    )->list[str]:
+    """
+    the regressions of `results` against `baseline`, a scenario regresses when it is slower or uses more
+    memory than the baseline by more than the tolerance (0.2 = 20%)
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        if result['seconds'] > base['seconds'] * (1 + time_tolerance):
+            regressions.append(
+                f"{name}: {result['seconds']:.3f}s vs baseline {base['seconds']:.3f}s "
+                f"(+{result['seconds'] / base['seconds'] - 1:.0%}, tolerance {time_tolerance:.0%})"
+            )
+        if result['peak_mb'] > base['peak_mb'] * (1 + memory_tolerance):
+            regressions.append(
+                f"{name}: peak {result['peak_mb']:.0f}MB vs baseline {base['peak_mb']:.0f}MB "
+                f"(+{result['peak_mb'] / base['peak_mb'] - 1:.0%}, tolerance {memory_tolerance:.0%})"
+            )
+    return regressions
+
+def main(argv:list[str]=None)->int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--profile', choices=sorted(PROFILES), default='quick')
+    parser.add_argument('-k', '--filter', default='*', help='glob of the scenario names to run')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--baseline', type=Path, default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--check', action='store_true')
+    parser.add_argument('--time-tolerance', type=float, default=0.25)
+    parser.add_argument('--memory-tolerance', type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    scenarios = [item for item in PROFILES[args.profile] if fnmatch.fnmatch(item[0], args.filter)]
+    baseline = load_baselines(args.baseline).get(machine_key(), {})
+
+    print(f"{'scenario':<40} {'seconds':>9} {'rows':>10} {'rows/s':>12} {'peak MB':>8} {'vs base':>8}")
+    results = {}
+    for name, kind, params in scenarios:
+        result = run_scenario(kind, params, args.repeat)
+        results[name] = result
+        delta = f"{result['seconds'] / baseline[name]['seconds'] - 1:+.0%}" if name in baseline else '-'
+        print(
+            f"{name:<40} {result['seconds']:>9.3f} {result['rows']:>10} "
+            f"{result['rows_per_second']:>12.0f} {result['peak_mb']:>8.0f} {delta:>8}",
+            flush=True,
+        )
+
+    if args.save_baseline:
+        save_baseline(results, args.baseline)
+        print(f"Saved the baseline of {machine_key()} to {args.baseline}")
+
+    if args.check:
+        if not baseline:
+            print(f"No baseline for {machine_key()} in {args.baseline}, run with --save-baseline first")
+            return 1
+        regressions = compare(results, baseline, args.time_tolerance, args.memory_tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} REGRESSION(S) against the baseline:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print("\nNo regression against the baseline")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,295 @@
+"""
+Benchmark scenarios, every scenario does its setup first and returns a callable which runs the timed part
+and returns the number of rows it processed
+"""
+import tempfile
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+import polars as pl
+import geopandas as gpd
+import h3ronpy.polars
+from shapely import box
+
+from h3_toolkit.core import H3Aggregator, H3AggregatorUp
+from h3_toolkit.hbase.client import HBaseClient
+from h3_toolkit.hbase.local_server import LocalHBaseServer
+from h3_toolkit.hbase.scheduler import AdaptiveScheduler
+from benchmarks.synthetic import synthetic_polygons, synthetic_points, synthetic_lines
+
+def polyfill(agg:str, resolution:int, n_polygons:int, size:float)->Callable[[], int]:
+    """
+    polyfill + aggregate with `H3Aggregator.process`
+    """
+    gdf = synthetic_polygons(n_polygons, size=size)
+    aggregator = H3Aggregator().set_geometry('geometry').set_resolution(resolution)
+    if agg == 'sum':
+        aggregator.sum(['value'], 'district')
+    elif agg == 'avg':
+        aggregator.avg(['value'])
+    elif agg in ('count', 'major', 'percentage'):
+        getattr(aggregator, agg)(['land_use'])
+    else:
+        raise ValueError(f"Unknown aggregation '{agg}'")
+
+    def run()->int:
+        return aggregator.process(gdf).height
+    return run
+
+def geometry_layer(kind:str, agg:str, resolution:int, n:int)->Callable[[], int]:
+    """
+    `H3Aggregator.process` of a point or line layer
+    """
+    gdf = synthetic_points(n) if kind == 'points' else synthetic_lines(n)
+    aggregator = H3Aggregator().set_geometry('geometry').set_resolution(resolution)
+    if agg == 'sum':
+        aggregator.sum(['value'], 'district')
+    else:
+        getattr(aggregator, agg)(['land_use'])
+
+    def run()->int:
+        return aggregator.process(gdf).height
+    return run
+
+def _source_cells(resolution:int, n_polygons:int, size:float)->pl.DataFrame:
+    """
+    the fetched HBase data of `H3AggregatorUp`, one row per cell with string values
+    """
+    cells = (
+        H3Aggregator().set_geometry('geometry').set_resolution(resolution)
+        .process(synthetic_polygons(n_polygons, size=size))
+        .select('hex_id')
+        .unique()
+    )
+    rng = np.random.default_rng(0)
+    return cells.with_columns(
+        pl.Series('p_cnt', rng.integers(0, 100, cells.height)).cast(pl.String),
+        pl.Series('h_cnt', rng.uniform(0, 50, cells.height)).cast(pl.String),
+        pl.Series('land_use', rng.choice(['residential', 'commercial', 'industrial', 'park'], cells.height)),
+    )
+
+def rollup(agg:str, resolution_source:int, resolution_target:int, n_polygons:int, size:float)->Callable[[], int]:
+    """
+    `H3AggregatorUp.process` from already fetched source cells
+    """
+    aggregator = (
+        H3AggregatorUp()
+        .set_resolution_source(resolution_source)
+        .set_resolution_target(resolution_target)
+    )
+    getattr(aggregator, agg)(['land_use'] if agg in ('major', 'percentage') else ['p_cnt', 'h_cnt'])
+    aggregator.data = _source_cells(resolution_source, n_polygons, size)
+
+    def run()->int:
+        aggregator.process()
+        return aggregator.data.height
+    return run
+
+def rollup_sink(method:str, resolution_target:int, n_polygons:int, size:float)->Callable[[], int]:
+    """
+    `sum` rollup written to an ipc file: `process` then write ('collect'), `process_to` one file ('file')
+    or partitioned by the parents at resolution 6 ('partitioned')
+    """
+    aggregator = H3AggregatorUp().set_resolution_source(12).set_resolution_target(resolution_target).sum(['p_cnt'])
+    aggregator.data = _source_cells(12, n_polygons, size).with_columns(pl.col('p_cnt').cast(pl.Int64))
+    tmp_dir = Path(tempfile.mkdtemp())
+
+    def run()->int:
+        if method == 'collect':
+            aggregator.process().write_ipc(tmp_dir / 'rollup.arrow')
+        elif method == 'file':
+            aggregator.process_to(tmp_dir / 'rollup.arrow', 'ipc')
+        else:
+            aggregator.process_to(tmp_dir / 'rollup', 'ipc', partition_by_parent=6)
+        return aggregator.data.height
+    return run
+
+def _hbase_rows(n_rows:int)->pl.DataFrame:
+    rng = np.random.default_rng(0)
+    return pl.DataFrame({
+        'hex_id': [f'8c{i:013x}' for i in range(n_rows)],
+        'p_cnt': rng.integers(0, 100, n_rows),
+        'h_cnt': rng.uniform(0, 50, n_rows),
+    })
+
+def hbase_send(n_rows:int, chunk_size:int)->Callable[[], int]:
+    """
+    `HBaseClient.send_data` against the local stand-in gateway
+    """
+    server = LocalHBaseServer().start()
+    client = HBaseClient()
+    client.fetch_url, client.send_url, client.chunk_size = server.fetch_url, server.send_url, chunk_size
+    data = _hbase_rows(n_rows)
+
+    def run()->int:
+        client.send_data(data, 'benchmark', 'cf', ['p_cnt', 'h_cnt'])
+        return n_rows
+    return run
+
+def hbase_fetch(n_rows:int, chunk_size:int)->Callable[[], int]:
+    """
+    `HBaseClient.fetch_data` against the local stand-in gateway
+    """
+    server = LocalHBaseServer().start()
+    client = HBaseClient()
+    client.fetch_url, client.send_url, client.chunk_size = server.fetch_url, server.send_url, chunk_size
+    data = _hbase_rows(n_rows)
+    client.send_data(data, 'benchmark', 'cf', ['p_cnt', 'h_cnt'])
+    rowkeys = data['hex_id'].to_list()
+
+    def run()->int:
+        return client.fetch_data('benchmark', 'cf', ['p_cnt', 'h_cnt'], rowkeys).height
+    return run
+
+def hbase_fetch_saturated(n_rows:int, adaptive:bool)->Callable[[], int]:
+    """
+    `HBaseClient.fetch_data` against a gateway serving 8 requests at a time at 2s per MB of request body,
+    with the default fixed chunks or with an `AdaptiveScheduler`
+    """
+    server = LocalHBaseServer(capacity=8, latency=0.05, seconds_per_mb=2.0).start()
+    client = HBaseClient()
+    client.fetch_url, client.send_url = server.fetch_url, server.send_url
+    data = _hbase_rows(n_rows)
+    client.send_data(data, 'benchmark', 'cf', ['p_cnt', 'h_cnt'])
+    client.set_scheduler(AdaptiveScheduler(chunk_size=5000, target_seconds=0.5) if adaptive else None)
+    rowkeys = data['hex_id'].to_list()
+
+    def run()->int:
+        return client.fetch_data('benchmark', 'cf', ['p_cnt', 'h_cnt'], rowkeys).height
+    return run
+
+def hbase_fetch_cover(method:str, n_polygons:int, size:float, max_ranges:int=None)->Callable[[], int]:
+    """
+    `H3AggregatorUp.fetch_hbase_data` of a polygon cover at r12, by rowkey list or by range scan
+    """
+    server = LocalHBaseServer().start()
+    client = HBaseClient()
+    client.fetch_url, client.send_url, client.scan_url = server.fetch_url, server.send_url, server.scan_url
+    gdf = synthetic_polygons(n_polygons, size=size)
+    cells = _source_cells(12, n_polygons, size)
+    client.send_data(cells, 'benchmark', 'cf', ['p_cnt', 'h_cnt'])
+    aggregator = H3AggregatorUp().set_client(client).set_resolution_source(12).set_cell_format('uint64')
+
+    def run()->int:
+        aggregator.fetch_hbase_data('benchmark', 'cf', ['p_cnt', 'h_cnt'], gdf,
+                                    scan=method == 'scan', max_ranges=max_ranges)
+        return aggregator.data.height
+    return run
+
+def raster_sum(method:str, resolution:int, size:int)->Callable[[], int]:
+    """
+    `sum` of a size x size raster of ~100m pixels, with `H3Aggregator.process_raster` or by vectorizing
+    every pixel into a polygon
+    """
+    rng = np.random.default_rng(0)
+    raster = rng.integers(0, 100, (size, size)).astype(np.float32)
+    transform = (121.0, 0.001, 0.0, 25.0, 0.0, -0.001)
+    aggregator = H3Aggregator().set_geometry('geometry').set_resolution(resolution)
+    if method == 'raster':
+        aggregator.sum(['value'], None)
+
+        def run()->int:
+            return aggregator.process_raster(raster, transform).height
+        return run
+
+    rows, cols = np.indices(raster.shape).reshape(2, -1)
+    gdf = gpd.GeoDataFrame(
+        {'pixel': np.arange(raster.size), 'value': raster.ravel()},
+        geometry=box(121.0 + 0.001 * cols, 25.0 - 0.001 * (rows + 1), 121.0 + 0.001 * (cols + 1), 25.0 - 0.001 * rows),
+        crs='epsg:4326',
+    )
+    aggregator.sum(['value'], 'pixel')
+
+    def run()->int:
+        return aggregator.process(gdf).height
+    return run
+
+SCENARIOS:dict[str, Callable[..., Callable[[], int]]] = {
+    'polyfill': polyfill,
+    'rollup': rollup,
+    'rollup_sink': rollup_sink,
+    'hbase_send': hbase_send,
+    'hbase_fetch': hbase_fetch,
+    'hbase_fetch_cover': hbase_fetch_cover,
+    'hbase_fetch_saturated': hbase_fetch_saturated,
+    'raster_sum': raster_sum,
+    'geometry_layer': geometry_layer,
+}
+
+def _polyfill_grid(resolutions, counts, sizes)->list[tuple[str, str, dict]]:
+    return [
+        (f"polyfill_{agg}_r{resolution}_n{n}_s{size}", 'polyfill',
+         {'agg': agg, 'resolution': resolution, 'n_polygons': n, 'size': size})
+        for agg in ('sum', 'avg', 'count', 'major', 'percentage')
+        for resolution in resolutions
+        for n in counts
+        for size in sizes
+    ]
+
+def _rollup_grid(targets)->list[tuple[str, str, dict]]:
+    return [
+        (f"rollup_{agg}_r12_to_r{target}", 'rollup',
+         {'agg': agg, 'resolution_source': 12, 'resolution_target': target, 'n_polygons': 20, 'size': 0.01})
+        for agg in ('sum', 'avg', 'major', 'percentage')
+        for target in targets
+    ]
+
+def _sink_grid(targets, n_polygons)->list[tuple[str, str, dict]]:
+    return [
+        (f"rollup_sink_{method}_r12_to_r{target}_n{n_polygons}", 'rollup_sink',
+         {'method': method, 'resolution_target': target, 'n_polygons': n_polygons, 'size': 0.01})
+        for method in ('collect', 'file', 'partitioned')
+        for target in targets
+    ]
+
+def _hbase_grid(rows)->list[tuple[str, str, dict]]:
+    return [
+        (f"{kind}_n{n}", kind, {'n_rows': n, 'chunk_size': 20000})
+        for kind in ('hbase_send', 'hbase_fetch')
+        for n in rows
+    ] + [
+        (f"hbase_fetch_cover_{method}", 'hbase_fetch_cover',
+         {'method': method, 'n_polygons': 20, 'size': 0.01, 'max_ranges': 500})
+        for method in ('rowkeys', 'scan')
+    ] + [
+        (f"hbase_fetch_saturated_{'adaptive' if adaptive else 'fixed'}", 'hbase_fetch_saturated',
+         {'n_rows': 200000, 'adaptive': adaptive})
+        for adaptive in (False, True)
+    ]
+
+def _layer_grid(counts)->list[tuple[str, str, dict]]:
+    return [
+        (f"{kind}_{agg}_r11_n{n}", 'geometry_layer', {'kind': kind, 'agg': agg, 'resolution': 11, 'n': n})
+        for kind in ('points', 'lines')
+        for agg in ('sum', 'count')
+        for n in counts
+    ]
+
+def _raster_grid(resolutions, size)->list[tuple[str, str, dict]]:
+    return [
+        (f"raster_sum_{method}_r{resolution}_{size}px", 'raster_sum',
+         {'method': method, 'resolution': resolution, 'size': size})
+        for method in ('vector', 'raster')
+        for resolution in resolutions
+    ]
+
+# 每個profile: (scenario name, scenario kind, kwargs)
+PROFILES:dict[str, list[tuple[str, str, dict]]] = {
+    'quick': (
+        _polyfill_grid(resolutions=(7, 9, 11, 13), counts=(200,), sizes=(0.005,))
+        + _rollup_grid(targets=(7, 9))
+        + _sink_grid(targets=(11,), n_polygons=20)
+        + _hbase_grid(rows=(50000,))
+        + _raster_grid(resolutions=(9, 11), size=500)
+        + _layer_grid(counts=(200000,))
+    ),
+    'full': (
+        _polyfill_grid(resolutions=range(7, 14), counts=(100, 1000, 10000), sizes=(0.001, 0.01))
+        + _rollup_grid(targets=range(5, 12))
+        + _sink_grid(targets=(9, 11), n_polygons=200)
+        + _hbase_grid(rows=(100000, 1000000))
+        + _raster_grid(resolutions=(7, 9, 11, 12), size=2000)
+        + _layer_grid(counts=(100000, 1000000))
+    ),
+}
@@ -0,0 +1,55 @@
+import geopandas as gpd
+import numpy as np
+import shapely
+from shapely.geometry import box
+
+# 台北附近的範圍，所有合成資料都放在這裡
+_BOUNDS = (121.3, 24.8, 121.8, 25.3)
+
+def synthetic_polygons(n:int, size:float=0.01, n_groups:int=10, seed:int=0)->gpd.GeoDataFrame:
+    """
+    n square polygons with a random `value` and a `land_use` category, grouped by `district`
+    n: int, the number of polygons
+    size: float, the side length of every polygon in degrees
+    n_groups: int, the number of districts
+    """
+    rng = np.random.default_rng(seed)
+    min_x, min_y, max_x, max_y = _BOUNDS
+    x = rng.uniform(min_x, max_x - size, n)
+    y = rng.uniform(min_y, max_y - size, n)
+    return gpd.GeoDataFrame(
+        {
+            'district': rng.integers(0, n_groups, n).astype(str),
+            'value': rng.uniform(0, 100, n),
+            'land_use': rng.choice(['residential', 'commercial', 'industrial', 'park'], n),
+        },
+        geometry=[box(a, b, a + size, b + size) for a, b in zip(x, y)],
+        crs='epsg:4326',
+    )
+
+def synthetic_points(n:int, n_groups:int=10, seed:int=0)->gpd.GeoDataFrame:
+    """
+    n points (POI / sensors) with the same attributes as `synthetic_polygons`
+    """
+    rng = np.random.default_rng(seed)
+    min_x, min_y, max_x, max_y = _BOUNDS
+    return gpd.GeoDataFrame(
+        {
+            'district': rng.integers(0, n_groups, n).astype(str),
+            'value': rng.uniform(0, 100, n),
+            'land_use': rng.choice(['residential', 'commercial', 'industrial', 'park'], n),
+        },
+        geometry=shapely.points(rng.uniform(min_x, max_x, n), rng.uniform(min_y, max_y, n)),
+        crs='epsg:4326',
+    )
+
+def synthetic_lines(n:int, length:float=0.01, n_groups:int=10, seed:int=0)->gpd.GeoDataFrame:
+    """
+    n road-like linestrings of 5 vertices, about `length` degrees long
+    """
+    rng = np.random.default_rng(seed)
+    points = synthetic_points(n, n_groups, seed)
+    start = shapely.get_coordinates(points.geometry.values)
+    steps = rng.normal(0, length / 4, (n, 4, 2)).cumsum(axis=1)
+    coords = np.concatenate([start[:, None, :], start[:, None, :] + steps], axis=1)
+    return points.set_geometry(shapely.linestrings(coords))
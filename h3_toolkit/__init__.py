@@ -2,9 +2,16 @@ from h3ronpy.polars.vector import (
     wkb_to_cells,
     cells_to_wkb_polygons
 )
+from h3ronpy.polars import cells_to_string
+from h3ronpy.arrow import change_resolution, change_resolution_list
+from h3_toolkit.processing.parallel import parallel_wkb_to_cells, containment_mode_name, DEFAULT_PARTITION_BYTES
+from h3_toolkit.processing.geom_dispatch import dispatch_wkb_to_cells
+from h3_toolkit.cache import PolyfillCache
+from h3_toolkit.tracing import Tracer
 from h3ronpy import ContainmentMode as Cont
 import polars as pl
 from shapely import from_wkb
+from typing import Optional
 
 @pl.api.register_expr_namespace('custom')
 class CustomExpr:
@@ -14,14 +21,78 @@ class CustomExpr:
                             resolution:int, 
                             containment_mode:Cont=Cont.ContainsCentroid, 
                             compact:bool=False, 
-                            flatten:bool=False
+                            flatten:bool=False,
+                            workers:int=1,
+                            partition_bytes:int=DEFAULT_PARTITION_BYTES,
+                            cache:Optional[PolyfillCache]=None,
+                            tracer:Optional[Tracer]=None,
                             )->pl.Expr:
+        if workers > 1 and not flatten:
+            # 多個process同時做polyfill
+            polyfill = lambda s: parallel_wkb_to_cells(s, resolution, containment_mode, compact, workers, partition_bytes)
+        else:
+            polyfill = lambda s: wkb_to_cells(s, resolution, containment_mode, compact, flatten)
+        if tracer is not None:
+            # 有cache的話只算到真的polyfill的geometry
+            polyfill = tracer.wrap('polyfill', polyfill)
+
+        if flatten:
+            return self._expr.map_batches(polyfill)
+
+        if cache is not None:
+            # 只有cache裡沒有的polygon才polyfill
+            mode_name = containment_mode_name(containment_mode)
+            polygons = lambda s: cache.wkb_to_cells(s, resolution, mode_name, compact, polyfill)
+        else:
+            polygons = polyfill
+        # point跟line不用polyfill，每個batch依照geometry type分開處理
         return (
             self._expr.map_batches(
-                lambda s: wkb_to_cells(s, resolution, containment_mode, compact, flatten)
+                lambda s: dispatch_wkb_to_cells(s, resolution, containment_mode, compact, polygons, tracer)
             )
         )
     
+    def custom_cells_to_string(self, tracer:Optional[Tracer]=None)->pl.Expr:
+        """
+        same as `h3.cells_to_string()`, but marked as elementwise with a known return type,
+        so the query can still run in the streaming engine and be sunk to a file
+        """
+        to_string = lambda s: cells_to_string(s)
+        if tracer is not None:
+            to_string = tracer.wrap('cells_to_string', to_string)
+        return (
+            self._expr.map_batches(
+                to_string,
+                return_dtype=pl.String,
+                is_elementwise=True
+            )
+        )
+
+    def custom_change_resolution(self, resolution:int)->pl.Expr:
+        """
+        same as `h3.change_resolution()` to a coarser resolution, but elementwise, so it can be sunk to a file
+        """
+        return (
+            self._expr.map_batches(
+                lambda s: pl.from_arrow(change_resolution(s.to_arrow(), resolution)),
+                return_dtype=pl.UInt64,
+                is_elementwise=True
+            )
+        )
+
+    def custom_change_resolution_list(self, resolution:int)->pl.Expr:
+        """
+        list of the cells at `resolution` for every cell (children when uncompacting, the parent itself otherwise)
+        `h3ronpy.polars.change_resolution_list` points to `change_resolution`, so the arrow function is used here
+        """
+        return (
+            self._expr.map_batches(
+                lambda s: pl.from_arrow(change_resolution_list(s.to_arrow(), resolution)),
+                return_dtype=pl.List(pl.UInt64),
+                is_elementwise=True
+            )
+        )
+
     def custom_cells_to_wkb_polygons(self,
                                      radians:bool=False,
                                      link_cells:bool=False
@@ -1,11 +1,113 @@
+from __future__ import annotations
+from pathlib import Path
+from typing import Callable, Optional, Iterable
+
+import numpy as np
 import polars as pl
+import pyarrow as pa
 import h3ronpy.polars
-from abc import ABC, abstractmethod
+from h3ronpy.arrow import grid_disk_distances
+
+from h3_toolkit.processing.geom_processor import CELL_WEIGHT
+
+# partial state的合併方式，都符合結合律，不管怎麼切chunk、用幾個worker、從哪個resolution合併結果都一樣
+MERGE_OPS = {
+    'sum': lambda col: pl.col(col).sum(),
+    'min': lambda col: pl.col(col).min(),
+    'max': lambda col: pl.col(col).max(),
+}
+
+# 每一種數值統計量的partial state，以及合併的方式
+NUMERIC_STATES = {
+    'sum': ('sum', lambda col: pl.col(col).cast(pl.Float64).sum()),
+    'count': ('sum', lambda col: pl.col(col).cast(pl.Float64).count()),
+    'sumsq': ('sum', lambda col: (pl.col(col).cast(pl.Float64) ** 2).sum()),
+    'min': ('min', lambda col: pl.col(col).cast(pl.Float64).min()),
+    'max': ('max', lambda col: pl.col(col).cast(pl.Float64).max()),
+}
+
+def state_col(col:str, state:str)->str:
+    return f'{col}_{state}'
+
+def numeric_state(target_cols:list[str], states:list[str])->list[pl.Expr]:
+    """
+    the aggregations of the partial state `{col}_{state}` of every target column,
+    states: list[str], keys of `NUMERIC_STATES` (sum, count, sumsq, min, max)
+    """
+    return [
+        NUMERIC_STATES[state][1](col).alias(state_col(col, state))
+        for col in target_cols
+        for state in states
+    ]
+
+def fetched_cols(df:pl.DataFrame, target_cols:list[str])->list[str]:
+    """
+    the target columns in `df`, the columns without any value are not returned by HBase
+    """
+    names = df.collect_schema().names()
+    return [col for col in target_cols if col in names]
+
+class AggregationStrategy:
+    """
+    a strategy implements `apply` (no partial state) or `partial` with `state` and `finalize` (mergeable),
+    the other one is derived, a subclass implementing neither fails when it is defined
+    """
+    # 可以直接處理compact後(混合resolution)的cell，不行的話要先uncompact
+    supports_compact: bool = True
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if cls.apply is AggregationStrategy.apply and cls.partial is AggregationStrategy.partial:
+            raise TypeError(f"{cls.__name__} must implement either apply or partial")
+
+    def prepare(self, df:pl.DataFrame, target_cols:list[str], agg_col:str)->AggregationStrategy:
+        """
+        在polyfill之前看一次原始資料，回傳要用的strategy，預設不需要準備
+        """
+        return self
 
-class AggregationStrategy(ABC):
-    @abstractmethod
     def apply(self, df:pl.DataFrame, target_cols:list[str], agg_col:str)->pl.DataFrame:
-        pass
+        """
+        the output columns of every cell, `finalize(merge(partial))` unless the strategy has no state
+        """
+        return self.finalize(self.merge(self.partial(df, target_cols, agg_col), target_cols, agg_col), target_cols, agg_col)
+
+    def partial(self, df:pl.DataFrame, target_cols:list[str], agg_col:str)->pl.DataFrame:
+        """
+        可以再被merge的中間結果，沒有state的strategy就是apply的結果
+        """
+        return self.apply(df, target_cols, agg_col)
+
+    def state(self, target_cols:list[str])->dict[str, str]:
+        """
+        partial state column -> merge op (`MERGE_OPS`)
+        預設沒有state，每個row都是獨立的結果
+        """
+        return {}
+
+    def merge(self, df:pl.DataFrame, target_cols:list[str], agg_col:str)->pl.DataFrame:
+        """
+        合併不同batch的partial result，同一個cell的state用`state`的方式合併
+        沒有state的話，直接concat就好，不需要再處理
+        """
+        ops = self.state(target_cols)
+        if not ops:
+            return df
+        names = df.collect_schema().names()
+        missing = [col for col in ops if col not in names]
+        if missing:
+            raise ValueError(f"The partial states {missing} of {type(self).__name__} are missing, merge the output of `partial`")
+        return (
+            df
+            .group_by('cell')
+            .agg([MERGE_OPS[op](col) for col, op in ops.items()])
+        )
+
+    def finalize(self, df:pl.DataFrame, target_cols:list[str], agg_col:str)->pl.DataFrame:
+        """
+        把merge完的partial result轉成最後輸出的column
+        """
+        return df
 
 class SumAggregation(AggregationStrategy):
     """
@@ -14,6 +116,16 @@ class SumAggregation(AggregationStrategy):
     def apply(self, df: pl.DataFrame, target_cols: list[str], agg_col: str) -> pl.DataFrame:
         if agg_col is None:
             raise ValueError("agg_cols must be provided when using sum aggregation")
+        if CELL_WEIGHT in df.collect_schema().names():
+            # compact後一個cell代表很多個子cell，分母改成子cell的數量
+            return (
+                df
+                .with_columns([
+                    ((pl.first(col).over(agg_col)) /
+                    (pl.col(CELL_WEIGHT).filter(pl.col(col).is_not_null()).sum().over(agg_col))).alias(col)
+                    for col in target_cols
+                ])
+            )
         return (    
             df
             .with_columns([
@@ -24,24 +136,45 @@ class SumAggregation(AggregationStrategy):
             ])
         )
     
-class SumAggregationUp(AggregationStrategy):
+class NumericStateAggregation(AggregationStrategy):
     """
-    用於將小的reslution scale up 到大的resolution
+    base of the scale up strategies of numeric columns, the partial state of every target column is
+    `{col}_{state}` for every state in `states` (sum, count, sumsq, min, max), merged with `NUMERIC_STATES`
     """
-    def apply(self, df: pl.DataFrame, target_cols: list[str], agg_col: str = None) -> pl.DataFrame:
-        """
-        Scale Up Function
-        target_cols: list, the columns to be aggregated
-        agg_cols: list, the columns to be aggregated by, usually is a boundary
-        """
-        target_cols = [target_col for target_col in target_cols if target_col in df.collect_schema().names()]
+    states: list[str] = ['sum', 'count']
+
+    def partial(self, df: pl.DataFrame, target_cols: list[str], agg_col: str = None) -> pl.DataFrame:
         return (
             df
             .group_by(
                 'cell'
             )
             .agg(
-                pl.col(target_cols).cast(pl.Float64).sum()
+                numeric_state(target_cols, self.states)
+            )
+        )
+
+    def state(self, target_cols: list[str]) -> dict[str, str]:
+        return {
+            state_col(col, state): NUMERIC_STATES[state][0]
+            for col in target_cols
+            for state in self.states
+        }
+
+    def apply(self, df: pl.DataFrame, target_cols: list[str], agg_col: str = None) -> pl.DataFrame:
+        # HBase沒有回傳的column (沒有任何一個rowkey有值) 直接跳過
+        return super().apply(df, fetched_cols(df, target_cols), agg_col)
+
+class SumAggregationUp(NumericStateAggregation):
+    """
+    用於將小的reslution scale up 到大的resolution
+    """
+    def finalize(self, df: pl.DataFrame, target_cols: list[str], agg_col: str = None) -> pl.DataFrame:
+        return (
+            df
+            .select(
+                pl.col('cell'),
+                *[pl.col(state_col(col, 'sum')).alias(col) for col in target_cols],
             )
         )
 
@@ -55,51 +188,482 @@ class AvgAggregation(AggregationStrategy):
             ])
         )
 
-class AvgAggregationUp(AggregationStrategy):
-    def apply(self, df: pl.DataFrame, target_cols: list[str], agg_col: str) -> pl.DataFrame:
+class AvgAggregationUp(NumericStateAggregation):
+    """
+    partial result keeps the sum and the count of every column, so the average of a coarser resolution
+    is weighted by the number of source cells instead of averaging the averages
+    """
+    def finalize(self, df: pl.DataFrame, target_cols: list[str], agg_col: str) -> pl.DataFrame:
         return (
             df
-            .group_by(
-                'cell'
+            .select(
+                pl.col('cell'),
+                *[
+                    pl.when(pl.col(state_col(col, 'count')) > 0)
+                    .then(pl.col(state_col(col, 'sum')) / pl.col(state_col(col, 'count')))
+                    .alias(col)
+                    for col in target_cols
+                ],
             )
-            .agg(
-                pl.col(target_cols).cast(pl.Float64).mean()
+        )
+
+class StatsAggregationUp(NumericStateAggregation):
+    """
+    several statistics of every target column at once, as `{col}_{stat}`
+    stats: list[str], sum, count, mean, std (sample standard deviation), min, max, mean / std / min / max if None
+    """
+    _REQUIRED_STATES = {
+        'sum': ['sum'],
+        'count': ['count'],
+        'mean': ['sum', 'count'],
+        'std': ['sum', 'count', 'sumsq'],
+        'min': ['min'],
+        'max': ['max'],
+    }
+
+    def __init__(self, stats:Optional[list[str]]=None):
+        stats = stats if stats is not None else ['mean', 'std', 'min', 'max']
+        unknown = [stat for stat in stats if stat not in self._REQUIRED_STATES]
+        if unknown:
+            raise ValueError(f"Unknown stats {unknown}, must be in {list(self._REQUIRED_STATES)}")
+        self.stats = stats
+        self.states = list(dict.fromkeys(state for stat in stats for state in self._REQUIRED_STATES[stat]))
+
+    def _stat(self, col: str, stat: str) -> pl.Expr:
+        total, count = pl.col(state_col(col, 'sum')), pl.col(state_col(col, 'count'))
+        if stat == 'mean':
+            return pl.when(count > 0).then(total / count)
+        if stat == 'std':
+            # 浮點誤差可能讓variance變成很小的負數
+            variance = (pl.col(state_col(col, 'sumsq')) - total ** 2 / count) / (count - 1)
+            return pl.when(count > 1).then(pl.max_horizontal(variance, pl.lit(0.0)).sqrt())
+        return pl.col(state_col(col, stat))
+
+    def finalize(self, df: pl.DataFrame, target_cols: list[str], agg_col: str = None) -> pl.DataFrame:
+        return (
+            df
+            .select(
+                pl.col('cell'),
+                *[
+                    self._stat(col, stat).alias(f'{col}_{stat}')
+                    for col in target_cols
+                    for stat in self.stats
+                ],
             )
         )
 
-# TODO: 改名字，不要用_count結尾
 class CountAggregation(AggregationStrategy):
+    """
+    number of rows of every category in a cell, one column per category plus `total_count`
+    the counts are conditional sums in one `group_by('cell')`, so the query streams and the output schema
+    is known before the cells are computed
+    categories: list, the category domain (a tuple per category when counting more than one column),
+        null is counted as the category None ("null" column), if None the domain is discovered from the
+        input by `prepare`, rows outside the domain are only counted in `total_count`
+    """
+    supports_compact = False
+
+    def __init__(self, categories:Optional[list]=None):
+        self.categories = categories
+
+    def prepare(self, df: pl.DataFrame, target_cols: list[str], agg_col: str) -> CountAggregation:
+        """
+        discover the category domain with a cheap pass over the attribute columns, before the polyfill
+        """
+        if self.categories is not None:
+            return self
+        categories = (
+            df
+            .lazy()
+            .select(category_key(target_cols).unique())
+            .collect()
+            .to_series()
+            .sort()
+            .to_list()
+        )
+        return CountAggregation(categories=categories)
+
+    def category_names(self, target_cols: list[str]) -> list[str]:
+        if self.categories is None:
+            raise ValueError("The categories of count aggregation are unknown, call prepare first")
+        return [category_name(category, len(target_cols)) for category in self.categories]
+
     def apply(self, df: pl.DataFrame, target_cols: list[str], agg_col: str) -> pl.DataFrame:
+        # 沒有先prepare的話，直接從cell的資料找category (要多掃一次)
+        names = list(dict.fromkeys(self.prepare(df, target_cols, agg_col).category_names(target_cols)))
         return (
             df
-            .group_by(['cell', *target_cols])
-            .agg([
-                pl.count().alias(f'{'_'.join(target_cols)}_count'),
-            ])
-            .fill_null('null') # 空值填"null"
+            # 先變成0/1的column，group_by裡只有單純的sum，streaming engine才吃得下
+            .select(pl.col('cell'), category_code(category_key(target_cols), names).alias(_CODE))
+            .select(pl.col('cell'), *category_indicators(_CODE, names))
+            .group_by('cell')
+            .agg(
+                pl.col(names).sum(),
+                pl.len().alias('total_count'),
+            )
+        )
+
+    def state(self, target_cols: list[str]) -> dict[str, str]:
+        """
+        同一個cell可能出現在不同的batch，count要再加總一次
+        """
+        return {name: 'sum' for name in [*self.category_names(target_cols), 'total_count']}
+
+def category_key(target_cols: list[str]) -> pl.Expr:
+    """
+    the category of every row as the name of its count column, the same names as the old pivot,
+    "value" for one column and '{"value1","value2"}' for more than one column, null is "null"
+    """
+    values = [pl.col(col).cast(pl.String).fill_null('null') for col in target_cols]
+    if len(values) == 1:
+        return values[0].alias('category')
+    return pl.concat_str([pl.lit('{"'), pl.concat_str(values, separator='","'), pl.lit('"}')]).alias('category')
+
+def category_name(category, n_cols: int) -> str:
+    """
+    the count column name of a category given by the user, the inverse of `category_key`
+    """
+    if n_cols == 1:
+        return _value_name(category)
+    # 已經是discover出來的名字
+    if isinstance(category, str):
+        return category
+    return '{' + ','.join(f'"{_value_name(value)}"' for value in category) + '}'
+
+def _value_name(value) -> str:
+    # 跟polars cast成String的結果一樣
+    if value is None:
+        return 'null'
+    if isinstance(value, bool):
+        return str(value).lower()
+    return str(value)
+
+def category_code(key: pl.Expr, names: list[str]) -> pl.Expr:
+    """
+    the position of the category of every row in `names`, null for rows outside `names`
+    key: pl.Expr, the category of every row (`category_key`)
+    """
+    return key.replace_strict(names, list(range(len(names))), default=None, return_dtype=pl.UInt32)
+
+def category_indicators(code_col: str, aliases: list[str]) -> list[pl.Expr]:
+    """
+    one 0/1 column per category from the integer code column, so every indicator is an integer comparison
+    instead of a string comparison, the code has to be a column of its own, otherwise it is computed
+    again for every indicator
+    """
+    return [(pl.col(code_col) == i).cast(pl.UInt32).alias(alias) for i, alias in enumerate(aliases)]
+
+# 暫時的category code column / 最大count column
+_CODE = '__category_code'
+_MAX = '__max_count'
+
+class _CategoryShares(AggregationStrategy):
+    """
+    base of `MajorAggregation` and `PercentageAggregation`, the partial result is the count of every
+    category of every target column (`{col}_{category}_count`) and the number of rows (`total_count`),
+    so cells of any resolution can be merged by summing the counts
+    categories: dict[str, list] | list, the category domain of every target column (a list when there is
+        only one target column), discovered by `prepare` if None
+    """
+    supports_compact = False
+
+    def __init__(self, categories:Optional[dict[str, list] | list]=None):
+        self.categories = categories
+
+    def _domain(self, target_cols: list[str]) -> dict[str, list[str]]:
+        if isinstance(self.categories, dict):
+            return {col: [category_name(c, 1) for c in self.categories[col]] for col in target_cols}
+        if len(target_cols) != 1:
+            raise ValueError("categories must be a dict of column -> categories when there is more than one target column")
+        return {target_cols[0]: [category_name(c, 1) for c in self.categories]}
+
+    def prepare(self, df: pl.DataFrame, target_cols: list[str], agg_col: str) -> _CategoryShares:
+        if self.categories is not None:
+            return self
+        unique = (
+            df
+            .lazy()
+            .select([category_key([col]).unique().implode().alias(col) for col in target_cols])
             .collect()
-            # lazyframe -> dataframe, dataframe is needed for pivot
-            .pivot(
-                values = f'{'_'.join(target_cols)}_count',
-                index = 'cell',
-                on = target_cols
+        )
+        return type(self)({col: sorted(unique[col].item().to_list()) for col in target_cols})
+
+    def partial(self, df: pl.DataFrame, target_cols: list[str], agg_col: str) -> pl.DataFrame:
+        domain = self.prepare(df, target_cols, agg_col)._domain(target_cols)
+        counts = [f'{col}_{name}_count' for col, names in domain.items() for name in names]
+        return (
+            df
+            .select(
+                pl.col('cell'),
+                *[category_code(category_key([col]), names).alias(f'{_CODE}_{col}') for col, names in domain.items()],
             )
-            .with_columns(
-                pl.sum_horizontal(pl.exclude('cell')).alias('total_count')
+            .select(
+                pl.col('cell'),
+                *[
+                    indicator
+                    for col, names in domain.items()
+                    for indicator in category_indicators(f'{_CODE}_{col}', [f'{col}_{name}_count' for name in names])
+                ],
+            )
+            .group_by('cell')
+            .agg(
+                pl.col(counts).sum(),
+                pl.len().alias('total_count'),
             )
-            # dataframe -> lazyframe
-            .lazy()
         )
-    
-# TODO:
-class MajorAggregation(AggregationStrategy):
+
+    def state(self, target_cols: list[str]) -> dict[str, str]:
+        return {
+            **{
+                f'{col}_{name}_count': 'sum'
+                for col, names in self._domain(target_cols).items()
+                for name in names
+            },
+            'total_count': 'sum',
+        }
+
     def apply(self, df: pl.DataFrame, target_cols: list[str], agg_col: str) -> pl.DataFrame:
-        pass
+        # 沒有先prepare的話，merge跟finalize也要用從資料找到的category
+        return AggregationStrategy.apply(self.prepare(df, target_cols, agg_col), df, target_cols, agg_col)
+
+class MajorAggregation(_CategoryShares):
+    """
+    the most frequent category of every target column in a cell, null values are not counted
+    ties go to the first category of the domain (sorted when discovered), so the result is deterministic
+    """
+    def _domain(self, target_cols: list[str]) -> dict[str, list[str]]:
+        # null不參與major
+        return {
+            col: [name for name in names if name != 'null']
+            for col, names in super()._domain(target_cols).items()
+        }
+
+    def finalize(self, df: pl.DataFrame, target_cols: list[str], agg_col: str) -> pl.DataFrame:
+        domain = self._domain(target_cols)
+        majors = []
+        for col, names in domain.items():
+            counts = [f'{col}_{name}_count' for name in names]
+            if not counts:
+                majors.append(pl.lit(None, dtype=pl.String).alias(col))
+                continue
+            # coalesce取第一個等於最大值的category
+            majors.append(
+                pl.coalesce([
+                    pl.when((pl.col(count) == pl.col(f'{_MAX}_{col}')) & (pl.col(count) > 0)).then(pl.lit(i, pl.UInt32))
+                    for i, count in enumerate(counts)
+                ])
+                .replace_strict(list(range(len(names))), names, return_dtype=pl.String)
+                .alias(col)
+            )
+        return (
+            df
+            .with_columns([
+                pl.max_horizontal(f'{col}_{name}_count' for name in names).alias(f'{_MAX}_{col}')
+                for col, names in domain.items() if names
+            ])
+            .select(pl.col('cell'), *majors)
+        )
+
+class PercentageAggregation(_CategoryShares):
+    """
+    the share (0 - 1) of every category of every target column in a cell, as `{col}_{category}`,
+    null values are the category "null", so the shares of a column sum to 1
+    """
+    def finalize(self, df: pl.DataFrame, target_cols: list[str], agg_col: str) -> pl.DataFrame:
+        domain = self._domain(target_cols)
+        return df.select(
+            pl.col('cell'),
+            *[
+                # 分母是cell內所有的row，包含null
+                (pl.col(f'{col}_{name}_count') / pl.col('total_count'))
+                .alias(f'{col}_{name}')
+                for col, names in domain.items()
+                for name in names
+            ],
+        )
+
+class SumAggregationDown(AggregationStrategy):
+    """
+    用於將大的resolution scale down 到小的resolution
+    split the value of every parent (`agg_col`) over its children, evenly, or in proportion to `weight_col`
+    of the children, the children of a parent always add up to the parent value
+    parents whose children have no weight at all (null or 0) are split evenly
+    """
+    def __init__(self, weight_col:Optional[str]=None):
+        self.weight_col = weight_col
 
-# TODO:
-class PercentageAggregation(AggregationStrategy):
     def apply(self, df: pl.DataFrame, target_cols: list[str], agg_col: str) -> pl.DataFrame:
-        pass
+        share = 1 / pl.len().over(agg_col)
+        if self.weight_col is not None:
+            weight = pl.col(self.weight_col).cast(pl.Float64).fill_null(0).clip(lower_bound=0)
+            total = weight.sum().over(agg_col)
+            share = pl.when(total > 0).then(weight / total).otherwise(share)
+        return (
+            df
+            .select(
+                pl.col('cell'),
+                *[(pl.col(col).cast(pl.Float64) * share).alias(col) for col in target_cols],
+            )
+        )
+
+class AvgAggregationDown(AggregationStrategy):
+    """
+    every child keeps the value of its parent (densities, rates, averages)
+    """
+    def apply(self, df: pl.DataFrame, target_cols: list[str], agg_col: str) -> pl.DataFrame:
+        return df.select(pl.col('cell'), pl.col(target_cols))
+
+# 每一種k-ring統計量: 同一個cell的多個row先怎麼合併
+KRING_CELL_OPS = {
+    'sum': lambda col: pl.col(col).cast(pl.Float64).sum(),
+    'mean': lambda col: pl.col(col).cast(pl.Float64).mean(),
+    'max': lambda col: pl.col(col).cast(pl.Float64).max(),
+}
+
+def disk_neighbors(cells:np.ndarray, k:int)->tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    the cells within `k` of every cell (the cell itself included) as flat arrays:
+    neighbors, their distance to the center, and the offsets (len + 1) of the disk of every cell
+    """
+    disks = grid_disk_distances(pa.array(cells, type=pa.uint64()), k, flatten=False)
+    neighbors = disks.column('cell').combine_chunks()
+    return (
+        neighbors.flatten().to_numpy(),
+        disks.column('k').combine_chunks().flatten().to_numpy(),
+        neighbors.offsets.to_numpy(),
+    )
+
+class KRingAggregation(AggregationStrategy):
+    """
+    the sum / mean / max of every target column over the cells within `k` rings of every cell (spatial
+    smoothing), the rows of a cell are combined first with the same statistic, only the cells with data
+    are in the output
+    the disks are computed for `batch_rows // disk size` cells at a time and looked up in the cells sorted
+    by index, the disk of every cell is a contiguous segment reduced with numpy, so the memory depends on
+    `batch_rows` instead of the number of cells times the disk size
+    k: int, the number of rings
+    how: str, sum, mean (weighted by `decay`, over the neighbors with a value) or max (of the weighted values)
+    decay: the weight of every ring, a list of k + 1 weights (ring 0 first) or a function of the distance,
+        None weighs every ring 1
+    inner: AggregationStrategy, applied before the smoothing, e.g. `SumAggregation` to split the value of a
+        geometry over its cells first
+
+    There is no partial state: the smoothed value of a cell needs every neighbor, so the whole input is
+    aggregated at once, the batched entry points (`process_chunked`, `process_to` with batches, `process_delta`,
+    `process_state`) reject it.
+    """
+    supports_compact = False
+
+    def __init__(self,
+                 k:int,
+                 how:str='mean',
+                 decay:Optional[list[float] | Callable[[int], float]]=None,
+                 inner:Optional[AggregationStrategy]=None,
+                 batch_rows:int=5_000_000,
+        ):
+        if how not in KRING_CELL_OPS:
+            raise ValueError(f"Unknown k-ring statistic '{how}', must be in {list(KRING_CELL_OPS)}")
+        if k < 0:
+            raise ValueError("k must not be negative")
+        if decay is None:
+            weights = [1.0] * (k + 1)
+        elif callable(decay):
+            weights = [float(decay(distance)) for distance in range(k + 1)]
+        else:
+            weights = [float(weight) for weight in decay]
+        if len(weights) != k + 1:
+            raise ValueError(f"decay must have k + 1 = {k + 1} weights, got {len(weights)}")
+        self.k = k
+        self.how = how
+        self.weights = weights
+        self.inner = inner
+        self.batch_rows = batch_rows
+
+    def prepare(self, df: pl.DataFrame, target_cols: list[str], agg_col: str) -> KRingAggregation:
+        if self.inner is None:
+            return self
+        return KRingAggregation(self.k, self.how, self.weights, self.inner.prepare(df, target_cols, agg_col), self.batch_rows)
+
+    def _smooth(self, values: pl.DataFrame, target_cols: list[str]) -> pl.DataFrame:
+        """
+        values: one row per cell, sorted by cell
+        """
+        cells = values['cell'].to_numpy()
+        columns = {col: values[col].fill_null(np.nan).to_numpy() for col in target_cols}
+        weights = np.asarray(self.weights)
+        result = {col: np.empty(len(cells)) for col in target_cols}
+        # 每個cell的disk有3k(k+1)+1個cell
+        batch_size = max(self.batch_rows // (3 * self.k * (self.k + 1) + 1), 1)
+        for start in range(0, len(cells), batch_size):
+            neighbors, distances, offsets = disk_neighbors(cells[start:start + batch_size], self.k)
+            # cell是排序過的，用二分搜尋找鄰居的值，不用建hash table，找不到的鄰居權重是0
+            index = np.searchsorted(cells, neighbors)
+            index[index == len(cells)] = 0
+            found = cells[index] == neighbors
+            weight = weights[distances]
+            stop = start + len(offsets) - 1
+            for col, column in columns.items():
+                value = column[index]
+                present = found & ~np.isnan(value)
+                weighted = np.where(present, value * weight, 0.0)
+                if self.how == 'max':
+                    weighted = np.where(present, weighted, -np.inf)
+                    result[col][start:stop] = np.maximum.reduceat(weighted, offsets[:-1])
+                    continue
+                total = np.add.reduceat(weighted, offsets[:-1])
+                if self.how == 'mean':
+                    with np.errstate(invalid='ignore', divide='ignore'):
+                        total = total / np.add.reduceat(np.where(present, weight, 0.0), offsets[:-1])
+                result[col][start:stop] = total
+        return (
+            pl.DataFrame({'cell': values['cell'], **result})
+            # 整個disk都沒有值的cell是null
+            .with_columns([
+                pl.when(pl.col(col).is_finite()).then(pl.col(col)).alias(col)
+                for col in target_cols
+            ])
+        )
+
+    def apply(self, df: pl.DataFrame, target_cols: list[str], agg_col: str = None) -> pl.DataFrame:
+        if self.inner is not None:
+            df = self.inner.apply(df, target_cols, agg_col)
+        values = (
+            df
+            .lazy()
+            # 太小的geometry polyfill不到cell，cell是null
+            .drop_nulls('cell')
+            .group_by('cell')
+            .agg([KRING_CELL_OPS[self.how](col) for col in target_cols])
+            .sort('cell')
+            # 故意在這裡collect: numpy的smoothing要所有cell排序好才能用二分搜尋找鄰居，
+            # map_batches在streaming engine裡只會拿到一部分的cell
+            .collect()
+        )
+        return self._smooth(values, target_cols).lazy()
+
+def merge_states(states:Iterable[pl.DataFrame | pl.LazyFrame | str | Path],
+                 strategy:AggregationStrategy,
+                 target_cols:list[str],
+                 agg_col:Optional[str]=None,
+                 resolution:Optional[int]=None,
+    )->pl.LazyFrame:
+    """
+    combine the partial states computed by different chunks, processes or machines into one state,
+    `strategy.finalize` turns it into the output columns
+    states: the state frames, or parquet files of them, with a uint64 `cell` column
+    resolution: int, roll the cells up to this resolution before merging, so states of finer
+        resolutions can be merged into a coarser one
+    """
+    frames = [
+        pl.scan_parquet(state) if isinstance(state, (str, Path)) else state.lazy()
+        for state in states
+    ]
+    if not frames:
+        raise ValueError("At least one state must be provided")
+    df = pl.concat(frames, how='diagonal_relaxed')
+    if resolution is not None:
+        df = df.with_columns(pl.col('cell').h3.change_resolution(resolution))
+    return strategy.merge(df, target_cols, agg_col)
 
 # def _sum(df:pl.DataFrame, target_cols:list[str], agg_col:str)->pl.DataFrame:
 #     """
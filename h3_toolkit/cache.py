@@ -0,0 +1,515 @@
+from __future__ import annotations
+from collections import OrderedDict
+from hashlib import blake2b
+from pathlib import Path
+from typing import Optional, Hashable, Any, Callable
+import logging
+import sys
+import time
+import uuid
+
+import numpy as np
+import polars as pl
+import pyarrow as pa
+
+class ByteLRU:
+    """
+    in-memory LRU bounded by the approximate bytes of the stored values
+    """
+    def __init__(self, max_bytes:int):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._items:OrderedDict[Hashable, tuple[Any, int]] = OrderedDict()
+
+    def __len__(self)->int:
+        return len(self._items)
+
+    def __contains__(self, key:Hashable)->bool:
+        return key in self._items
+
+    def get(self, key:Hashable, default=None):
+        if key not in self._items:
+            return default
+        self._items.move_to_end(key)
+        return self._items[key][0]
+
+    def peek(self, key:Hashable, default=None):
+        """
+        the value without marking it as recently used
+        """
+        if key not in self._items:
+            return default
+        return self._items[key][0]
+
+    def put(self, key:Hashable, value:Any, size:int)->None:
+        self.pop(key)
+        if size > self.max_bytes:
+            # 比整個budget還大就不放進memory
+            return
+        self._items[key] = (value, size)
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            _, (_, evicted_size) = self._items.popitem(last=False)
+            self.nbytes -= evicted_size
+
+    def pop(self, key:Hashable, default=None):
+        if key not in self._items:
+            return default
+        value, size = self._items.pop(key)
+        self.nbytes -= size
+        return value
+
+    def keys(self)->list[Hashable]:
+        return list(self._items.keys())
+
+    def clear(self)->None:
+        self._items.clear()
+        self.nbytes = 0
+
+class RowkeyCache:
+    """
+    two-tier cache of the HBase cells, keyed by (table, cf, qualifier, rowkey)
+
+    every fetch is stored as one segment (row, qualifier, value, fetched_at), the memory tier keeps the most
+    recently used segments within `max_memory_bytes`, the disk tier keeps every segment as an arrow ipc file
+    which is memory-mapped on read, so it is shared between sessions and processes
+    rowkeys fetched without a value are cached with a null value, so they are not requested again
+    when a (table, cf) has more than `max_segments` segments on disk they are compacted into one, without the
+    older copies of a cell and the expired cells, the disk tier still grows with the number of distinct cells,
+    use `invalidate` / `clear` to remove it
+
+    max_memory_bytes: int, the byte budget of the memory tier
+    cache_dir: str | Path, the directory of the disk tier, None to only cache in memory
+    ttl: float, seconds before a cached value expires, None to never expire
+    max_segments: int, the number of disk segments of a (table, cf) which triggers the compaction
+    """
+    def __init__(self,
+                 max_memory_bytes:int=512 * 1024 * 1024,
+                 cache_dir:Optional[str | Path]=None,
+                 ttl:Optional[float]=None,
+                 max_segments:int=32,
+                 ):
+        self.memory = ByteLRU(max_memory_bytes)
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.ttl = ttl
+        self.max_segments = max_segments
+        self.hits = 0
+        self.misses = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+
+    def _segment_dir(self, table_name:str, cf:str)->Path:
+        return self.cache_dir / table_name / cf
+
+    def _is_fresh(self)->pl.Expr:
+        if self.ttl is None:
+            return pl.lit(True)
+        return pl.col('fetched_at') >= time.time() - self.ttl
+
+    def _memory_segments(self, table_name:str, cf:str)->dict[Hashable, pl.DataFrame]:
+        # 用peek掃，不然每次lookup整個table的segment都會變成最近用過的
+        return {
+            key: self.memory.peek(key)
+            for key in self.memory.keys()
+            if key[:2] == (table_name, cf)
+        }
+
+    def _disk_segments(self, table_name:str, cf:str)->list[Path]:
+        if self.cache_dir is None or not self._segment_dir(table_name, cf).exists():
+            return []
+        return sorted(self._segment_dir(table_name, cf).glob('*.arrow'))
+
+    def _latest(self, df:pl.LazyFrame)->pl.LazyFrame:
+        # 同一個cell取最新的
+        return (
+            df
+            .filter(self._is_fresh())
+            .sort('fetched_at', descending=True)
+            .unique(['row', 'qualifier'], keep='first', maintain_order=True)
+        )
+
+    def _query(self, df:pl.LazyFrame, cq_list:list[str], rowkeys:pl.Series)->pl.LazyFrame:
+        return (
+            df
+            .filter(pl.col('row').is_in(rowkeys) & pl.col('qualifier').is_in(cq_list))
+            .pipe(self._latest)
+        )
+
+    def _lookup(self, segments:list[pl.DataFrame], cq_list:list[str], rowkeys:pl.Series)->pl.DataFrame:
+        if not segments:
+            return pl.DataFrame(schema=_SCHEMA)
+        return self._query(pl.concat([segment.lazy() for segment in segments], how='vertical'), cq_list, rowkeys).collect()
+
+    def lookup(self,
+               table_name:str,
+               cf:str,
+               cq_list:list[str],
+               rowkeys:list[str],
+        )->tuple[pl.DataFrame, list[str]]:
+        """
+        return the cached cells (row, qualifier, value) and the rowkeys that still need to be fetched,
+        a rowkey is a hit only when every qualifier in `cq_list` is cached
+        """
+        requested = pl.Series('row', rowkeys, dtype=pl.String).unique()
+
+        segments = self._memory_segments(table_name, cf)
+        found = self._lookup(
+            [segment.with_columns(pl.lit(i, pl.UInt32).alias(_SEGMENT)) for i, segment in enumerate(segments.values())],
+            cq_list,
+            requested,
+        )
+        if _SEGMENT in found.columns:
+            # 只有真的有hit的segment才更新LRU的順序
+            keys = list(segments)
+            for i in found[_SEGMENT].unique().to_list():
+                self.memory.get(keys[i])
+            found = found.drop(_SEGMENT)
+        memory_hit_rows = _complete_rows(found, cq_list)
+
+        remaining = requested.filter(~requested.is_in(memory_hit_rows))
+        if len(remaining):
+            from_disk = _collect_segments(
+                lambda: self._disk_segments(table_name, cf),
+                lambda df: self._query(df, cq_list, remaining),
+            )
+            if from_disk is not None and not from_disk.is_empty():
+                # 從disk讀到的放回memory，下次就不用再讀disk
+                self._put_memory(table_name, cf, from_disk)
+                found = pl.concat([found, from_disk], how='vertical')
+
+        hit_rows = _complete_rows(found, cq_list)
+        missing = requested.filter(~requested.is_in(hit_rows))
+
+        self.memory_hits += len(memory_hit_rows)
+        self.disk_hits += len(hit_rows) - len(memory_hit_rows)
+        self.hits += len(hit_rows)
+        self.misses += len(missing)
+        return found.filter(pl.col('row').is_in(hit_rows)), missing.to_list()
+
+    def _put_memory(self, table_name:str, cf:str, segment:pl.DataFrame)->None:
+        self.memory.put((table_name, cf, uuid.uuid4().hex), segment, segment.estimated_size())
+
+    def put(self,
+            table_name:str,
+            cf:str,
+            cq_list:list[str],
+            rowkeys:list[str],
+            data:pl.DataFrame,
+        )->None:
+        """
+        store the fetched cells, `data` is the long frame with the columns row, qualifier, value,
+        every (rowkey, qualifier) in `rowkeys` x `cq_list` without a value is stored as null
+        """
+        if not rowkeys:
+            return
+        requested = (
+            pl.DataFrame({'row': pl.Series(rowkeys, dtype=pl.String).unique()})
+            .join(pl.DataFrame({'qualifier': pl.Series(cq_list, dtype=pl.String)}), how='cross')
+        )
+        segment = (
+            requested
+            .join(
+                data.select(
+                    pl.col('row').cast(pl.String),
+                    pl.col('qualifier').cast(pl.String),
+                    pl.col('value').cast(pl.String),
+                ).unique(['row', 'qualifier'], keep='last'),
+                on=['row', 'qualifier'],
+                how='left',
+            )
+            .with_columns(pl.lit(time.time()).alias('fetched_at'))
+        )
+        self._put_memory(table_name, cf, segment)
+
+        if self.cache_dir is not None:
+            _write_segment(self._segment_dir(table_name, cf), segment)
+            if len(self._disk_segments(table_name, cf)) > self.max_segments:
+                self.compact(table_name, cf)
+
+    def compact(self, table_name:Optional[str]=None, cf:Optional[str]=None)->None:
+        """
+        merge the disk segments of a table (and column family) into one, keeping only the latest value of
+        every cell that hasn't expired, every table if table_name is None
+        """
+        if self.cache_dir is None or not self.cache_dir.exists():
+            return
+        for path in self.cache_dir.glob(f"{table_name or '*'}/{cf or '*'}"):
+            _compact_segments(path, self._latest)
+
+    def invalidate(self, table_name:Optional[str]=None, cf:Optional[str]=None)->None:
+        """
+        drop the cached segments of a table (and column family), everything if table_name is None
+        """
+        for key in self.memory.keys():
+            if (table_name is None or key[0] == table_name) and (cf is None or key[1] == cf):
+                self.memory.pop(key)
+
+        if self.cache_dir is None or not self.cache_dir.exists():
+            return
+        pattern = f"{table_name or '*'}/{cf or '*'}/*.arrow"
+        for path in self.cache_dir.glob(pattern):
+            path.unlink(missing_ok=True)
+        logging.info(f"Invalidate the cache of table={table_name} cf={cf}")
+
+    def clear(self)->None:
+        self.invalidate()
+
+    def stats(self)->dict[str, int]:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'memory_bytes': self.memory.nbytes,
+            'memory_segments': len(self.memory),
+        }
+
+_SCHEMA = {'row': pl.String, 'qualifier': pl.String, 'value': pl.String, 'fetched_at': pl.Float64}
+# lookup的時候記錄每個row是從哪個memory segment來的
+_SEGMENT = '__segment'
+
+def _write_segment(path:Path, df:pl.DataFrame)->None:
+    path.mkdir(parents=True, exist_ok=True)
+    # 先寫到暫存檔再rename，其他process不會讀到寫一半的檔案
+    tmp = path / f".{uuid.uuid4().hex}.tmp"
+    df.write_ipc(tmp)
+    tmp.rename(path / f"{time.time_ns()}-{uuid.uuid4().hex[:8]}.arrow")
+
+def _scan_segments(files:list[Path])->pl.LazyFrame:
+    return pl.concat([pl.scan_ipc(path, memory_map=True) for path in files], how='vertical')
+
+def _collect_segments(segments:Callable[[], list[Path]],
+                      query:Callable[[pl.LazyFrame], pl.LazyFrame],
+                      attempts:int=3,
+    )->Optional[pl.DataFrame]:
+    """
+    run `query` over the memory-mapped segment files, None when there is no segment
+    the segments are listed again when another process compacted them in the meantime, if it keeps
+    failing the cache is skipped (a miss) instead of failing the fetch
+    """
+    for _ in range(attempts):
+        files = segments()
+        if not files:
+            return None
+        try:
+            return query(_scan_segments(files)).collect()
+        except FileNotFoundError:
+            logging.info("The cache segments were compacted by another process, reading them again")
+    return None
+
+def _compact_segments(path:Path, query:Callable[[pl.LazyFrame], pl.LazyFrame])->None:
+    """
+    replace the segments in `path` by one segment with the result of `query` over them
+    the new segment is written before the old ones are removed, so a reader never misses a cached value
+    """
+    files = sorted(path.glob('*.arrow'))
+    if not files:
+        return
+    try:
+        compacted = query(_scan_segments(files)).collect()
+    except FileNotFoundError:
+        # 另一個process正在compact同一個目錄
+        return
+    if not compacted.is_empty():
+        _write_segment(path, compacted)
+    for file in files:
+        file.unlink(missing_ok=True)
+    logging.info(f"Compacted {len(files)} cache segments in {path}")
+
+def _complete_rows(found:pl.DataFrame, cq_list:list[str])->pl.Series:
+    """
+    the rows which have every qualifier cached
+    """
+    return (
+        found
+        .group_by('row')
+        .agg(pl.col('qualifier').n_unique().alias('n'))
+        .filter(pl.col('n') == len(set(cq_list)))
+        .get_column('row')
+    )
+
+# 每個geometry在memory tier的固定成本: ndarray物件、key tuple、LRU的entry (用tracemalloc量的)
+_POLYFILL_ENTRY_BYTES = 360
+
+class PolyfillCache:
+    """
+    two-tier cache of the polyfilled cells of every geometry, keyed by
+    (wkb digest, resolution, containment mode, compact)
+
+    the memory tier keeps the cells of the most recently used geometries within `max_memory_bytes`,
+    the disk tier keeps every polyfilled batch as an arrow ipc file (digest, cells) per
+    (resolution, containment mode, compact), memory-mapped on read, so it is shared between processes
+    identical geometries in the same batch are only polyfilled once
+    when a directory has more than `max_segments` segments they are compacted into one without the duplicated
+    geometries, the disk tier still grows with the number of distinct geometries, use `clear` to remove it
+
+    max_memory_bytes: int, the byte budget of the memory tier
+    cache_dir: str | Path, the directory of the disk tier, None to only cache in memory
+    max_segments: int, the number of disk segments of a directory which triggers the compaction
+    """
+    def __init__(self,
+                 max_memory_bytes:int=256 * 1024 * 1024,
+                 cache_dir:Optional[str | Path]=None,
+                 max_segments:int=32,
+                 ):
+        self.memory = ByteLRU(max_memory_bytes)
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.max_segments = max_segments
+        self.hits = 0
+        self.misses = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+
+    @staticmethod
+    def digest(wkb:bytes)->bytes:
+        return blake2b(wkb, digest_size=16).digest()
+
+    def _put_memory(self, digest:bytes, resolution:int, mode:str, compact:bool, cells:np.ndarray)->None:
+        # 只算cells.nbytes的話，沒有cell的geometry是0 bytes，memory tier就沒有上限
+        size = _POLYFILL_ENTRY_BYTES + sys.getsizeof(digest) + cells.nbytes
+        self.memory.put((digest, resolution, mode, compact), cells, size)
+
+    def _segment_dir(self, resolution:int, mode:str, compact:bool)->Path:
+        return self.cache_dir / f"res{resolution}-{mode}-{'compact' if compact else 'full'}"
+
+    def _disk_segments(self, resolution:int, mode:str, compact:bool)->list[Path]:
+        if self.cache_dir is None or not self._segment_dir(resolution, mode, compact).exists():
+            return []
+        return sorted(self._segment_dir(resolution, mode, compact).glob('*.arrow'))
+
+    def lookup(self,
+               digests:list[bytes],
+               resolution:int,
+               mode:str,
+               compact:bool,
+        )->tuple[dict[bytes, np.ndarray], list[bytes]]:
+        """
+        return the cached cells of every digest and the digests that still need to be polyfilled
+        """
+        found = {}
+        missing = []
+        for digest in dict.fromkeys(digests):
+            cells = self.memory.get((digest, resolution, mode, compact))
+            if cells is None:
+                missing.append(digest)
+            else:
+                found[digest] = cells
+        self.memory_hits += len(found)
+
+        from_disk = None
+        if missing:
+            from_disk = _collect_segments(
+                lambda: self._disk_segments(resolution, mode, compact),
+                lambda df: df.filter(pl.col('digest').is_in(pl.Series(missing, dtype=pl.Binary))).pipe(_distinct_digests),
+            )
+        if from_disk is not None:
+            for digest, cells in zip(from_disk['digest'], from_disk['cells']):
+                # 從disk讀到的放回memory，下次就不用再讀disk
+                cells = cells.to_numpy()
+                self._put_memory(digest, resolution, mode, compact, cells)
+                found[digest] = cells
+            self.disk_hits += from_disk.height
+            missing = [digest for digest in missing if digest not in found]
+
+        self.hits += len(found)
+        self.misses += len(missing)
+        return found, missing
+
+    def put(self,
+            digests:list[bytes],
+            cells:pl.Series,
+            resolution:int,
+            mode:str,
+            compact:bool,
+        )->None:
+        """
+        store the polyfilled cells (a List(UInt64) series aligned with `digests`)
+        """
+        if not digests:
+            return
+        for digest, row in zip(digests, cells):
+            row = row.to_numpy() if row is not None else np.array([], dtype=np.uint64)
+            self._put_memory(digest, resolution, mode, compact, row)
+
+        if self.cache_dir is not None:
+            path = self._segment_dir(resolution, mode, compact)
+            _write_segment(path, pl.DataFrame({
+                'digest': pl.Series(digests, dtype=pl.Binary),
+                'cells': cells.cast(pl.List(pl.UInt64)),
+            }))
+            if len(self._disk_segments(resolution, mode, compact)) > self.max_segments:
+                _compact_segments(path, _distinct_digests)
+
+    def compact(self)->None:
+        """
+        merge the disk segments of every (resolution, containment mode, compact) into one
+        """
+        if self.cache_dir is None or not self.cache_dir.exists():
+            return
+        for path in self.cache_dir.iterdir():
+            if path.is_dir():
+                _compact_segments(path, _distinct_digests)
+
+    def wkb_to_cells(self,
+                     s:pl.Series,
+                     resolution:int,
+                     mode:str,
+                     compact:bool,
+                     polyfill:Callable[[pl.Series], pl.Series],
+        )->pl.Series:
+        """
+        the cells of every wkb in `s`, only the geometries missing in the cache are passed to `polyfill`
+        mode: str, the name of the ContainmentMode
+        """
+        digests = [self.digest(wkb) if wkb is not None else None for wkb in s.to_list()]
+        found, missing = self.lookup([d for d in digests if d is not None], resolution, mode, compact)
+
+        if missing:
+            # 每個digest只polyfill第一個wkb
+            first = {}
+            for i, digest in enumerate(digests):
+                if digest is not None and digest not in found and digest not in first:
+                    first[digest] = i
+            cells = polyfill(s.gather(list(first.values())))
+            self.put(list(first), cells, resolution, mode, compact)
+            for digest, row in zip(first, cells):
+                found[digest] = row.to_numpy() if row is not None else np.array([], dtype=np.uint64)
+            logging.info(f"Polyfilled {len(missing)} geometries, {len(found) - len(missing)} from the cache")
+
+        return _list_series(s.name, [found[digest] if digest is not None else None for digest in digests])
+
+    def clear(self)->None:
+        self.memory.clear()
+        if self.cache_dir is None or not self.cache_dir.exists():
+            return
+        for path in self.cache_dir.glob('*/*.arrow'):
+            path.unlink(missing_ok=True)
+
+    def stats(self)->dict[str, int]:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'memory_bytes': self.memory.nbytes,
+            'memory_geometries': len(self.memory),
+        }
+
+def _distinct_digests(df:pl.LazyFrame)->pl.LazyFrame:
+    # 同一個geometry的cell都一樣，留一份就好
+    return df.unique('digest', keep='last')
+
+def _list_series(name:str, arrays:list[Optional[np.ndarray]])->pl.Series:
+    """
+    List(UInt64) series from uint64 arrays (None for null), built from the offsets without a python list per cell
+    """
+    lengths = np.array([0 if array is None else len(array) for array in arrays], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    values = [array for array in arrays if array is not None]
+    values = np.concatenate(values).astype(np.uint64) if values else np.array([], dtype=np.uint64)
+    list_array = pa.LargeListArray.from_arrays(
+        pa.array(offsets, pa.int64()),
+        pa.array(values, pa.uint64()),
+        mask=pa.array([array is None for array in arrays], pa.bool_()),
+    )
+    return pl.Series(name, list_array).cast(pl.List(pl.UInt64))
@@ -1,17 +1,129 @@
 from __future__ import annotations
 from enum import Enum
-from typing import Literal, Callable, Optional
+from typing import Literal, Callable, Optional, Iterator
+from pathlib import Path
 import logging
+import tempfile
 
+import numpy as np
 import polars as pl
+import pyarrow as pa
+import pyarrow.parquet as pq
 import h3ronpy.polars
 import geopandas as gpd
 
 from h3_toolkit.hbase.client import HBaseClient
-from h3_toolkit.aggregation.strategy import SumAggregation, AvgAggregation, CountAggregation, SumAggregationUp, AvgAggregationUp
+from h3_toolkit.hbase.planner import plan_scan
+from h3_toolkit.cache import PolyfillCache
+from h3_toolkit.aggregation.strategy import (
+    AggregationStrategy, SumAggregation, AvgAggregation, CountAggregation, SumAggregationUp, AvgAggregationUp,
+    MajorAggregation, PercentageAggregation, StatsAggregationUp, SumAggregationDown, AvgAggregationDown, KRingAggregation,
+    merge_states, fetched_cols
+)
 # from h3_toolkit.aggregation.aggregator import _sum, _avg, _count, _major, _percentage
 # from h3_toolkit.aggregation.aggregator_up import _sum_agg, _avg_agg
-from h3_toolkit.processing.geom_processor import geom_to_wkb, wkb_to_cells
+from h3_toolkit.processing.geom_processor import to_wkb_frame, wkb_to_cells, uncompact_cells, CELL_WEIGHT
+from h3_toolkit.processing.batch_processor import iter_batches
+from h3_toolkit.processing.raster_processor import (
+    RasterInput, PIXEL, read_raster, iter_windows, tile_to_cells, window_coefficients, affine_coefficients,
+    samples_cells, raster_categories
+)
+from h3_toolkit.processing.parallel import DEFAULT_PARTITION_BYTES
+from h3_toolkit.processing.sink import SinkFormat, sink_to, sink_by_parent
+from h3_toolkit.tracing import Tracer, Span, as_tracer
+from h3_toolkit.processing.delta import (
+    Changeset, fingerprint, read_manifest, write_manifest, diff_manifest, manifest_cells
+)
+
+# 可以直接傳進aggregator的geometry資料
+GeometryInput = gpd.GeoDataFrame | pl.DataFrame | pl.LazyFrame | pa.Table | str | Path
+
+# 用memory_budget推算batch size時，先拿來估計的geometry數量
+_PROBE_SIZE = 1000
+
+# process_wide的暫時column: 每個geometry的編號, 每個geometry的cell數量
+_GEOMETRY_ID = '__geometry_id'
+_N_CELLS = '__n_cells'
+
+# H3AggregatorDown的暫時column: 每個child的parent, 每個child的權重
+_PARENT = '__parent'
+_WEIGHT = '__weight'
+
+# output的cell: 'string'是hex string的hex_id, 'uint64'是uint64的cell (只在HBaseClient送出時才轉成string)
+CellFormat = Literal['string', 'uint64']
+
+def cell_key(cell_format: CellFormat) -> str:
+    """
+    the name of the cell column of the output
+    """
+    if cell_format not in ('string', 'uint64'):
+        raise ValueError(f"Unknown cell format '{cell_format}', use 'string' or 'uint64'")
+    return 'hex_id' if cell_format == 'string' else 'cell'
+
+def finalize_cells(df: pl.LazyFrame, cell_format: CellFormat, tracer: Optional[Tracer] = None) -> pl.LazyFrame:
+    """
+    cell (uint64) first, converted to the hex_id string unless the format is 'uint64'
+    """
+    cell = pl.col('cell')
+    if cell_format == 'string':
+        cell = cell.custom.custom_cells_to_string(tracer).alias('hex_id')
+    return df.select(cell, pl.exclude('cell'))
+
+def traced_wkb_frame(data: GeometryInput, geometry_col: str, tracer: Tracer) -> pl.DataFrame | pl.LazyFrame:
+    """
+    `to_wkb_frame` recorded as the `to_wkb` stage
+    """
+    with tracer.span('to_wkb') as metrics:
+        data = to_wkb_frame(data, geometry_col)
+        if isinstance(data, pl.DataFrame):
+            metrics['rows'] = data.height
+    return data
+
+def source_cells(data: pl.DataFrame | pl.LazyFrame) -> pl.LazyFrame:
+    """
+    the fetched data keyed by the uint64 `cell`, parsed from hex_id if it was fetched with string rowkeys
+    """
+    data = data.lazy()
+    if 'cell' in data.collect_schema().names():
+        return data
+    return data.with_columns(pl.col('hex_id').h3.cells_parse().alias('cell'))
+
+def lossless_dtypes(df: pl.DataFrame, cols: list[str]) -> dict[str, pl.DataType]:
+    """
+    the smallest dtype of every column which keeps every value: UInt32 for non-negative integers below 2^32,
+    Float32 when every value survives the round trip, otherwise the dtype is kept
+    """
+    numeric = [col for col in cols if df.schema[col].is_numeric()]
+    if not numeric or df.is_empty():
+        return {}
+    checks = df.select(
+        *[
+            (
+                (pl.col(col) >= 0) & (pl.col(col) < 2 ** 32) & (pl.col(col).cast(pl.Float64) % 1 == 0)
+            ).all().alias(f'{col}_uint32')
+            for col in numeric
+        ],
+        *[
+            (pl.col(col).cast(pl.Float32).cast(pl.Float64) == pl.col(col).cast(pl.Float64)).all().alias(f'{col}_float32')
+            for col in numeric
+        ],
+    ).row(0, named=True)
+
+    dtypes = {}
+    for col in numeric:
+        if checks[f'{col}_uint32']:
+            dtypes[col] = pl.UInt32
+        elif checks[f'{col}_float32'] and df.schema[col].is_float():
+            dtypes[col] = pl.Float32
+    return dtypes
+
+def check_batchable(strategy: Optional[AggregationStrategy], entry: str) -> None:
+    """
+    `kring` has no partial state, a batch or a shard doesn't have the neighbors of the cells at its border
+    """
+    if isinstance(strategy, KRingAggregation):
+        raise ValueError(f"{entry} aggregates the data batch by batch, which `kring` doesn't support, "
+                         "its neighbors cross the batches")
 
 class H3Aggregator:
     def __init__(self):
@@ -21,13 +133,44 @@ class H3Aggregator:
         self.geometry_col:str = None
         self.hex_id:str = None
         self.resolution:int = 12
+        self.compact:bool = False
+        self.keep_compacted:bool = False
+        self.workers:int = 1
+        self.partition_bytes:int = DEFAULT_PARTITION_BYTES
+        self.polyfill_cache:Optional[PolyfillCache] = None
+        self.cell_format:CellFormat = 'string'
+        self.tracer:Tracer = Tracer()
     
-    def _apply_strategy(self, df: pl.DataFrame) -> pl.DataFrame:
+    def _apply_strategy(self, df: pl.DataFrame, strategy: Optional[AggregationStrategy] = None, partial: bool = False) -> pl.DataFrame:
         # 可以不指定strategy，不指定strategy就直接回傳hexegon中心點對應到的值
-        if self.strategy is None:
+        strategy = strategy or self.strategy
+        if strategy is None:
             return df
             # raise ValueError("Aggregation strategy must be set before processing data")
-        return  self.strategy.apply(df, self.target_cols, self.agg_col)
+        if partial:
+            return strategy.partial(df, self.target_cols, self.agg_col)
+        return  strategy.apply(df, self.target_cols, self.agg_col)
+
+    def _merge_partial(self, df: pl.LazyFrame, strategy: Optional[AggregationStrategy] = None) -> pl.LazyFrame:
+        """
+        merge the partial states of the batches (`_to_lazy(partial=True)`) and compute the output columns
+        """
+        if strategy is None:
+            return df
+        return (
+            df
+            .pipe(strategy.merge, self.target_cols, self.agg_col)
+            .pipe(strategy.finalize, self.target_cols, self.agg_col)
+        )
+
+    def _prepare_strategy(self, data: pl.DataFrame | pl.LazyFrame) -> Optional[AggregationStrategy]:
+        """
+        let the strategy look at the attributes before the polyfill (e.g. the categories of `count`)
+        """
+        if self.strategy is None:
+            return None
+        # 跟_to_lazy一樣先fill_nan，找到的category才會跟aggregate的值一樣
+        return self.strategy.prepare(data.lazy().fill_nan(0), self.target_cols, self.agg_col)
             
     def sum(self, target_cols: list[str], agg_col: str) -> H3Aggregator:
         self.strategy = SumAggregation()
@@ -40,15 +183,100 @@ class H3Aggregator:
         self.target_cols = target_cols
         return self
     
-    def count(self, target_cols: list[str], agg_col=None) -> H3Aggregator:
-        self.strategy = CountAggregation()
+    def count(self, target_cols: list[str], agg_col=None, categories: Optional[list]=None) -> H3Aggregator:
+        """
+        categories: list, the category domain, one output column per category in this order,
+            if None the categories are discovered from the input before the polyfill
+        """
+        self.strategy = CountAggregation(categories)
+        self.target_cols = target_cols
+        return self
+
+    def major(self, target_cols: list[str], agg_col=None, categories: Optional[dict[str, list] | list]=None) -> H3Aggregator:
+        """
+        the most frequent category of every target column in a cell, ties go to the first category
+        categories: dict[str, list] | list, the category domain of every target column, discovered if None
+        """
+        self.strategy = MajorAggregation(categories)
+        self.target_cols = target_cols
+        return self
+
+    def percentage(self, target_cols: list[str], agg_col=None, categories: Optional[dict[str, list] | list]=None) -> H3Aggregator:
+        """
+        the share of every category of every target column in a cell, as `{col}_{category}`
+        categories: dict[str, list] | list, the category domain of every target column, discovered if None
+        """
+        self.strategy = PercentageAggregation(categories)
+        self.target_cols = target_cols
+        return self
+
+    def kring(self,
+              target_cols: list[str],
+              k: int,
+              how: str = 'mean',
+              decay: Optional[list[float] | Callable[[int], float]] = None,
+              agg_col: Optional[str] = None,
+        ) -> H3Aggregator:
+        """
+        the sum / mean / max of every target column over the cells within `k` rings of every cell,
+        see `KRingAggregation`
+        decay: list[float] | Callable[[int], float], the weight of every ring (ring 0 first), uniform if None
+        agg_col: str, with `how='sum'` the value of every `agg_col` group is split over its cells first (`sum`)
+        """
+        inner = SumAggregation() if how == 'sum' and agg_col else None
+        self.strategy = KRingAggregation(k, how, decay, inner)
         self.target_cols = target_cols
+        self.agg_col = agg_col
         return self
     
     def set_resolution(self, resolution: int) -> H3Aggregator:
         self.resolution = resolution
         return self
     
+    def set_workers(self, workers: int, partition_bytes: int=DEFAULT_PARTITION_BYTES) -> H3Aggregator:
+        """
+        polyfill the geometries with a pool of `workers` processes
+        partition_bytes: int, the wkb bytes of each partition sent to a worker
+        """
+        self.workers = workers
+        self.partition_bytes = partition_bytes
+        return self
+
+    def set_polyfill_cache(self, cache: Optional[PolyfillCache]) -> H3Aggregator:
+        """
+        reuse the cells of geometries polyfilled before (e.g. the same boundaries joined to another layer)
+        """
+        self.polyfill_cache = cache
+        return self
+
+    def set_tracer(self, tracer: Optional[Tracer | Callable[[Span], None]]) -> H3Aggregator:
+        """
+        record the wall time, rows and peak memory of every stage (to_wkb, polyfill, cells_to_string and every
+        collected query), see `h3_toolkit.tracing.RecordingTracer`, a function is called with every `Span`
+        """
+        self.tracer = as_tracer(tracer)
+        return self
+
+    def set_cell_format(self, cell_format: CellFormat='uint64') -> H3Aggregator:
+        """
+        'uint64' keeps the uint64 `cell` in the output instead of the hex_id string, 8 bytes per cell instead of
+        ~15 bytes plus offsets, `HBaseClient` converts it to the rowkey string only when sending
+        """
+        cell_key(cell_format)
+        self.cell_format = cell_format
+        return self
+
+    def set_compact(self, compact: bool=True, keep_compacted: bool=False) -> H3Aggregator:
+        """
+        polyfill with compacted cells, a big polygon is covered by a few coarse cells instead of millions of
+        cells at `resolution`, `sum` divides by the number of child cells of every compacted cell
+        keep_compacted: bool, keep the compacted cells in the result (for storage), the values are still per
+            `resolution` cell, otherwise the result is uncompacted to `resolution` at the end
+        """
+        self.compact = compact
+        self.keep_compacted = keep_compacted
+        return self
+
     def set_geometry(self, geometry_col: str=None) -> H3Aggregator:
         """
         要處理地理空間資料之前一定要set_geometry
@@ -68,34 +296,474 @@ class H3Aggregator:
         self.target_cols = target_cols
         return self
     
-    def process(self, data: gpd.GeoDataFrame | pl.DataFrame)-> pl.DataFrame:
-        if isinstance(data, gpd.GeoDataFrame):
-            logging.info("Converting GeoDataFrame to polars.DataFrame")
-            data = geom_to_wkb(data, self.geometry_col)
+    def _to_lazy(self, data: GeometryInput, strategy: Optional[AggregationStrategy] = None, partial: bool = False) -> pl.LazyFrame:
+        """
+        build the lazy query from geometry to the aggregated h3 cells (cell is still uint64)
+        strategy: AggregationStrategy, the prepared strategy, prepared from `data` if None
+        partial: bool, return the mergeable partial state of the strategy instead of the output columns
+        """
+        data = traced_wkb_frame(data, self.geometry_col, self.tracer)
+        strategy = strategy or self._prepare_strategy(data)
 
         selected_cols = []
         if self.agg_col:
             selected_cols.append(self.agg_col)
         selected_cols.extend(self.target_cols)
 
-        logging.info(f"Start converting data to h3 cells in resolution {self.resolution}")
+        compact = self.compact and self.geometry_col is not None
         result = (
             data
             .fill_nan(0)
             .lazy()
-            .pipe(wkb_to_cells, self.resolution, self.geometry_col, selected_cols) # convert geometry to h3 cells
-            .pipe(self._apply_strategy) # apply the aggregation strategy
-            .select(  # Convert the cell(unit64) to string
-                pl.col('cell').h3.cells_to_string().alias('hex_id'),
-                pl.exclude('cell')
+            .pipe(wkb_to_cells, self.resolution, self.geometry_col, selected_cols,
+                  compact=compact, workers=self.workers, partition_bytes=self.partition_bytes, cache=self.polyfill_cache,
+                  tracer=self.tracer) # convert geometry to h3 cells
+        )
+        if compact and strategy is not None and not strategy.supports_compact:
+            result = result.pipe(uncompact_cells, self.resolution)
+
+        result = result.pipe(self._apply_strategy, strategy, partial) # apply the aggregation strategy
+
+        if compact:
+            # uncompact的時候，會順便把cell_weight拿掉
+            result = (
+                result.select(pl.exclude(CELL_WEIGHT))
+                if self.keep_compacted else
+                result.pipe(uncompact_cells, self.resolution)
             )
-            .collect(streaming=True)
+        return result
+
+    def _finalize(self, df: pl.LazyFrame) -> pl.LazyFrame:
+        # Convert the cell(unit64) to string
+        return finalize_cells(df, self.cell_format, self.tracer)
+
+    def process(self, data: GeometryInput)-> pl.DataFrame:
+        """
+        data: GeoDataFrame, GeoParquet path, pyarrow Table (WKB / geoarrow.wkb) or polars DataFrame / LazyFrame with WKB
+        """
+        logging.info(f"Start converting data to h3 cells in resolution {self.resolution}")
+        result = (
+            self._to_lazy(data)
+            .pipe(self._finalize)
+            .pipe(self.tracer.collect, 'process', streaming=True)
         )
         logging.info(result.head(5))
         logging.info(f"Successfully converting data to h3 cells with resolution {self.resolution}")
 
         return result
 
+    def process_to(self,
+                   data: GeometryInput,
+                   path: str | Path,
+                   format: SinkFormat = 'parquet',
+                   partition_by_parent: Optional[int] = None,
+                   batch_size: Optional[int] = None,
+                   memory_budget: Optional[int] = None,
+        ) -> list[Path]:
+        """
+        same as `process`, but the result is written to `path` instead of returned, return the written files
+        format: 'parquet' or 'ipc' (uncompressed Arrow IPC, can be memory-mapped by `pl.read_ipc(memory_map=True)`)
+        partition_by_parent: int, write to the directory `path`, one hive partition `parent=<hex_id>` per parent
+            cell at this resolution, so a tile can be read without the rest
+        batch_size / memory_budget: polyfill the geometries batch by batch like `process_chunked`, not supported
+            by `kring`
+
+        The polyfill is a python function, so the cells of one batch are collected before they are written,
+        the partial results of the batches are merged from disk with the streaming engine.
+        Send the files with `HBaseClient.send_files`.
+        """
+        if partition_by_parent is not None:
+            if not 0 <= partition_by_parent <= self.resolution:
+                raise ValueError(f"The parent resolution must be between 0 and {self.resolution}, got {partition_by_parent}")
+            if self.compact and self.keep_compacted:
+                raise ValueError("Compacted cells can't be partitioned by parent, use set_compact(keep_compacted=False)")
+
+        if batch_size is None and memory_budget is None:
+            written = sink_to(
+                self._to_lazy(data), path, format, partition_by_parent, self._finalize, self.tracer, 'process'
+            )
+            logging.info(f"Successfully write the h3 cells in resolution {self.resolution} to {path}")
+            return written
+
+        check_batchable(self.strategy, 'process_to')
+        data = traced_wkb_frame(data, self.geometry_col, self.tracer)
+        if isinstance(data, pl.LazyFrame):
+            data = data.collect()
+        strategy = self._prepare_strategy(data)
+        batches = self._iter_partial_results(data, batch_size, memory_budget, strategy)
+        return self._sink_partial_results(batches, path, strategy, format, partition_by_parent)
+
+    def process_wide(self,
+                     data: GeometryInput,
+                     column_batch: int = 64,
+                     downcast: bool = True,
+        ) -> Iterator[pl.DataFrame]:
+        """
+        `sum` / `avg` of layers with hundreds of target columns, yields one frame (hex_id, [agg_col], columns)
+        per batch of `column_batch` target columns, the rows of every frame are in the same order
+        data: GeometryInput, the input data
+        column_batch: int, the number of target columns in each frame
+        downcast: bool, store a column as UInt32 or Float32 when it is lossless
+
+        The target columns are not carried through the polyfill. The number of cells of every geometry is
+        computed once, `sum` is computed per `agg_col` group on the geometries (first value / cells of the
+        group with a value) and `avg` per geometry, and every batch is broadcast to the cells with one join,
+        so the memory grows with `column_batch` instead of the number of target columns.
+        """
+        if not isinstance(self.strategy, (SumAggregation, AvgAggregation)):
+            raise ValueError("process_wide only supports sum and avg")
+        if isinstance(self.strategy, SumAggregation) and self.agg_col is None:
+            raise ValueError("agg_cols must be provided when using sum aggregation")
+        if self.compact:
+            raise ValueError("process_wide does not support compact mode")
+
+        data = traced_wkb_frame(data, self.geometry_col, self.tracer)
+        if isinstance(data, pl.LazyFrame):
+            data = data.collect()
+        data = data.with_row_index(_GEOMETRY_ID)
+
+        polyfilled = (
+            data
+            .lazy()
+            .select(
+                pl.col(_GEOMETRY_ID),
+                *([pl.col(self.agg_col)] if self.agg_col else []),
+                pl.col(self.geometry_col).custom.custom_wkb_to_cells(
+                    self.resolution, workers=self.workers, partition_bytes=self.partition_bytes,
+                    cache=self.polyfill_cache, tracer=self.tracer,
+                ).alias('cell'),
+            )
+            .pipe(self.tracer.collect, 'wide_polyfill')
+        )
+        # explode之後沒有cell的geometry也會留下一個row
+        n_cells = polyfilled.select(_GEOMETRY_ID, pl.col('cell').list.len().clip(lower_bound=1).alias(_N_CELLS))
+        cells = (
+            polyfilled
+            .explode('cell')
+            .lazy()
+            .pipe(self._finalize)
+            .pipe(self.tracer.collect, 'wide_cells')
+        )
+        del polyfilled
+
+        key = self.agg_col if isinstance(self.strategy, SumAggregation) else _GEOMETRY_ID
+        key_cols = [cell_key(self.cell_format), *([self.agg_col] if self.agg_col else [])]
+        attributes = data.drop(self.geometry_col).join(n_cells, on=_GEOMETRY_ID, how='left')
+        for start in range(0, len(self.target_cols), column_batch):
+            batch = self.target_cols[start:start + column_batch]
+            logging.info(f"Processing target columns {start} - {start + len(batch)} of {len(self.target_cols)}")
+            with self.tracer.span('wide_batch') as metrics:
+                values = attributes.select(key, _N_CELLS, *batch).fill_nan(0)
+                if isinstance(self.strategy, SumAggregation):
+                    # 每個group只算一次，不用每個column各開兩個window
+                    values = values.group_by(key, maintain_order=True).agg([
+                        (pl.first(col) / (pl.col(_N_CELLS) * pl.col(col).is_not_null()).sum()).alias(col)
+                        for col in batch
+                    ])
+                values = values.select(key, *batch)
+                if downcast:
+                    values = values.cast(lossless_dtypes(values, batch))
+                result = (
+                    cells
+                    .join(values, on=key, how='left', join_nulls=True)
+                    .select(*key_cols, *batch)
+                )
+                metrics['rows'] = result.height
+            yield result
+
+    def process_chunked(self,
+                        data: GeometryInput,
+                        batch_size: Optional[int] = None,
+                        memory_budget: Optional[int] = None,
+                        sink: Optional[str | Path] = None,
+        ) -> Iterator[pl.DataFrame] | None:
+        """
+        polyfill and aggregate the geometries batch by batch, so the peak memory depends on the batch size
+        instead of the size of the whole dataset
+        data: GeometryInput, the input data, a lazy source is collected first (only the wkb, not the cells)
+        batch_size: int, the number of geometries in each batch
+        memory_budget: int, the approximate bytes of the result of each batch, used when batch_size is not given,
+            the rows per batch are estimated from a small probe batch
+        sink: str | Path, the parquet file to write the merged result to, if None a generator of result frames is returned
+
+        Geometries with the same `agg_col` are always in the same batch, so the `over(agg_col)` windows of
+        `SumAggregation` are exact. Strategies grouping by cell (`count`, `major`) may emit the same hex_id in
+        more than one batch when the geometries of different batches overlap, use `sink` to get their partial
+        states merged. `kring` is not supported, its neighbors cross the batches.
+        """
+        if batch_size is None and memory_budget is None:
+            raise ValueError("Either batch_size or memory_budget must be provided")
+        check_batchable(self.strategy, 'process_chunked')
+
+        data = traced_wkb_frame(data, self.geometry_col, self.tracer)
+        if isinstance(data, pl.LazyFrame):
+            data = data.collect()
+
+        # 整份資料只prepare一次，每個batch的output schema才會一樣
+        strategy = self._prepare_strategy(data)
+        batches = self._iter_partial_results(data, batch_size, memory_budget, strategy)
+        if sink is None:
+            return (
+                self.tracer.collect(self._merge_partial(batch.lazy(), strategy).pipe(self._finalize), 'chunk_finalize')
+                for batch in batches
+            )
+        self._sink_partial_results(batches, sink, strategy)
+
+    def _iter_partial_results(self,
+                              data: pl.DataFrame,
+                              batch_size: Optional[int],
+                              memory_budget: Optional[int],
+                              strategy: Optional[AggregationStrategy] = None,
+        ) -> Iterator[pl.DataFrame]:
+        """
+        the partial states of the strategy batch by batch, merged with `_merge_partial`
+        """
+        if self.agg_col:
+            data = data.sort(self.agg_col, maintain_order=True, nulls_last=True)
+
+        if batch_size is None:
+            # 先用一小批資料估計每一個row會產生多少bytes，再推算batch size
+            probe = next(iter_batches(data, _PROBE_SIZE, self.agg_col), None)
+            if probe is None:
+                return
+            result = self.tracer.collect(self._to_lazy(probe, strategy, partial=True), 'chunk', streaming=True)
+            yield result
+            bytes_per_row = max(result.estimated_size() / max(probe.height, 1), 1)
+            batch_size = max(int(memory_budget / bytes_per_row), 1)
+            logging.info(f"Estimated batch size {batch_size} from the memory budget {memory_budget} bytes")
+            data = data.slice(probe.height)
+
+        for i, batch in enumerate(iter_batches(data, batch_size, self.agg_col)):
+            logging.info(f"Processing batch {i} with {batch.height} geometries")
+            yield self.tracer.collect(self._to_lazy(batch, strategy, partial=True), 'chunk', streaming=True)
+
+    def _sink_partial_results(self,
+                              batches: Iterator[pl.DataFrame],
+                              sink: str | Path,
+                              strategy: Optional[AggregationStrategy] = None,
+                              format: SinkFormat = 'parquet',
+                              partition_by_parent: Optional[int] = None,
+        ) -> list[Path]:
+        with tempfile.TemporaryDirectory(dir=Path(sink).parent) as tmp_dir:
+            files = []
+            for i, batch in enumerate(batches):
+                path = Path(tmp_dir) / f"part-{i:05d}.parquet"
+                batch.write_parquet(path)
+                files.append(path)
+            if not files:
+                logging.warning("No data to sink")
+                return []
+
+            written = sink_to(
+                pl.concat([pl.scan_parquet(path) for path in files], how='diagonal')
+                .pipe(self._merge_partial, strategy),
+                sink, format, partition_by_parent, self._finalize, self.tracer,
+            )
+        logging.info(f"Successfully sink the result to {sink}")
+        return written
+
+    def _raster_strategy(self, raster: np.ndarray, nodata, tile_size: int) -> AggregationStrategy:
+        """
+        the cell-grouped strategy of the pixels, its partial state of every tile is merged like the states of
+        `merge_states`: `sum` -> `SumAggregationUp`, `avg` -> `AvgAggregationUp`, `count` with the categories
+        discovered from the raster
+        """
+        if isinstance(self.strategy, SumAggregation):
+            return SumAggregationUp()
+        if isinstance(self.strategy, AvgAggregation):
+            return AvgAggregationUp()
+        if isinstance(self.strategy, CountAggregation):
+            if self.strategy.categories is not None:
+                return self.strategy
+            values = np.array(raster_categories(raster, nodata, tile_size), dtype=raster.dtype)
+            return self.strategy.prepare(pl.DataFrame({self.target_cols[0]: values}), self.target_cols, None)
+        raise ValueError("process_raster only supports sum, avg and count")
+
+    def process_raster(self,
+                       raster: RasterInput,
+                       transform,
+                       nodata = None,
+                       tile_size: int = 1024,
+        ) -> pl.DataFrame:
+        """
+        aggregate a single band raster to the h3 cells tile by tile, without vectorizing the pixels
+        raster: np.ndarray | str | Path, the 2D array (rows, cols) in EPSG:4326, a np.memmap or a .npy file is
+            read one tile at a time
+        transform: affine.Affine or a GDAL geotransform (c, a, b, f, d, e) of the raster
+        nodata: the value of the pixels without data, NaN pixels are always skipped
+        tile_size: int, the rows and columns of every tile, the peak memory depends on it
+
+        The only target column is the name of the band. When the cells are finer than the pixels, every cell
+        takes the value of the pixel of its center (h3ronpy's raster conversion), `sum` splits the value of a
+        pixel evenly over its cells. Otherwise every pixel goes to the cell of its center, `sum` adds the
+        pixels of a cell, `avg` is their mean and `count` counts them per value. `agg_col` is not used.
+        """
+        if len(self.target_cols) != 1:
+            raise ValueError("process_raster needs exactly one target column, the name of the band")
+        if self.compact:
+            raise ValueError("process_raster does not support compact mode")
+        value_col = self.target_cols[0]
+        raster = read_raster(raster)
+        strategy = self._raster_strategy(raster, nodata, tile_size)
+
+        coefficients = affine_coefficients(transform)
+        sample = samples_cells(raster.shape, transform, self.resolution)
+        logging.info(
+            f"Converting a {raster.shape} raster to h3 cells in resolution {self.resolution} "
+            f"({'sampling the cells' if sample else 'by the pixel centers'})"
+        )
+        states = []
+        for row_off, col_off, height, width in iter_windows(raster.shape, tile_size):
+            with self.tracer.span('raster_tile', rows=height * width):
+                # memmap只有在這裡才會讀這個tile
+                tile = np.asarray(raster[row_off:row_off + height, col_off:col_off + width])
+                cells = tile_to_cells(
+                    tile, window_coefficients(coefficients, row_off, col_off), self.resolution, value_col,
+                    nodata=nodata, pixel_offset=(row_off, col_off, raster.shape[1]), sample=sample,
+                )
+                if isinstance(strategy, SumAggregationUp):
+                    cells = cells.with_columns(pl.col(value_col) / pl.len().over(PIXEL))
+                states.append(strategy.partial(cells.drop(PIXEL), self.target_cols, None))
+
+        if not states:
+            return self._finalize(strategy.partial(
+                pl.DataFrame(schema={'cell': pl.UInt64, value_col: raster.dtype}).lazy(), self.target_cols, None
+            )).collect()
+        return (
+            strategy.merge(pl.concat(states, how='diagonal_relaxed').lazy(), self.target_cols, None)
+            .pipe(strategy.finalize, self.target_cols, None)
+            .pipe(self._finalize)
+            .pipe(self.tracer.collect, 'raster_merge')
+        )
+
+    def process_delta(self,
+                      data: GeometryInput,
+                      manifest: str | Path,
+                      id_col: str,
+                      commit: bool = True,
+        ) -> Changeset:
+        """
+        incremental `process`, only the new, changed and deleted rows since the last run are polyfilled,
+        and only the cells they affect are recomputed
+        data: GeometryInput, the full current layer
+        manifest: str | Path, the parquet file with the fingerprint and the cells of every row of the last run,
+            the first run (no manifest yet) processes everything
+        id_col: str, the stable id of every input row
+        commit: bool, write the new manifest, set it to False to write `changeset.manifest` with
+            `write_manifest` only after the changeset is sent
+
+        The fingerprint covers the wkb, `agg_col` and the target columns. The affected cells are the old and
+        new cells of the changed rows, plus every cell of an `agg_col` group with a changed row, because `sum`
+        is redistributed inside the group. Unchanged rows covering an affected cell are aggregated again from
+        the cells in the manifest, without polyfilling them. `kring` is not supported, the neighbors of the
+        affected cells are not recomputed.
+        """
+        if self.geometry_col is None:
+            raise ValueError("Geometry column must be set before processing data, use `set_geometry()`")
+        if self.compact:
+            raise ValueError("process_delta does not support compact mode")
+        check_batchable(self.strategy, 'process_delta')
+
+        data = traced_wkb_frame(data, self.geometry_col, self.tracer)
+        if isinstance(data, pl.LazyFrame):
+            data = data.collect()
+        if data[id_col].is_duplicated().any():
+            raise ValueError(f"Column '{id_col}' must be unique to track the changes")
+
+        attribute_cols = list(dict.fromkeys(col for col in [self.agg_col, *self.target_cols] if col))
+        current = data.select(
+            pl.col(id_col),
+            fingerprint(self.geometry_col, attribute_cols),
+            (pl.col(self.agg_col) if self.agg_col else pl.lit(None)).alias('group'),
+        )
+        previous = read_manifest(manifest, id_col, current.schema[id_col], current.schema['group'])
+        ids = diff_manifest(current.select(id_col, 'fingerprint'), previous, id_col)
+        dirty = pl.concat([ids['new'], ids['changed']])
+        removed = pl.concat([ids['changed'], ids['deleted']])
+        unchanged = previous.filter(pl.col(id_col).is_in(ids['unchanged']))
+
+        # 只有新增跟修改的geometry要polyfill
+        dirty_cells = (
+            data
+            .filter(pl.col(id_col).is_in(dirty))
+            .lazy()
+            .pipe(wkb_to_cells, self.resolution, self.geometry_col, [id_col],
+                  workers=self.workers, partition_bytes=self.partition_bytes, cache=self.polyfill_cache,
+                  tracer=self.tracer)
+            .pipe(self.tracer.collect, 'delta_polyfill')
+        )
+        affected = [manifest_cells(previous, id_col, removed)['cell'], dirty_cells['cell'].drop_nulls()]
+        if self.agg_col:
+            # sum在agg_col內平分，group裡有geometry變動的話，整個group的cell都要重算
+            groups = pl.concat([
+                current.filter(pl.col(id_col).is_in(dirty))['group'],
+                previous.filter(pl.col(id_col).is_in(removed))['group'],
+            ])
+            affected.append(manifest_cells(unchanged.filter(pl.col('group').is_in(groups)), id_col)['cell'])
+        affected = pl.concat(affected).unique()
+
+        # 沒變的geometry如果蓋到affected cell，也要一起重新aggregate (用manifest裡的cell)
+        context_ids = manifest_cells(unchanged, id_col).filter(pl.col('cell').is_in(affected))[id_col].unique()
+        if self.agg_col:
+            context_groups = unchanged.filter(pl.col(id_col).is_in(context_ids))['group']
+            context_ids = unchanged.filter(
+                pl.col(id_col).is_in(context_ids) | pl.col('group').is_in(context_groups)
+            )[id_col]
+
+        strategy = self._prepare_strategy(data)
+        upserts = (
+            pl.concat([dirty_cells, manifest_cells(unchanged, id_col, context_ids)], how='diagonal_relaxed')
+            .lazy()
+            .join(
+                data.lazy().select(id_col, *attribute_cols).fill_nan(0).with_row_index('__row'),
+                on=id_col,
+                how='left',
+            )
+            # 跟`process`一樣照input的順序，sum取的first才會一樣
+            .sort('__row', maintain_order=True)
+            .select('cell', *attribute_cols)
+            .pipe(self._apply_strategy, strategy)
+            .filter(pl.col('cell').is_in(affected))
+            .pipe(self._finalize)
+            .pipe(self.tracer.collect, 'delta_upserts')
+        )
+        upserted = upserts['cell'] if self.cell_format == 'uint64' else upserts['hex_id'].h3.cells_parse()
+        deletes = (
+            pl.DataFrame({'cell': affected})
+            .filter(~pl.col('cell').is_in(upserted))
+            .pipe(finalize_cells, self.cell_format)
+            .to_series()
+            .to_list()
+        )
+
+        new_manifest = pl.concat(
+            [
+                unchanged,
+                current
+                .filter(pl.col(id_col).is_in(dirty))
+                .join(
+                    dirty_cells.group_by(id_col).agg(pl.col('cell').drop_nulls().alias('cells')),
+                    on=id_col,
+                    how='left',
+                )
+                .select(unchanged.columns),
+            ],
+            how='vertical_relaxed',
+        )
+        if commit:
+            write_manifest(new_manifest, manifest)
+
+        stats = {
+            **{name: len(rows) for name, rows in ids.items()},
+            'polyfilled': dirty.len(),
+            'context': len(context_ids),
+            'affected_cells': len(affected),
+            'upserts': upserts.height,
+            'deletes': len(deletes),
+        }
+        logging.info(f"Delta of {manifest}: {stats}")
+        return Changeset(upserts, deletes, new_manifest, stats)
+
 class H3AggregatorUp:
     def __init__(self):
         self.client:HBaseClient = None
@@ -105,6 +773,11 @@ class H3AggregatorUp:
         self.geometry_col:str = 'geometry'
         self.resolution_source:int = 12
         self.resolution_target:int = 7
+        self.workers:int = 1
+        self.partition_bytes:int = DEFAULT_PARTITION_BYTES
+        self.polyfill_cache:Optional[PolyfillCache] = None
+        self.cell_format:CellFormat = 'string'
+        self.tracer:Tracer = Tracer()
 
     def set_client(self, client:HBaseClient) -> H3AggregatorUp:
         self.client = client
@@ -118,14 +791,55 @@ class H3AggregatorUp:
         self.resolution_target = resolution
         return self
     
+    def set_workers(self, workers: int, partition_bytes: int=DEFAULT_PARTITION_BYTES) -> H3AggregatorUp:
+        """
+        polyfill the geometries with a pool of `workers` processes
+        partition_bytes: int, the wkb bytes of each partition sent to a worker
+        """
+        self.workers = workers
+        self.partition_bytes = partition_bytes
+        return self
+
+    def set_polyfill_cache(self, cache: Optional[PolyfillCache]) -> H3AggregatorUp:
+        """
+        reuse the cells of geometries polyfilled before, the rowkeys of the same boundaries are not polyfilled again
+        """
+        self.polyfill_cache = cache
+        return self
+
+    def set_tracer(self, tracer: Optional[Tracer | Callable[[Span], None]]) -> H3AggregatorUp:
+        """
+        record every stage of the roll up, see `H3Aggregator.set_tracer`,
+        set the same tracer on the `HBaseClient` to record the fetch as well
+        """
+        self.tracer = as_tracer(tracer)
+        return self
+
+    def set_cell_format(self, cell_format: CellFormat='uint64') -> H3AggregatorUp:
+        """
+        'uint64' fetches with uint64 rowkeys and keeps the uint64 `cell` in the fetched data and the output,
+        the hex strings only exist inside `HBaseClient`
+        """
+        cell_key(cell_format)
+        self.cell_format = cell_format
+        return self
+
+    def _finalize(self, df: pl.LazyFrame) -> pl.LazyFrame:
+        return finalize_cells(df, self.cell_format, self.tracer)
+
     def set_geometry(self, geometry_col: str) -> H3AggregatorUp:
         self.geometry_col = geometry_col
         return self
 
-    def _apply_strategy(self, df: pl.DataFrame) -> pl.DataFrame:
-        if self.strategy is None:
+    def _apply_strategy(self, df: pl.DataFrame, strategy: Optional[AggregationStrategy] = None) -> pl.DataFrame:
+        strategy = strategy or self.strategy
+        if strategy is None:
             raise ValueError("Aggregation strategy must be set before processing data") 
-        return  self.strategy.apply(df, self.target_cols, self.agg_col)
+        return  strategy.apply(df, self.target_cols, self.agg_col)
+
+    def _fetched_cols(self) -> list[str]:
+        # HBase不會回傳沒有任何值的column，這些column的state沒辦法算，直接跳過
+        return fetched_cols(self.data, self.target_cols)
             
     def sum(self, target_cols: list[str], agg_col=None) -> H3AggregatorUp:
         self.strategy = SumAggregationUp()
@@ -137,18 +851,63 @@ class H3AggregatorUp:
         self.target_cols = target_cols
         return self
 
+    def stats(self, target_cols: list[str], stats: Optional[list[str]]=None) -> H3AggregatorUp:
+        """
+        several statistics of every target column, as `{col}_{stat}`
+        stats: list[str], sum, count, mean, std, min, max, mean / std / min / max if None
+        """
+        self.strategy = StatsAggregationUp(stats)
+        self.target_cols = target_cols
+        return self
+
+    def major(self, target_cols: list[str], agg_col=None, categories: Optional[dict[str, list] | list]=None) -> H3AggregatorUp:
+        """
+        the most frequent category of the source cells, counted from the source resolution at every level
+        """
+        self.strategy = MajorAggregation(categories)
+        self.target_cols = target_cols
+        return self
+
+    def percentage(self, target_cols: list[str], agg_col=None, categories: Optional[dict[str, list] | list]=None) -> H3AggregatorUp:
+        """
+        the share of every category of the source cells, as `{col}_{category}`
+        """
+        self.strategy = PercentageAggregation(categories)
+        self.target_cols = target_cols
+        return self
+
+    def kring(self,
+              target_cols: list[str],
+              k: int,
+              how: str = 'mean',
+              decay: Optional[list[float] | Callable[[int], float]] = None,
+        ) -> H3AggregatorUp:
+        """
+        the sum / mean / max of the source cells of every target cell and of its neighbors within `k` rings
+        at `resolution_target`, see `KRingAggregation`
+        """
+        self.strategy = KRingAggregation(k, how, decay)
+        self.target_cols = target_cols
+        return self
+
     def fetch_hbase_data(self, 
                          table_name:str, 
                          column_family:str,
                          column_qualifier: list[str],
-                         data: pl.DataFrame | gpd.GeoDataFrame,
+                         data: GeometryInput,
+                         scan: bool = False,
+                         max_ranges: Optional[int] = None,
         ) -> H3AggregatorUp:
 
         """
         data只需傳入geometry的資訊即可，需要去hbase抓資料, based on geometry的hex_id
+        scan: bool, fetch the compacted cover as rowkey range scans (the client needs a `scan_url`)
+            instead of sending every rowkey
+        max_ranges: int, merge the closest ranges until there are at most `max_ranges` scans,
+            the rows of the merged gaps are filtered out after the scan
         """
 
-        data = data if isinstance(data, pl.DataFrame) else geom_to_wkb(data, self.geometry_col)
+        data = traced_wkb_frame(data, self.geometry_col, self.tracer)
 
         if not self.client:
             raise ValueError("HBase client must be set before fetching data, use `set_client()` to set the client")
@@ -157,49 +916,413 @@ class H3AggregatorUp:
             data
             .fill_nan(0) 
             .lazy() 
-            .pipe(wkb_to_cells, self.resolution_source, self.geometry_col) # convert geometry to h3 cells
-            .select(
-                pl.col('cell')
-                .h3.cells_to_string()
-                .unique()
-                .alias('hex_id'), # scale down to resolution 12
-            )
-            .collect(streaming=True)
+            .pipe(wkb_to_cells, self.resolution_source, self.geometry_col,
+                  workers=self.workers, partition_bytes=self.partition_bytes, cache=self.polyfill_cache,
+                  tracer=self.tracer) # convert geometry to h3 cells
+            .select(pl.col('cell').unique()) # scale down to resolution 12
+            .pipe(self.tracer.collect, 'rowkeys', streaming=True)
         )
+        if scan:
+            # 子孫cell的index是連續的，compact之後每個cell就是一段rowkey range
+            ranges = plan_scan(rowkeys['cell'], self.resolution_source, max_ranges)
+            logging.info(f"Scan {rowkeys.height} rowkeys as {ranges.height} rowkey ranges")
+            self.data = (
+                self.client.fetch_ranges(table_name, column_family, column_qualifier, ranges, as_cells=True)
+                .filter(pl.col('cell').is_in(rowkeys['cell']))
+            )
+            if self.cell_format == 'string':
+                self.data = self.data.select(
+                    pl.col('cell').h3.cells_to_string().alias('hex_id'), pl.exclude('cell')
+                )
+            return self
+
+        # uint64的rowkey由client轉成string, 拿回來的資料也是uint64的cell
         self.data = self.client.fetch_data(
             table_name=table_name,
             cf=column_family,
             cq_list=column_qualifier,
-            rowkeys=rowkeys['hex_id'].to_list(),
+            rowkeys=(
+                rowkeys['cell'] if self.cell_format == 'uint64' else
+                rowkeys['cell'].h3.cells_to_string().to_list()
+            ),
         )
         return self
     
-    def process(self) -> pl.DataFrame:
+    def _rollup_lazy(self,
+                     source: Optional[pl.LazyFrame] = None,
+                     strategy: Optional[AggregationStrategy] = None,
+                     streaming: bool = False,
+        ) -> pl.LazyFrame:
+        """
+        the lazy query rolling the fetched data up to `resolution_target` (cell is still uint64)
+        source: pl.LazyFrame, the cells to roll up instead of the fetched data
+        strategy: AggregationStrategy, the prepared strategy, prepared from the fetched data if None
+        streaming: bool, the query has to run in the streaming engine (to be sunk to a file), otherwise the
+            resolution is changed on the whole column and the in-memory group_by is used, which needs less
+            memory when there are many cells
+        """
+        if strategy is None and self.strategy is not None:
+            strategy = self.strategy.prepare(self.data, self.target_cols, self.agg_col)
+        cell = pl.col('cell')
+        cell = (
+            cell.custom.custom_change_resolution(self.resolution_target)
+            if streaming else
+            cell.h3.change_resolution(self.resolution_target)
+        )
+        return (
+            (source if source is not None else source_cells(self.data))
+            .with_columns(cell.alias('cell')) # 根據cell做resolution的轉換
+            .pipe(self._apply_strategy, strategy)
+        )
 
+    def process(self) -> pl.DataFrame:
         result = (
-            self.data
-            .lazy() 
+            self._rollup_lazy()
+            .pipe(self._finalize)
+            .pipe(self.tracer.collect, 'rollup', streaming=True)
+        )
+        return result
+
+    def process_to(self,
+                   path: str | Path,
+                   format: SinkFormat = 'parquet',
+                   partition_by_parent: Optional[int] = None,
+        ) -> list[Path]:
+        """
+        same as `process`, but the result is written to `path` instead of returned, return the written files
+        format: 'parquet' or 'ipc' (uncompressed Arrow IPC, can be memory-mapped by `pl.read_ipc(memory_map=True)`)
+        partition_by_parent: int, write to the directory `path`, one hive partition `parent=<hex_id>` per parent
+            cell at this resolution, so a tile can be read without the rest
+
+        Without partitions the query is sunk with the streaming engine, whose group_by needs more memory than
+        `process` when there are many output cells. With partitions the fetched data is split by parent first
+        and rolled up a few hundred thousand rows of whole parents at a time, so the result is never held as
+        a whole (except `kring`, whose neighbors cross the partitions, it is sunk first and split afterwards).
+        Send the files with `HBaseClient.send_files`.
+        """
+        if partition_by_parent is not None and not 0 <= partition_by_parent <= self.resolution_target:
+            raise ValueError(
+                f"The parent resolution must be between 0 and {self.resolution_target}, got {partition_by_parent}"
+            )
+        if partition_by_parent is None or isinstance(self.strategy, KRingAggregation):
+            written = sink_to(
+                self._rollup_lazy(streaming=True), path, format, partition_by_parent, self._finalize, self.tracer,
+                'rollup',
+            )
+        else:
+            strategy = self.strategy.prepare(self.data, self.target_cols, self.agg_col) if self.strategy else None
+            written = sink_by_parent(
+                source_cells(self.data), path, format, partition_by_parent,
+                lambda source: self._rollup_lazy(source, strategy), self._finalize, self.tracer, 'rollup',
+            )
+        logging.info(f"Successfully write the data in resolution {self.resolution_target} to {path}")
+        return written
+
+    def process_state(self) -> pl.DataFrame:
+        """
+        the mergeable partial state of the fetched data at `resolution_target` (cell is still uint64),
+        states of different shards are combined with `finalize_states`
+        the category domain of `major` / `percentage` should be given, so every shard has the same columns,
+        `kring` has no partial state
+        """
+        if self.strategy is None:
+            raise ValueError("Aggregation strategy must be set before processing data")
+        check_batchable(self.strategy, 'process_state')
+        target_cols = self._fetched_cols()
+        strategy = self.strategy.prepare(self.data, target_cols, self.agg_col)
+        return (
+            source_cells(self.data)
             .with_columns(
-                # 根據hex_id做resolution的轉換
-                pl.col('hex_id')
-                .h3.cells_parse()
+                pl.col('cell')
                 .h3.change_resolution(self.resolution_target)
                 .alias('cell')
-            ) 
-            .pipe(self._apply_strategy)
-            
-            .select(
-                pl.col('cell')
-                    .h3.cells_to_string()
-                    .alias('hex_id'), 
-                pl.exclude('cell'))
-            .collect(streaming=True)
+            )
+            .pipe(strategy.partial, target_cols, self.agg_col)
+            .pipe(self.tracer.collect, 'rollup_state', streaming=True)
         )
-        return result
+
+    def finalize_states(self,
+                        states: list[pl.DataFrame | pl.LazyFrame | str | Path],
+                        resolution: Optional[int] = None,
+        ) -> pl.DataFrame:
+        """
+        merge the partial states of `process_state` (frames or parquet files) and compute the output columns
+        resolution: int, roll the states up to a coarser resolution before merging
+
+        A target column without a state in any shard (not fetched from HBase anywhere) is skipped.
+        """
+        if self.strategy is None:
+            raise ValueError("Aggregation strategy must be set before processing data")
+        check_batchable(self.strategy, 'finalize_states')
+        states = [pl.scan_parquet(state) if isinstance(state, (str, Path)) else state.lazy() for state in states]
+        names = {name for state in states for name in state.collect_schema().names()}
+        target_cols = [col for col in self.target_cols if names.issuperset(self.strategy.state([col]))]
+        return (
+            merge_states(states, self.strategy, target_cols, self.agg_col, resolution)
+            .pipe(self.strategy.finalize, target_cols, self.agg_col)
+            .pipe(self._finalize)
+            .pipe(self.tracer.collect, 'finalize_states', streaming=True)
+        )
+
+    def process_pyramid(self,
+                        resolutions: list[int],
+                        sink_dir: Optional[str | Path] = None,
+        ) -> dict[int, pl.DataFrame] | dict[int, Path]:
+        """
+        roll up the fetched data to several resolutions in one pass, every coarser resolution is aggregated
+        from the already reduced result of the previous one instead of the full source data
+        resolutions: list[int], the target resolutions, must not be finer than `resolution_source`
+        sink_dir: str | Path, write every resolution to `{sink_dir}/res{r}.parquet` instead of returning the frames
+        `kring` is not supported, a coarser resolution can't be smoothed from the smoothed finer one
+        """
+        if self.strategy is None:
+            raise ValueError("Aggregation strategy must be set before processing data")
+        check_batchable(self.strategy, 'process_pyramid')
+        if not resolutions:
+            raise ValueError("At least one resolution must be provided")
+        if max(resolutions) > self.resolution_source:
+            raise ValueError(f"Resolutions must not be finer than the source resolution {self.resolution_source}")
+
+        # 由細到粗，每一層都從上一層的結果再聚合
+        levels = sorted(set(resolutions), reverse=True)
+        target_cols = self._fetched_cols()
+        strategy = self.strategy.prepare(self.data, target_cols, self.agg_col)
+        state = None
+        results = {}
+        for resolution in levels:
+            if state is None:
+                source = source_cells(self.data)
+                reduce = strategy.partial
+            else:
+                source = state.lazy()
+                reduce = strategy.merge
+            state = (
+                source
+                .with_columns(
+                    pl.col('cell')
+                    .h3.change_resolution(resolution)
+                    .alias('cell')
+                )
+                .pipe(reduce, target_cols, self.agg_col)
+                .pipe(self.tracer.collect, f'pyramid_r{resolution}_state', streaming=True)
+            )
+            result = (
+                strategy.finalize(state.lazy(), target_cols, self.agg_col)
+                .pipe(self._finalize)
+                .pipe(self.tracer.collect, f'pyramid_r{resolution}', streaming=True)
+            )
+            logging.info(f"Successfully roll up the data to resolution {resolution}")
+
+            if sink_dir is None:
+                results[resolution] = result
+            else:
+                path = Path(sink_dir) / f"res{resolution}.parquet"
+                result.write_parquet(path)
+                results[resolution] = path
+
+        return results
     
 
 
 
+class H3AggregatorDown:
+    """
+    push the values of coarse cells (`resolution_source`) down to their children (`resolution_target`),
+    the children are generated for a batch of parents at a time, so the memory depends on `max_children`
+    instead of the number of parents times 7 ** (resolution_target - resolution_source)
+    """
+    def __init__(self):
+        self.client:HBaseClient = None
+        self.strategy:Optional[AggregationStrategy] = None
+        self.target_cols:list[str] = []
+        self.resolution_source:int = 7
+        self.resolution_target:int = 12
+        self.max_children:int = 1_000_000
+        self.weights:Optional[pl.DataFrame] = None
+        self.weight_source:Optional[tuple[str, str, str]] = None
+        self.cell_format:CellFormat = 'string'
+        self.tracer:Tracer = Tracer()
+
+    def set_client(self, client:HBaseClient) -> H3AggregatorDown:
+        self.client = client
+        return self
+
+    def set_resolution_source(self, resolution: int) -> H3AggregatorDown:
+        self.resolution_source = resolution
+        return self
+
+    def set_resolution_target(self, resolution: int) -> H3AggregatorDown:
+        self.resolution_target = resolution
+        return self
+
+    def set_batch_size(self, max_children: int) -> H3AggregatorDown:
+        """
+        max_children: int, the children generated at a time, the parents of a batch are
+            max_children // 7 ** (resolution_target - resolution_source), at least one
+        """
+        self.max_children = max_children
+        return self
+
+    def set_tracer(self, tracer: Optional[Tracer | Callable[[Span], None]]) -> H3AggregatorDown:
+        """
+        record every batch, see `H3Aggregator.set_tracer`
+        """
+        self.tracer = as_tracer(tracer)
+        return self
+
+    def set_cell_format(self, cell_format: CellFormat='uint64') -> H3AggregatorDown:
+        """
+        'uint64' keeps the uint64 `cell` in the output, `send_hbase_data` sends it as the rowkey
+        """
+        cell_key(cell_format)
+        self.cell_format = cell_format
+        return self
+
+    def _finalize(self, df: pl.LazyFrame) -> pl.LazyFrame:
+        return finalize_cells(df, self.cell_format, self.tracer)
+
+    def sum(self, target_cols: list[str], agg_col=None) -> H3AggregatorDown:
+        """
+        split the value of every parent over its children, in proportion to the weights when they are set
+        (`set_weights` / `set_hbase_weights`), evenly otherwise
+        """
+        self.strategy = SumAggregationDown(_WEIGHT)
+        self.target_cols = target_cols
+        return self
+
+    def avg(self, target_cols: list[str], agg_col=None) -> H3AggregatorDown:
+        """
+        every child keeps the value of its parent
+        """
+        self.strategy = AvgAggregationDown()
+        self.target_cols = target_cols
+        return self
+
+    def set_weights(self, weights: Optional[pl.DataFrame | pl.LazyFrame], weight_col: str = 'weight') -> H3AggregatorDown:
+        """
+        the weight of the cells at `resolution_target` (hex_id or uint64 cell, weight_col), e.g. building counts,
+        cells without a weight weigh 0, None splits evenly
+        """
+        self.weight_source = None
+        self.weights = None if weights is None else (
+            source_cells(weights)
+            .select(pl.col('cell'), pl.col(weight_col).cast(pl.Float64).alias(_WEIGHT))
+            .collect()
+        )
+        return self
+
+    def set_hbase_weights(self, table_name: str, column_family: str, column_qualifier: str) -> H3AggregatorDown:
+        """
+        fetch the weights of the children from HBase batch by batch, the children of every parent are one
+        rowkey range, so the client needs a `scan_url`
+        """
+        self.weights = None
+        self.weight_source = (table_name, column_family, column_qualifier)
+        return self
+
+    def _parent_batches(self, data: pl.DataFrame | pl.LazyFrame) -> Iterator[pl.DataFrame]:
+        if self.strategy is None:
+            raise ValueError("Aggregation strategy must be set before processing data")
+        if self.resolution_target <= self.resolution_source:
+            raise ValueError(
+                f"resolution_target ({self.resolution_target}) must be finer than "
+                f"resolution_source ({self.resolution_source})"
+            )
+        parents = source_cells(data).select('cell', *self.target_cols).collect()
+        resolutions = parents['cell'].h3.cells_resolution().unique().to_list()
+        if any(resolution != self.resolution_source for resolution in resolutions):
+            raise ValueError(f"Every cell must be at resolution_source {self.resolution_source}, got {resolutions}")
+
+        batch_size = max(self.max_children // 7 ** (self.resolution_target - self.resolution_source), 1)
+        # 沒有parent的話也給一個空的batch，output才有schema
+        for start in range(0, max(parents.height, 1), batch_size):
+            yield parents.slice(start, batch_size)
+
+    def _batch_weights(self, parents: pl.Series) -> Optional[pl.DataFrame]:
+        if self.weight_source is None:
+            return self.weights
+        if not self.client:
+            raise ValueError("HBase client must be set before fetching weights, use `set_client()` to set the client")
+        if parents.is_empty():
+            return pl.DataFrame(schema={'cell': pl.UInt64, _WEIGHT: pl.Float64})
+        table_name, column_family, column_qualifier = self.weight_source
+        with self.tracer.span('down_weights') as metrics:
+            ranges = plan_scan(parents, self.resolution_target)
+            fetched = self.client.fetch_ranges(table_name, column_family, [column_qualifier], ranges, as_cells=True)
+            # 整個batch都沒有權重的話，拿回來的資料沒有這個column
+            weights = (
+                fetched.select(pl.col('cell'), pl.col(column_qualifier).cast(pl.Float64, strict=False).alias(_WEIGHT))
+                if column_qualifier in fetched.columns else
+                pl.DataFrame(schema={'cell': pl.UInt64, _WEIGHT: pl.Float64})
+            )
+            metrics['rows'] = weights.height
+        return weights
+
+    def process_iter(self, data: pl.DataFrame | pl.LazyFrame) -> Iterator[pl.DataFrame]:
+        """
+        yield the children (hex_id, target columns) of one batch of parents at a time
+        data: the parents at `resolution_source` (hex_id or uint64 cell and the target columns), one row per cell
+        """
+        for i, parents in enumerate(self._parent_batches(data)):
+            logging.info(f"Disaggregating batch {i} with {parents.height} parents")
+            weights = self._batch_weights(parents['cell'])
+            children = (
+                parents
+                .lazy()
+                .with_columns(
+                    pl.col('cell').alias(_PARENT),
+                    pl.col('cell').custom.custom_change_resolution_list(self.resolution_target),
+                )
+                .explode('cell')
+            )
+            if weights is not None:
+                children = children.join(weights.lazy(), on='cell', how='left')
+            else:
+                children = children.with_columns(pl.lit(None, pl.Float64).alias(_WEIGHT))
+            yield (
+                children
+                .pipe(self.strategy.apply, self.target_cols, _PARENT)
+                .pipe(self._finalize)
+                .pipe(self.tracer.collect, 'disaggregate')
+            )
+
+    def process(self, data: pl.DataFrame | pl.LazyFrame, sink: Optional[str | Path] = None) -> Optional[pl.DataFrame]:
+        """
+        the children of every parent, or write them batch by batch to the parquet file `sink`
+        without parents the result is empty (the file too) but still has the output columns
+        """
+        batches = self.process_iter(data)
+        if sink is None:
+            return pl.concat(list(batches))
+
+        writer = None
+        try:
+            for batch in batches:
+                table = batch.to_arrow()
+                writer = writer or pq.ParquetWriter(sink, table.schema)
+                writer.write_table(table)
+        finally:
+            if writer is not None:
+                writer.close()
+        logging.info(f"Successfully sink the result to {sink}")
+
+    def send_hbase_data(self, data: pl.DataFrame | pl.LazyFrame, table_name: str, column_family: str) -> list[str]:
+        """
+        send the children to HBase batch by batch (the target columns are the qualifiers),
+        return the outcome of every chunk
+        """
+        if not self.client:
+            raise ValueError("HBase client must be set before sending data, use `set_client()` to set the client")
+        statuses = []
+        for batch in self.process_iter(data):
+            if batch.is_empty():
+                continue
+            statuses.extend(self.client.send_data(
+                batch, table_name, column_family, self.target_cols, rowkey_col=cell_key(self.cell_format)
+            ))
+        return statuses
+
+
 # class AggFunc(Enum):
 #     """
 #     5 ways to aggregate the data
@@ -1,8 +1,25 @@
 import asyncio
 import aiohttp
 import logging
+import threading
+import time
+import weakref
 import polars as pl
 import json
+from pathlib import Path
+from typing import Callable, Optional, AsyncIterator, Iterator, TYPE_CHECKING
+
+from h3_toolkit.cache import RowkeyCache
+from h3_toolkit.hbase.scheduler import AdaptiveScheduler, ChunkOutcome, TransferReport, TransferError, backoff_delay
+from h3_toolkit.tracing import Tracer, Span, as_tracer
+from h3_toolkit.processing.sink import iter_file_batches
+from h3_toolkit.hbase.codec import (
+    decode_response, to_wide, to_cells, encode_put_payload, encode_delete_payload, encode_scan_ranges,
+    is_cell_rowkeys, rowkeys_to_strings, LONG_SCHEMA, Rowkeys,
+)
+
+if TYPE_CHECKING:
+    from h3_toolkit.processing.delta import Changeset
 
 class SingletontMeta(type):
     _instances = {}
@@ -18,25 +35,284 @@ class HBaseClient(metaclass=SingletontMeta):
                  fetch_url='http://10.100.2.218:2891/api/hbase/v1/test/filterdata2', 
                  send_url='http://10.100.2.218:2891/api/hbase/v1/test/putdata', 
                  max_concurrent_requests=5,
-                 chunk_size=200000
+                 chunk_size=200000,
+                 cache:Optional[RowkeyCache]=None,
+                 connection_limit=100,
+                 connection_limit_per_host=0,
+                 keepalive_timeout=60,
+                 delete_url=None,
+                 scan_url=None,
+                 ranges_per_request=100,
+                 scheduler:Optional[AdaptiveScheduler]=None,
+                 retries=3,
+                 backoff_base=0.5,
+                 backoff_cap=30.0,
                 ):
         """
         semaphore: 限制最大concurrency數量
         chunk_size: 每次request的rowkey數量
+        cache: RowkeyCache, only the rowkeys missing in the cache are fetched from HBase
+        connection_limit: int, the max number of pooled tcp connections, 0 means no limit
+        connection_limit_per_host: int, the max number of pooled tcp connections to the same host, 0 means no limit
+        keepalive_timeout: float, seconds to keep an idle connection alive for the next request
+        delete_url: str, the endpoint deleting rowkeys, needed to send the deletes of a changeset
+        scan_url: str, the endpoint scanning rowkey ranges, needed by `fetch_ranges`
+        ranges_per_request: int, 每次scan request的rowkey range數量
+        scheduler: AdaptiveScheduler, tune the chunk size and the in-flight requests from the observed latency,
+            payload size and failures instead of the fixed `chunk_size` / `max_concurrent_requests`
+        retries: int, the requests of a chunk before it is reported as failed
+        backoff_base, backoff_cap: float, the exponential backoff (with full jitter) between the retries
         """
         self.fetch_url = fetch_url
         self.send_url = send_url
-        self.semaphore = asyncio.Semaphore(max_concurrent_requests)
+        self.delete_url = delete_url
+        self.scan_url = scan_url
+        self.ranges_per_request = ranges_per_request
+        self.scheduler = scheduler
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        # 最近一次fetch / scan / send / delete每個chunk的結果
+        self.last_report:Optional[TransferReport] = None
+        self.tracer:Tracer = Tracer()
+        self.max_concurrent_requests = max_concurrent_requests
         self.chunk_size = chunk_size
+        self.cache = cache
+        self.connection_limit = connection_limit
+        self.connection_limit_per_host = connection_limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        # session跟semaphore都綁定在建立它的event loop上，所以每個loop各自一份
+        self._sessions:weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, aiohttp.ClientSession] = weakref.WeakKeyDictionary()
+        self._semaphores:weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore] = weakref.WeakKeyDictionary()
+        # sync API用的背景event loop，讓connection pool可以在每次呼叫之間重複使用
+        self._loop:Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread:Optional[threading.Thread] = None
+        self._loop_lock = threading.Lock()
+
+    @property
+    def semaphore(self)->asyncio.Semaphore:
+        """
+        the semaphore of the running event loop, limits the number of concurrent requests
+        """
+        loop = asyncio.get_running_loop()
+        if loop not in self._semaphores:
+            limit = self.scheduler.max_concurrency if self.scheduler else self.max_concurrent_requests
+            self._semaphores[loop] = asyncio.Semaphore(limit)
+        return self._semaphores[loop]
+
+    async def _get_session(self)->aiohttp.ClientSession:
+        """
+        the pooled session of the running event loop, created on first use and kept until `close()`
+        """
+        loop = asyncio.get_running_loop()
+        session = self._sessions.get(loop)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.connection_limit,
+                limit_per_host=self.connection_limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            session = aiohttp.ClientSession(connector=connector)
+            self._sessions[loop] = session
+        return session
+
+    def _get_loop(self)->asyncio.AbstractEventLoop:
+        with self._loop_lock:
+            if self._loop is None or self._loop.is_closed():
+                self._loop = asyncio.new_event_loop()
+                self._loop_thread = threading.Thread(target=self._loop.run_forever, name='hbase-client-loop', daemon=True)
+                self._loop_thread.start()
+            return self._loop
+
+    def _run_sync(self, coro):
+        """
+        run the coroutine on the background loop of the client and wait for it,
+        works the same from a plain script and from code already running inside an event loop
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self._get_loop()).result()
+
+    async def aclose(self):
+        """
+        close the pooled session of the running event loop
+        """
+        session = self._sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None and not session.closed:
+            await session.close()
 
-    async def _fetch_data(self, session, form_data):
+    def close(self):
+        """
+        close the pooled sessions and stop the background loop, the client can still be used afterwards,
+        new sessions are created on the next request
+        """
+        for loop, session in list(self._sessions.items()):
+            if session.closed or loop.is_closed():
+                continue
+            if loop is self._loop:
+                self._run_sync(session.close())
+            elif not loop.is_running():
+                loop.run_until_complete(session.close())
+            else:
+                # 別的正在跑的loop只能把close排進去，要馬上關閉請在那個loop裡用`await aclose()`
+                asyncio.run_coroutine_threadsafe(session.close(), loop)
+        self._sessions.clear()
+
+        with self._loop_lock:
+            if self._loop is not None and not self._loop.is_closed():
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                self._loop_thread.join()
+                self._loop.close()
+            self._loop, self._loop_thread = None, None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.aclose()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def set_cache(self, cache:Optional[RowkeyCache]):
+        """
+        HBaseClient is a singleton, use this to attach (or detach with None) a cache after it is created
+        """
+        self.cache = cache
+        return self
+
+    def set_scheduler(self, scheduler:Optional[AdaptiveScheduler]):
+        """
+        attach (or detach with None) an adaptive scheduler, see `AdaptiveScheduler`
+        """
+        self.scheduler = scheduler
+        # semaphore的上限跟著scheduler改
+        self._semaphores.clear()
+        return self
+
+    def set_tracer(self, tracer:Optional[Tracer | Callable[[Span], None]]):
+        """
+        record every round trip (`hbase_fetch` / `hbase_scan` / `hbase_send` / `hbase_delete` with the bytes sent
+        and received and the retries) and the decode / pivot / encode of the payloads
+        """
+        self.tracer = as_tracer(tracer)
+        return self
+
+    def _decode(self, body:bytes)->pl.DataFrame:
+        with self.tracer.span('hbase_decode') as metrics:
+            cells = decode_response(body)
+            metrics['rows'] = cells.height
+        return cells
+
+    def _to_wide(self, cells:pl.DataFrame, as_cells:bool)->pl.DataFrame:
+        with self.tracer.span('hbase_pivot', rows=cells.height):
+            return to_cells(to_wide(cells)) if as_cells else to_wide(cells)
+
+    def _chunk_bounds(self, total:int, size:Optional[int]=None)->Iterator[tuple[int, int]]:
+        """
+        (start, size) of every chunk, the size is read again for every chunk so it follows the scheduler
+        """
+        start = 0
+        while start < total:
+            step = size or (self.scheduler.chunk_size if self.scheduler else self.chunk_size)
+            yield start, min(step, total - start)
+            start += step
+
+    async def _with_retry(self, request)->tuple[object, int]:
+        """
+        call `request()` until it returns something else than None, with backoff between the attempts
+        return the result (None if every attempt failed) and the number of attempts
+        """
+        for attempt in range(self.retries):
+            result = await request()
+            if result is not None:
+                return result, attempt + 1
+            if attempt + 1 < self.retries:
+                delay = backoff_delay(attempt, self.backoff_base, self.backoff_cap)
+                logging.warning(f"Retry {attempt + 1}/{self.retries} failed, next attempt in {delay:.2f}s")
+                await asyncio.sleep(delay)
+        return None, self.retries
+
+    async def _hedged(self, request, delay:float)->tuple[object, int, bool]:
+        """
+        `_with_retry`, plus a second identical request if the first one takes longer than `delay`
+        the first successful response wins and the other request is cancelled
+        """
+        first = asyncio.ensure_future(self._with_retry(request))
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done:
+            return (*first.result(), False)
+        second = asyncio.ensure_future(self._with_retry(request))
+        pending = {first, second}
+        attempts = 0
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    result, tries = task.result()
+                    attempts += tries
+                    if result is not None:
+                        return result, attempts, True
+            return None, attempts, True
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _run_chunk(self,
+                         report:TransferReport,
+                         start:int,
+                         size:int,
+                         payload_bytes:int,
+                         request,
+                         keys:Optional[list]=None,
+                         hedge:bool=False,
+        ):
+        """
+        run the request of one chunk with retries (and hedging for reads), record its outcome in the report
+        and feed the latency to the scheduler, return the result or None if the chunk failed
+        """
+        began = time.perf_counter()
+        delay = self.scheduler.hedge_delay() if hedge and self.scheduler else None
+        if delay is None:
+            result, attempts = await self._with_retry(request)
+            hedged = False
+        else:
+            result, attempts, hedged = await self._hedged(request, delay)
+        seconds = time.perf_counter() - began
+
+        ok = result is not None
+        self.tracer.record(
+            f"hbase_{report.kind}", seconds, rows=size, bytes_sent=payload_bytes,
+            bytes_received=len(result) if isinstance(result, bytes) else 0, retries=attempts - 1,
+        )
+        if self.scheduler is not None:
+            # 有retry的chunk時間包含backoff，不拿來估計延遲
+            self.scheduler.observe(size, seconds if attempts == 1 else 0, payload_bytes, ok)
+        report.add(ChunkOutcome(
+            kind=report.kind,
+            start=start,
+            size=size,
+            status='Success' if ok else 'Failed',
+            attempts=attempts,
+            seconds=seconds,
+            payload_bytes=payload_bytes,
+            hedged=hedged,
+            keys=None if ok else keys,
+        ))
+        if not ok:
+            logging.error(f"{report.kind} chunk {start}-{start + size} failed after {attempts} attempts")
+        return result
+
+    async def _fetch_data(self, session, form_data, url=None):
         async with self.semaphore:
             try:
-                async with session.post(self.fetch_url, data=form_data) as response:
+                async with session.post(url or self.fetch_url, data=form_data) as response:
                     response.raise_for_status() # 有任何不是200的response都會raise exception
-                    response_text = await response.json()
+                    # 拿原始的bytes，之後直接交給polars parse，不用先轉成python dict
+                    response_body = await response.read()
                     logging.info(f"Successfully fetch data")
-                    return response_text
+                    return response_body
             except aiohttp.ClientResponseError as e:
                 logging.error(f"Failed to fetch data: {e.status} {e.message}")
                 return None
@@ -44,36 +320,135 @@ class HBaseClient(metaclass=SingletontMeta):
                 logging.error(f"Exception occurred: {str(e)}")
                 return None
             
-    async def _fetch_data_with_retry(self, session, form_data, retries=3):
-        for attempt in range(retries):
-            result = await self._fetch_data(session, form_data)
-            if result is not None:
-                return result
-            logging.warning(f"Retry {attempt + 1}/{retries} failed for fetching data")
-            await asyncio.sleep(1)
-        return None
-    
-    async def _fetch_data_main(self, table_name, cf, cq_list, rowkeys):
-        async with aiohttp.ClientSession() as session:
-            tasks = []
-            for start in range(0, len(rowkeys), self.chunk_size):
-                form_data = {
-                    "tablename": table_name,
-                    "rowkey": json.dumps(rowkeys[start:start + self.chunk_size]),
-                    "column_qualifiers": json.dumps({cf: cq_list})
-                }
-                tasks.append(self._fetch_data_with_retry(session, form_data))
-            
-            responses = await asyncio.gather(*tasks)
+    async def _fetch_chunk(self, session, table_name, cf, cq_list, rowkeys, start, report):
+        """
+        fetch one chunk of rowkeys, return the rowkeys and the decoded cells (row, qualifier, value)
+        """
+        form_data = {
+            "tablename": table_name,
+            "rowkey": json.dumps(rowkeys),
+            "column_qualifiers": json.dumps({cf: cq_list})
+        }
+        body = await self._run_chunk(
+            report, start, len(rowkeys), len(form_data['rowkey']),
+            lambda: self._fetch_data(session, form_data), keys=rowkeys, hedge=True,
+        )
+        if body is None:
+            return rowkeys, None
+        return rowkeys, self._decode(body)
+
+    async def afetch_data_iter(self,
+                               table_name:str,
+                               cf:str,
+                               cq_list:list[str],
+                               rowkeys:Rowkeys
+        )->AsyncIterator[pl.DataFrame]:
+        """
+        fetch the rowkeys chunk by chunk and yield every chunk as a wide frame (hex_id + one column per qualifier)
+        as soon as it arrives, in the order the responses complete
+        at most `max_concurrent_requests` chunks are fetched or waiting to be consumed at the same time,
+        so the memory does not grow with the number of rowkeys
+        rowkeys given as uint64 cells are keyed by the uint64 `cell` instead of hex_id
+        the outcome of every chunk is in `last_report`, chunks failing every retry raise a `TransferError`
+        after the other chunks were yielded
+        """
+        as_cells = is_cell_rowkeys(rowkeys)
+        wide = lambda cells: self._to_wide(cells, as_cells)
+        rowkeys = rowkeys_to_strings(rowkeys)
+        report = self.last_report = TransferReport('fetch')
+        if self.cache is not None:
+            cached, rowkeys = self.cache.lookup(table_name, cf, cq_list, rowkeys)
+            logging.info(f"{cached['row'].n_unique()} rowkeys from cache, {len(rowkeys)} rowkeys to fetch")
+            # value是null的是cache起來的「HBase沒有這個cell」
+            cached = cached.filter(pl.col('value').is_not_null()).select(list(LONG_SCHEMA))
+            if not cached.is_empty():
+                yield wide(cached)
+
+        if not rowkeys:
+            return
+
+        session = await self._get_session()
+        requests = (
+            self._fetch_chunk(session, table_name, cf, cq_list, rowkeys[start:start + size], start, report)
+            for start, size in self._chunk_bounds(len(rowkeys))
+        )
+        async for chunk, cells in self._as_completed(requests):
+            if cells is None:
+                continue
+            if self.cache is not None:
+                self.cache.put(table_name, cf, cq_list, chunk, cells)
+            if not cells.is_empty():
+                yield wide(cells)
+        if report.failed:
+            raise TransferError(report)
+
+    async def _as_completed(self, requests:Iterator)->AsyncIterator:
+        """
+        run the request coroutines with at most `max_concurrent_requests` (or the concurrency of the scheduler)
+        in flight or waiting to be consumed, and yield their results in the order they complete
+        """
+        pending = set()
+        try:
+            while True:
+                # 補滿in-flight的chunk
+                for request in requests:
+                    pending.add(asyncio.ensure_future(request))
+                    limit = self.scheduler.concurrency if self.scheduler else self.max_concurrent_requests
+                    if len(pending) >= limit:
+                        break
+                if not pending:
+                    break
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+        finally:
+            for task in pending:
+                task.cancel()
 
-            # process
-            dfs = [pl.DataFrame(response[key]) for response in responses if response for key in response.keys()]
-            return pl.concat(dfs, how='vertical')
+    async def _scan_chunk(self, session, table_name, cf, cq_list, ranges, start, report):
+        form_data = {
+            "tablename": table_name,
+            "ranges": encode_scan_ranges(ranges),
+            "column_qualifiers": json.dumps({cf: cq_list})
+        }
+        keys = [(scan['start'], scan['stop']) for scan in json.loads(form_data['ranges'])]
+        body = await self._run_chunk(
+            report, start, ranges.height, len(form_data['ranges']),
+            lambda: self._fetch_data(session, form_data, self.scan_url), keys=keys,
+        )
+        return None if body is None else self._decode(body)
+
+    async def afetch_ranges_iter(self,
+                                 table_name:str,
+                                 cf:str,
+                                 cq_list:list[str],
+                                 ranges:pl.DataFrame,
+                                 as_cells:bool=False,
+        )->AsyncIterator[pl.DataFrame]:
+        """
+        scan the rowkey ranges (start, end) of `plan_scan`, `ranges_per_request` ranges per request, and yield
+        every response as a wide frame, keyed by the uint64 `cell` if `as_cells`
+        the scanned rows are not cached, ranges failing every retry raise a `TransferError` at the end instead
+        of leaving a hole in the result
+        """
+        if self.scan_url is None:
+            raise ValueError("scan_url must be set to scan rowkey ranges")
+        report = self.last_report = TransferReport('scan')
+        session = await self._get_session()
+        requests = (
+            self._scan_chunk(session, table_name, cf, cq_list, ranges.slice(start, size), start, report)
+            for start, size in self._chunk_bounds(ranges.height, self.ranges_per_request)
+        )
+        async for cells in self._as_completed(requests):
+            if cells is not None and not cells.is_empty():
+                yield self._to_wide(cells, as_cells)
+        if report.failed:
+            raise TransferError(report)
     
-    async def _send_data(self, session, result):
+    async def _send_data(self, session, payload, url=None):
         async with self.semaphore:
             try:
-                async with session.post(self.send_url, json=result) as response:
+                async with session.post(url or self.send_url, data=payload, headers={'Content-Type': 'application/json'}) as response:
                     response.raise_for_status() # 有任何不是200的response都會raise exception
                     response_text = await response.text()
                     logging.info(f"Successfully sent data: {response_text}")
@@ -85,66 +460,213 @@ class HBaseClient(metaclass=SingletontMeta):
                 logging.error(f"Exception occurred: {str(e)}")
                 return None
 
-    async def _send_data_with_retry(self, session, result, retries=3):
-        for attempt in range(retries):
-            success = await self._send_data(session, result)
-            if success:
-                return "Success"
-            logging.warning(f"Retry {attempt + 1}/{retries} failed for data chunk")
-            await asyncio.sleep(1)  # 等待一段時間後重試
-        return "Failed"
-    
+    def _encode_put(self, data, table_name, cf, cq_list, rowkey_col, timestamp)->bytes:
+        with self.tracer.span('hbase_encode', rows=data.height):
+            return encode_put_payload(data, table_name, cf, cq_list, rowkey_col, timestamp)
+
+    async def _send_chunk(self, session, payload, start, size, report, url=None, keys=None):
+        success = await self._run_chunk(
+            report, start, size, len(payload), lambda: self._send_data(session, payload, url), keys=keys,
+        )
+        return "Success" if success else "Failed"
+
     async def _send_data_main(self, data, table_name, cf, cq_list, rowkey_col, timestamp):
-        async with aiohttp.ClientSession() as session:
-            tasks = []
-            for start in range(0, len(data), self.chunk_size):
-                chunk = data.slice(start, self.chunk_size)
-                result = {
-                    "cells": [
-                        {
-                            "rowkey": row[rowkey_col],
-                            "datas": {
-                                cf: { cq: str(row[cq]) for cq in cq_list if row[cq] is not None},
-                            }
-                        } for row in chunk.iter_rows(named=True)
-                    ],
-                    "tablename": f"{table_name}",
-                    "timestamp": timestamp if timestamp else ""
-                }
-                tasks.append(self._send_data_with_retry(session, result))
-            
-            responses = await asyncio.gather(*tasks)
-            # for response in responses:
-            #     print(response)
+        report = self.last_report = TransferReport('send')
+        session = await self._get_session()
+        # payload等到要送的時候才產生，同時間最多只有in-flight數量的payload
+        requests = (
+            self._send_chunk(
+                session,
+                self._encode_put(data.slice(start, size), table_name, cf, cq_list, rowkey_col, timestamp),
+                start, size, report,
+            )
+            for start, size in self._chunk_bounds(len(data))
+        )
+        responses = [response async for response in self._as_completed(requests)]
+
+        failed = responses.count("Failed")
+        if failed:
+            logging.error(f"{failed}/{len(responses)} chunks failed to send, see `last_report` for the rows")
+        return responses
+
+    async def _delete_data_main(self, table_name, cf, rowkeys):
+        report = self.last_report = TransferReport('delete')
+        session = await self._get_session()
+        rowkeys = rowkeys_to_strings(rowkeys)
+        requests = (
+            self._send_chunk(
+                session,
+                encode_delete_payload(table_name, cf, rowkeys[start:start + size]),
+                start, size, report, url=self.delete_url, keys=rowkeys[start:start + size],
+            )
+            for start, size in self._chunk_bounds(len(rowkeys))
+        )
+        responses = [response async for response in self._as_completed(requests)]
+
+        failed = responses.count("Failed")
+        if failed:
+            logging.error(f"{failed}/{len(responses)} chunks failed to delete, see `last_report` for the rowkeys")
+        return responses
+
+    async def afetch_data(self,
+                          table_name:str,
+                          cf:str,
+                          cq_list:list[str],
+                          rowkeys:Rowkeys
+        )->pl.DataFrame:
+        """
+        awaitable version of `fetch_data`, for code already running inside an event loop
+        """
+        chunks = []
+        try:
+            async for chunk in self.afetch_data_iter(table_name, cf, cq_list, rowkeys):
+                chunks.append(chunk)
+        except TransferError as e:
+            # 成功的chunk還是交給caller
+            e.partial = pl.concat(chunks, how='diagonal_relaxed') if chunks else None
+            raise
+        if not chunks:
+            logging.warning(f"No data fetched from HBase")
+            return pl.DataFrame(schema={"cell": pl.UInt64} if is_cell_rowkeys(rowkeys) else {"hex_id": pl.String})
+
+        # 每個chunk的qualifier可能不一樣
+        return pl.concat(chunks, how='diagonal_relaxed')
+
+    async def afetch_ranges(self,
+                            table_name:str,
+                            cf:str,
+                            cq_list:list[str],
+                            ranges:pl.DataFrame,
+                            as_cells:bool=False,
+        )->pl.DataFrame:
+        """
+        awaitable version of `fetch_ranges`
+        """
+        chunks = []
+        try:
+            async for chunk in self.afetch_ranges_iter(table_name, cf, cq_list, ranges, as_cells):
+                chunks.append(chunk)
+        except TransferError as e:
+            e.partial = pl.concat(chunks, how='diagonal_relaxed') if chunks else None
+            raise
+        if not chunks:
+            logging.warning(f"No data scanned from HBase")
+            return pl.DataFrame(schema={"cell": pl.UInt64} if as_cells else {"hex_id": pl.String})
+        return pl.concat(chunks, how='diagonal_relaxed')
+
+    async def asend_data(self,
+                         data:pl.DataFrame,
+                         table_name:str,
+                         cf:str,
+                         cq_list:list[str],
+                         rowkey_col="hex_id",
+                         timestamp=None
+        )->list[str]:
+        """
+        awaitable version of `send_data`, return the outcome ("Success" / "Failed") of every chunk
+        """
+        responses = await self._send_data_main(data, table_name, cf, cq_list, rowkey_col, timestamp)
+        if self.cache is not None:
+            # 寫入之後cache裡的值就過期了
+            self.cache.invalidate(table_name, cf)
+        return responses
+
+    async def adelete_data(self,
+                           table_name:str,
+                           cf:str,
+                           rowkeys:Rowkeys,
+        )->list[str]:
+        """
+        awaitable version of `delete_data`, return the outcome ("Success" / "Failed") of every chunk
+        """
+        if self.delete_url is None:
+            raise ValueError("delete_url must be set to delete rowkeys")
+        responses = await self._delete_data_main(table_name, cf, rowkeys)
+        if self.cache is not None:
+            self.cache.invalidate(table_name, cf)
+        return responses
+
+    async def asend_changeset(self,
+                              changeset:'Changeset',
+                              table_name:str,
+                              cf:str,
+                              cq_list:list[str],
+                              timestamp=None,
+        )->dict[str, list[str]]:
+        """
+        awaitable version of `send_changeset`
+        """
+        if changeset.deletes and self.delete_url is None:
+            raise ValueError("delete_url must be set to send a changeset with deletes")
+        rowkey_col = 'cell' if 'cell' in changeset.upserts.columns else 'hex_id'
+        upserts = await self.asend_data(changeset.upserts, table_name, cf, cq_list, rowkey_col, timestamp)
+        deletes = await self.adelete_data(table_name, cf, changeset.deletes) if changeset.deletes else []
+        return {'upserts': upserts, 'deletes': deletes}
+
+    async def asend_files(self,
+                          path:str | Path,
+                          table_name:str,
+                          cf:str,
+                          cq_list:list[str],
+                          rowkey_col="hex_id",
+                          timestamp=None,
+                          batch_rows:int=500_000,
+        )->list[str]:
+        """
+        awaitable version of `send_files`
+        """
+        statuses = []
+        for batch in iter_file_batches(path, batch_rows):
+            statuses.extend(await self.asend_data(batch, table_name, cf, cq_list, rowkey_col, timestamp))
+        return statuses
+
+    def fetch_data_iter(self,
+                        table_name:str,
+                        cf:str,
+                        cq_list:list[str],
+                        rowkeys:Rowkeys
+        )->Iterator[pl.DataFrame]:
+        """
+        sync version of `afetch_data_iter`, yield one wide frame per chunk
+        """
+        chunks = self.afetch_data_iter(table_name, cf, cq_list, rowkeys)
+        try:
+            while True:
+                try:
+                    yield self._run_sync(chunks.__anext__())
+                except StopAsyncIteration:
+                    return
+        finally:
+            self._run_sync(chunks.aclose())
 
     def fetch_data(self, 
                 table_name:str, 
                 cf:str, 
                 cq_list:list[str], 
-                rowkeys:list[str]
+                rowkeys:Rowkeys
         )->pl.DataFrame:
         """
         table_name: str, the table name in HBase, ex: "res12_pre_data"
         cf: str, the column family in HBase, ex: "demographic"
         cq_list: list[str], the column qualifier in HBase, ex: ["p_cnt", "h_cnt"]
-        rowkeys: list[str], the rowkeys to be fetched, ex: ["8c4ba0a415749ff","8c4ba0a415741ff"]
-        """
-        loop = asyncio.get_event_loop()
-        result = loop.run_until_complete(self._fetch_data_main(table_name, cf, cq_list, rowkeys))
-        result = (
-            result
-            .unnest('properties')
-            .pivot(index="row", values="value", on="qualifier")
-            .select(
-                pl.col("row").alias("hex_id"), 
-                pl.exclude("row")
-            )
-        )
-        
-        if result.is_empty():
-            logging.warning(f"No data fetched from HBase")
+        rowkeys: list[str], the rowkeys to be fetched, ex: ["8c4ba0a415749ff","8c4ba0a415741ff"],
+            or a uint64 Series of cells, then the result has a uint64 `cell` column instead of hex_id
+        """
+        return self._run_sync(self.afetch_data(table_name, cf, cq_list, rowkeys))
 
-        return result
+    def fetch_ranges(self,
+                     table_name:str,
+                     cf:str,
+                     cq_list:list[str],
+                     ranges:pl.DataFrame,
+                     as_cells:bool=False,
+        )->pl.DataFrame:
+        """
+        fetch every row in the rowkey ranges instead of listing the rowkeys
+        ranges: pl.DataFrame, (start, end) uint64 cells, both inclusive, from `h3_toolkit.hbase.planner.plan_scan`
+        as_cells: bool, key the result by the uint64 `cell` instead of hex_id
+        """
+        return self._run_sync(self.afetch_ranges(table_name, cf, cq_list, ranges, as_cells))
 
     def send_data(self, 
                 data:pl.DataFrame, 
@@ -155,11 +677,48 @@ class HBaseClient(metaclass=SingletontMeta):
                 timestamp=None
         ):
         """
-        rowkey_col: str, the column name of rowkey, default is "hex_id"
+        rowkey_col: str, the column name of rowkey, default is "hex_id", a uint64 cell column is sent as hex strings
         timestamp: str, if timestamp is None, it will use the current time
         """
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(self._send_data_main(data, table_name, cf, cq_list, rowkey_col, timestamp))
+        return self._run_sync(self.asend_data(data, table_name, cf, cq_list, rowkey_col, timestamp))
+
+    def send_files(self,
+                   path:str | Path,
+                   table_name:str,
+                   cf:str,
+                   cq_list:list[str],
+                   rowkey_col="hex_id",
+                   timestamp=None,
+                   batch_rows:int=500_000,
+        )->list[str]:
+        """
+        `send_data` of the files written by `process_to` (a file or a partitioned directory), read `batch_rows`
+        at a time (ipc files are memory-mapped), so the whole result is never in memory
+        """
+        return self._run_sync(self.asend_files(path, table_name, cf, cq_list, rowkey_col, timestamp, batch_rows))
+
+    def delete_data(self,
+                    table_name:str,
+                    cf:str,
+                    rowkeys:Rowkeys,
+        )->list[str]:
+        """
+        delete every cell of `cf` of the rowkeys, chunked like `send_data`
+        """
+        return self._run_sync(self.adelete_data(table_name, cf, rowkeys))
+
+    def send_changeset(self,
+                       changeset:'Changeset',
+                       table_name:str,
+                       cf:str,
+                       cq_list:list[str],
+                       timestamp=None,
+        )->dict[str, list[str]]:
+        """
+        send the result of `H3Aggregator.process_delta`, the upserts with `send_data` and the deletes with
+        `delete_data`, return the outcomes of the chunks of both
+        """
+        return self._run_sync(self.asend_changeset(changeset, table_name, cf, cq_list, timestamp))
 
 if __name__ == '__main__':
     client = HBaseClient()
@@ -0,0 +1,166 @@
+import io
+import json
+
+import polars as pl
+from h3ronpy.polars import cells_to_string
+import h3ronpy.polars
+
+# rowkey可以是hex string或是uint64的cell，cell只在送出/收到的時候才轉成string
+Rowkeys = list[str] | list[int] | pl.Series
+
+# 一個HBase cell: rowkey, column qualifier, value
+LONG_SCHEMA = {'row': pl.String, 'qualifier': pl.String, 'value': pl.String}
+
+def decode_response(body:bytes)->pl.DataFrame:
+    """
+    decode the response of `filterdata2` into the long format (row, qualifier, value)
+    the json is parsed by polars directly, without building python dicts
+    body: bytes, {"<key>": [{"row": "...", "properties": {"qualifier": "...", "value": "...", ...}}, ...], ...}
+    """
+    if not body or body.strip() in (b'{}', b'[]'):
+        return pl.DataFrame(schema=LONG_SCHEMA)
+
+    df = pl.read_json(io.BytesIO(body))
+    # 沒有資料的key會是List(Null)，直接跳過
+    keys = [
+        key for key, dtype in df.schema.items()
+        if isinstance(dtype, pl.List) and isinstance(dtype.inner, pl.Struct)
+    ]
+    if not keys:
+        return pl.DataFrame(schema=LONG_SCHEMA)
+
+    return (
+        pl.concat(
+            [df.select(pl.col(key).explode()).unnest(key) for key in keys],
+            how='diagonal_relaxed'
+        )
+        .unnest('properties')
+        .select(
+            pl.col('row').cast(pl.String),
+            pl.col('qualifier').cast(pl.String),
+            pl.col('value').cast(pl.String),
+        )
+    )
+
+def to_wide(df:pl.DataFrame)->pl.DataFrame:
+    """
+    long format (row, qualifier, value) -> one row per rowkey (hex_id) and one column per qualifier
+    """
+    if df.is_empty():
+        return pl.DataFrame(schema={'hex_id': pl.String})
+    return (
+        df
+        .pivot(index="row", values="value", on="qualifier")
+        .select(
+            pl.col("row").alias("hex_id"),
+            pl.exclude("row")
+        )
+    )
+
+def is_cell_rowkeys(rowkeys:Rowkeys)->bool:
+    """
+    the rowkeys are uint64 cells instead of hex strings
+    """
+    if isinstance(rowkeys, pl.Series):
+        return rowkeys.dtype == pl.UInt64
+    return bool(len(rowkeys)) and isinstance(rowkeys[0], int)
+
+def rowkeys_to_strings(rowkeys:Rowkeys)->list[str]:
+    """
+    the hex strings of the rowkeys, uint64 cells are formatted in one vectorized call
+    """
+    if is_cell_rowkeys(rowkeys):
+        return cells_to_string(pl.Series(rowkeys, dtype=pl.UInt64)).to_list()
+    return rowkeys.to_list() if isinstance(rowkeys, pl.Series) else list(rowkeys)
+
+def to_cells(df:pl.DataFrame)->pl.DataFrame:
+    """
+    wide frame keyed by hex_id -> keyed by the uint64 `cell`
+    """
+    return df.select(pl.col('hex_id').h3.cells_parse().alias('cell'), pl.exclude('hex_id'))
+
+def _json_string(expr:pl.Expr)->pl.Expr:
+    """
+    quote and escape a string expression as a json string
+    """
+    escaped = expr
+    for char, replacement in _JSON_ESCAPES:
+        escaped = escaped.str.replace_all(char, replacement, literal=True)
+    return pl.concat_str([pl.lit('"'), escaped, pl.lit('"')])
+
+# backslash一定要第一個處理
+_JSON_ESCAPES = [('\\', '\\\\'), ('"', '\\"'), ('\n', '\\n'), ('\r', '\\r'), ('\t', '\\t')]
+
+def _value_to_string(col:str, dtype:pl.DataType)->pl.Expr:
+    """
+    same string as python `str(value)`, which was used to build the payload row by row
+    """
+    if dtype == pl.Boolean:
+        return pl.when(pl.col(col)).then(pl.lit('True')).otherwise(pl.lit('False'))
+    return pl.col(col).cast(pl.String)
+
+def encode_put_cells(df:pl.DataFrame, cf:str, cq_list:list[str], rowkey_col:str)->pl.Series:
+    """
+    build the json of every row of `putdata` with polars expressions, null values are left out
+    {"rowkey": "...", "datas": {"<cf>": {"<cq>": "<value>", ...}}}
+    """
+    missing = [col for col in [rowkey_col, *cq_list] if col not in df.columns]
+    if missing:
+        raise ValueError(f"Columns {missing} not found in the input DataFrame")
+    if df.schema[rowkey_col] == pl.UInt64:
+        df = df.with_columns(cells_to_string(df[rowkey_col]).alias(rowkey_col))
+
+    datas = pl.concat_str(
+        [
+            pl.when(pl.col(cq).is_not_null())
+            .then(pl.concat_str([pl.lit(json.dumps(cq) + ':'), _json_string(_value_to_string(cq, df.schema[cq]))]))
+            for cq in cq_list
+        ],
+        separator=',',
+        ignore_nulls=True,
+    ) if cq_list else pl.lit('')
+
+    return df.select(
+        pl.concat_str([
+            pl.lit('{"rowkey":'),
+            _json_string(pl.col(rowkey_col).cast(pl.String)),
+            pl.lit(',"datas":{' + json.dumps(cf) + ':{'),
+            datas,
+            pl.lit('}}}'),
+        ])
+    ).to_series()
+
+def encode_put_payload(df:pl.DataFrame,
+                       table_name:str,
+                       cf:str,
+                       cq_list:list[str],
+                       rowkey_col:str,
+                       timestamp=None,
+    )->bytes:
+    """
+    the request body of `putdata` for one chunk, serialized in bulk instead of a python dict per row
+    """
+    cells = encode_put_cells(df, cf, cq_list, rowkey_col).str.join(',').item() if df.height else ''
+    return (
+        '{"cells":[' + cells + '],'
+        f'"tablename":{json.dumps(f"{table_name}")},'
+        f'"timestamp":{json.dumps(timestamp if timestamp else "")}}}'
+    ).encode()
+
+def encode_delete_payload(table_name:str, cf:str, rowkeys:Rowkeys)->bytes:
+    """
+    the request body of `deletedata` for one chunk, every cell of `cf` of the rowkeys is deleted
+    {"tablename": "...", "cf": "...", "rowkeys": ["...", ...]}
+    """
+    return json.dumps({'tablename': table_name, 'cf': cf, 'rowkeys': rowkeys_to_strings(rowkeys)}).encode()
+
+def encode_scan_ranges(ranges:pl.DataFrame)->str:
+    """
+    the `ranges` form field of `scandata`, (start, end) uint64 cells are sent as rowkey ranges with an
+    inclusive start and an exclusive stop, like a HBase scan
+    [{"start": "...", "stop": "..."}, ...]
+    """
+    return json.dumps([
+        {'start': f'{start:015x}', 'stop': f'{end + 1:015x}'}
+        for start, end in ranges.select('start', 'end').iter_rows()
+    ])
@@ -0,0 +1,195 @@
+import asyncio
+import bisect
+import json
+import threading
+from collections import defaultdict
+from typing import Optional
+
+from aiohttp import web
+
+class LocalHBaseServer:
+    """
+    in-memory stand-in of the HBase REST gateway, for tests and benchmarks
+    it implements `filterdata2`, `scandata`, `putdata` and `deletedata` with the same request and response format
+
+        with LocalHBaseServer() as server:
+            client = HBaseClient(fetch_url=server.fetch_url, send_url=server.send_url)
+
+    the server runs its own event loop in a background thread
+    capacity: int, requests served at the same time, the others wait in a queue like on a saturated gateway
+    latency: float, seconds added to every request, plus `seconds_per_mb` of the request body
+    fail_next: int, answer the next `fail_next` requests with 503, to test retries and failure reports
+    """
+    def __init__(self,
+                 host:str='127.0.0.1',
+                 port:int=0,
+                 capacity:Optional[int]=None,
+                 latency:float=0.0,
+                 seconds_per_mb:float=0.0,
+        ):
+        self.host = host
+        self.port = port
+        self.capacity = capacity
+        self.latency = latency
+        self.seconds_per_mb = seconds_per_mb
+        self.fail_next = 0
+        # table -> rowkey -> (cf, qualifier) -> value
+        self.tables:dict[str, dict[str, dict[tuple[str, str], str]]] = defaultdict(lambda: defaultdict(dict))
+        # scan用的排序過的rowkey，寫入或刪除之後重建
+        self._sorted_rowkeys:dict[str, list[str]] = {}
+        self.requests:dict[str, int] = defaultdict(int)
+        self.bytes_received = 0
+        self._loop:Optional[asyncio.AbstractEventLoop] = None
+        self._runner:Optional[web.AppRunner] = None
+        self._thread:Optional[threading.Thread] = None
+
+    @property
+    def url(self)->str:
+        return f"http://{self.host}:{self.port}"
+
+    @property
+    def fetch_url(self)->str:
+        return f"{self.url}/filterdata2"
+
+    @property
+    def scan_url(self)->str:
+        return f"{self.url}/scandata"
+
+    @property
+    def send_url(self)->str:
+        return f"{self.url}/putdata"
+
+    @property
+    def delete_url(self)->str:
+        return f"{self.url}/deletedata"
+
+    def _app(self)->web.Application:
+        capacity = asyncio.Semaphore(self.capacity) if self.capacity else None
+
+        @web.middleware
+        async def simulate(request:web.Request, handler)->web.StreamResponse:
+            if self.fail_next > 0:
+                self.fail_next -= 1
+                self.requests['failed'] += 1
+                return web.Response(status=503, text='unavailable')
+            async def serve()->web.StreamResponse:
+                delay = self.latency + self.seconds_per_mb * (request.content_length or 0) / 1024 ** 2
+                if delay:
+                    await asyncio.sleep(delay)
+                return await handler(request)
+
+            if capacity is None:
+                return await serve()
+            async with capacity:
+                return await serve()
+
+        app = web.Application(client_max_size=1024 ** 3, middlewares=[simulate])
+        app.router.add_post('/filterdata2', self._filterdata2)
+        app.router.add_post('/scandata', self._scandata)
+        app.router.add_post('/putdata', self._putdata)
+        app.router.add_post('/deletedata', self._deletedata)
+        return app
+
+    @staticmethod
+    def _cells(table:dict, rowkeys:list[str], column_qualifiers:str)->list[dict]:
+        columns = [
+            (cf, qualifier)
+            for cf, qualifiers in json.loads(column_qualifiers).items()
+            for qualifier in qualifiers
+        ]
+        return [
+            {
+                'row': rowkey,
+                'properties': {'family': cf, 'qualifier': qualifier, 'value': table[rowkey][(cf, qualifier)]},
+            }
+            for rowkey in rowkeys if rowkey in table
+            for cf, qualifier in columns if (cf, qualifier) in table[rowkey]
+        ]
+
+    async def _filterdata2(self, request:web.Request)->web.Response:
+        self.requests['filterdata2'] += 1
+        form = await request.post()
+        self.bytes_received += request.content_length or 0
+        table = self.tables.get(form['tablename'], {})
+        cells = self._cells(table, json.loads(form['rowkey']), form['column_qualifiers'])
+        return web.json_response({'data': cells})
+
+    async def _scandata(self, request:web.Request)->web.Response:
+        """
+        every rowkey in [start, stop) of the ranges
+        """
+        self.requests['scandata'] += 1
+        form = await request.post()
+        self.bytes_received += request.content_length or 0
+        name = form['tablename']
+        table = self.tables.get(name, {})
+        if name not in self._sorted_rowkeys:
+            self._sorted_rowkeys[name] = sorted(table)
+        keys = self._sorted_rowkeys[name]
+        rowkeys = [
+            key
+            for scan in json.loads(form['ranges'])
+            for key in keys[bisect.bisect_left(keys, scan['start']):bisect.bisect_left(keys, scan['stop'])]
+        ]
+        cells = self._cells(table, rowkeys, form['column_qualifiers'])
+        return web.json_response({'data': cells})
+
+    async def _putdata(self, request:web.Request)->web.Response:
+        self.requests['putdata'] += 1
+        body = await request.read()
+        self.bytes_received += len(body)
+        payload = json.loads(body)
+        table = self.tables[payload['tablename']]
+        self._sorted_rowkeys.pop(payload['tablename'], None)
+        for cell in payload['cells']:
+            for cf, values in cell['datas'].items():
+                for qualifier, value in values.items():
+                    table[cell['rowkey']][(cf, qualifier)] = value
+        return web.Response(text=f"put {len(payload['cells'])} rows")
+
+    async def _deletedata(self, request:web.Request)->web.Response:
+        self.requests['deletedata'] += 1
+        body = await request.read()
+        self.bytes_received += len(body)
+        payload = json.loads(body)
+        table = self.tables[payload['tablename']]
+        self._sorted_rowkeys.pop(payload['tablename'], None)
+        for rowkey in payload['rowkeys']:
+            row = table.get(rowkey, {})
+            for key in [key for key in row if key[0] == payload['cf']]:
+                del row[key]
+            if not row:
+                table.pop(rowkey, None)
+        return web.Response(text=f"delete {len(payload['rowkeys'])} rows")
+
+    def start(self)->'LocalHBaseServer':
+        ready = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._runner = web.AppRunner(self._app())
+            self._loop.run_until_complete(self._runner.setup())
+            site = web.TCPSite(self._runner, self.host, self.port)
+            self._loop.run_until_complete(site.start())
+            # port=0的話由OS決定port
+            self.port = site._server.sockets[0].getsockname()[1]
+            ready.set()
+            self._loop.run_forever()
+            self._loop.run_until_complete(self._runner.cleanup())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, name='local-hbase-server', daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self
+
+    def stop(self)->None:
+        if self._loop is not None and self._loop.is_running():
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+
+    def __enter__(self)->'LocalHBaseServer':
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb)->None:
+        self.stop()
@@ -0,0 +1,79 @@
+from typing import Optional
+
+import numpy as np
+import polars as pl
+import h3ronpy.polars
+
+# H3 index的bit layout: mode在bit 59-62, resolution在bit 52-55, base cell在bit 45-51,
+# 之後是15個3 bits的digit，沒用到的digit都是7
+_MODE_CELL = np.uint64(1) << np.uint64(59)
+_RES_OFFSET = np.uint64(52)
+_BASE_OFFSET = np.uint64(45)
+_MAX_RES = 15
+
+def _digit_offset(i:int)->np.uint64:
+    return np.uint64(3 * (_MAX_RES - i))
+
+def cell_ordinals(cells:np.ndarray, resolution:int)->np.ndarray:
+    """
+    the position of the first descendant at `resolution` of every cell, counted in base 7 from the base cell
+    every descendant of a cell at `resolution` is in [ordinal, ordinal + 7 ** (resolution - cell resolution))
+    """
+    cells = cells.astype(np.uint64)
+    res = ((cells >> _RES_OFFSET) & np.uint64(15)).astype(np.int64)
+    if (res > resolution).any():
+        raise ValueError(f"Cells must not be finer than the scan resolution {resolution}")
+    ordinals = ((cells >> _BASE_OFFSET) & np.uint64(127)).astype(np.int64)
+    for i in range(1, resolution + 1):
+        digit = ((cells >> _digit_offset(i)) & np.uint64(7)).astype(np.int64)
+        # 比cell自己的resolution還細的digit都從0開始
+        ordinals = ordinals * 7 + np.where(i <= res, digit, 0)
+    return ordinals
+
+def ordinals_to_cells(ordinals:np.ndarray, resolution:int)->np.ndarray:
+    """
+    the cells at `resolution` of the ordinals of `cell_ordinals`
+    """
+    ordinals = ordinals.astype(np.int64)
+    cells = np.full(len(ordinals), _MODE_CELL | (np.uint64(resolution) << _RES_OFFSET), dtype=np.uint64)
+    for i in range(_MAX_RES, 0, -1):
+        if i > resolution:
+            digit = np.full(len(ordinals), 7, dtype=np.uint64)
+        else:
+            ordinals, digit = np.divmod(ordinals, 7)
+        cells |= digit.astype(np.uint64) << _digit_offset(i)
+    return cells | (ordinals.astype(np.uint64) << _BASE_OFFSET)
+
+def plan_scan(cells:pl.Series, resolution:int, max_ranges:Optional[int]=None)->pl.DataFrame:
+    """
+    the rowkey ranges (start, end, both inclusive cells at `resolution`) covering the cells
+
+    The cells are compacted first, the descendants of a compacted cell are one contiguous rowkey range,
+    and adjacent ranges are merged. With `max_ranges`, the smallest gaps are merged as well until there
+    are at most `max_ranges` ranges, the rows in the merged gaps are not in `cells` and must be filtered
+    out after the scan.
+    cells: pl.Series, uint64 cells at `resolution`
+    """
+    cells = cells.drop_nulls().unique()
+    if cells.is_empty():
+        return pl.DataFrame(schema={'start': pl.UInt64, 'end': pl.UInt64})
+
+    compacted = cells.h3.compact().to_numpy()
+    res = ((compacted >> _RES_OFFSET) & np.uint64(15)).astype(np.int64)
+    starts = cell_ordinals(compacted, resolution)
+    ends = starts + 7 ** (resolution - res) - 1
+    order = np.argsort(starts)
+    starts, ends = starts[order], ends[order]
+
+    # 兩個range之間沒有任何cell的話就是連在一起的
+    gaps = starts[1:] - ends[:-1] - 1
+    merge = gaps == 0
+    if max_ranges is not None and len(starts) - merge.sum() > max_ranges:
+        n_merge = len(starts) - max(max_ranges, 1)
+        merge[np.argsort(gaps, kind='stable')[:n_merge]] = True
+    keep = np.concatenate([[True], ~merge])
+    last = np.concatenate([~merge, [True]])
+    return pl.DataFrame({
+        'start': pl.Series(ordinals_to_cells(starts[keep], resolution), dtype=pl.UInt64),
+        'end': pl.Series(ordinals_to_cells(ends[last], resolution), dtype=pl.UInt64),
+    })
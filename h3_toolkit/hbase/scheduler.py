@@ -0,0 +1,170 @@
+import random
+from collections import deque
+from typing import NamedTuple, Optional
+
+import numpy as np
+import polars as pl
+
+def backoff_delay(attempt:int, base:float=0.5, cap:float=30.0)->float:
+    """
+    seconds to wait before retry `attempt` (0 based), exponential backoff with full jitter, so the retries of
+    the chunks failing together are spread out instead of hitting the gateway again at the same time
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+class ChunkOutcome(NamedTuple):
+    """
+    kind: fetch / scan / send / delete
+    start: the offset of the chunk in the rowkeys, ranges or rows of the call
+    size: the number of rowkeys, ranges or rows of the chunk
+    status: "Success" / "Failed"
+    attempts: the number of requests, retries included
+    seconds: the wall time of the chunk, retries and backoff included
+    payload_bytes: the size of the request body
+    hedged: a second request was sent because the first one was slow
+    keys: the rowkeys (fetch / delete) or the (start, stop) rowkeys (scan) of a failed chunk
+    """
+    kind: str
+    start: int
+    size: int
+    status: str
+    attempts: int
+    seconds: float
+    payload_bytes: int
+    hedged: bool = False
+    keys: Optional[list] = None
+
+class TransferReport:
+    """
+    the outcome of every chunk of one `fetch_data` / `fetch_ranges` / `send_data` / `delete_data` call
+    """
+    def __init__(self, kind:str):
+        self.kind = kind
+        self.outcomes:list[ChunkOutcome] = []
+
+    def add(self, outcome:ChunkOutcome)->None:
+        self.outcomes.append(outcome)
+
+    @property
+    def failed(self)->list[ChunkOutcome]:
+        return [outcome for outcome in self.outcomes if outcome.status != 'Success']
+
+    @property
+    def failed_keys(self)->list:
+        return [key for outcome in self.failed for key in (outcome.keys or [])]
+
+    def to_frame(self)->pl.DataFrame:
+        """
+        one row per chunk, without the keys
+        """
+        return pl.DataFrame(
+            [outcome._asdict() for outcome in self.outcomes],
+            schema={
+                'kind': pl.String, 'start': pl.Int64, 'size': pl.Int64, 'status': pl.String, 'attempts': pl.Int64,
+                'seconds': pl.Float64, 'payload_bytes': pl.Int64, 'hedged': pl.Boolean,
+            },
+        )
+
+    def summary(self)->dict:
+        return {
+            'chunks': len(self.outcomes),
+            'failed': len(self.failed),
+            'size': sum(outcome.size for outcome in self.outcomes),
+            'failed_size': sum(outcome.size for outcome in self.failed),
+            'retries': sum(outcome.attempts - 1 for outcome in self.outcomes),
+            'hedged': sum(outcome.hedged for outcome in self.outcomes),
+            'payload_bytes': sum(outcome.payload_bytes for outcome in self.outcomes),
+        }
+
+    def __repr__(self)->str:
+        return f"TransferReport({self.kind}, {self.summary()})"
+
+class TransferError(RuntimeError):
+    """
+    raised after the last chunk when some chunks still failed after every retry
+    report: TransferReport, the failed chunks and their rowkeys
+    partial: pl.DataFrame, the rows of the chunks which succeeded (set by `fetch_data` / `fetch_ranges`)
+    """
+    def __init__(self, report:TransferReport, partial:Optional[pl.DataFrame]=None):
+        summary = report.summary()
+        super().__init__(
+            f"{summary['failed']}/{summary['chunks']} {report.kind} chunks "
+            f"({summary['failed_size']} of {summary['size']}) failed after every retry"
+        )
+        self.report = report
+        self.partial = partial
+
+class AdaptiveScheduler:
+    """
+    tune the chunk size and the number of in-flight requests of `HBaseClient` from the observed requests
+
+    chunk size: every successful chunk moves it towards the size which takes `target_seconds`, at most halved
+        or doubled at a time, and never above `max_payload_bytes` per request
+    concurrency: additive increase while the (smoothed) seconds per row stay close to the best seen so far,
+        decrease by one when they grow by `congestion_factor` (the gateway is queueing), and halve with the
+        chunk size on a failed request
+    hedge_quantile: send a second request for a fetch slower than this quantile of the recent latencies,
+        the first response wins, None disables hedging
+    """
+    def __init__(self,
+                 chunk_size:int=20000,
+                 min_chunk_size:int=1000,
+                 max_chunk_size:int=200000,
+                 concurrency:int=2,
+                 max_concurrency:int=16,
+                 target_seconds:float=1.0,
+                 max_payload_bytes:int=64 * 1024 ** 2,
+                 congestion_factor:float=2.0,
+                 hedge_quantile:Optional[float]=None,
+                 window:int=64,
+        ):
+        self.chunk_size = chunk_size
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.concurrency = concurrency
+        self.max_concurrency = max_concurrency
+        self.target_seconds = target_seconds
+        self.max_payload_bytes = max_payload_bytes
+        self.congestion_factor = congestion_factor
+        self.hedge_quantile = hedge_quantile
+        self._latencies:deque[float] = deque(maxlen=window)
+        self._best_seconds_per_row:Optional[float] = None
+        self._seconds_per_row:Optional[float] = None
+
+    def observe(self, size:int, seconds:float, payload_bytes:int, ok:bool)->None:
+        """
+        update the chunk size and the concurrency after a chunk
+        """
+        if not ok:
+            self.concurrency = max(1, self.concurrency // 2)
+            self.chunk_size = max(self.min_chunk_size, self.chunk_size // 2)
+            return
+        if size <= 0 or seconds <= 0:
+            return
+        self._latencies.append(seconds)
+
+        per_row = seconds / size
+        if self._best_seconds_per_row is None or per_row < self._best_seconds_per_row:
+            self._best_seconds_per_row = per_row
+        # 單一個慢的request不代表gateway塞住了，用EWMA平滑
+        self._seconds_per_row = (
+            per_row if self._seconds_per_row is None else 0.8 * self._seconds_per_row + 0.2 * per_row
+        )
+        if self._seconds_per_row > self._best_seconds_per_row * self.congestion_factor:
+            self.concurrency = max(1, self.concurrency - 1)
+        else:
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+
+        target = size * self.target_seconds / seconds
+        if payload_bytes:
+            target = min(target, size * self.max_payload_bytes / payload_bytes)
+        target = min(max(target, self.chunk_size / 2), self.chunk_size * 2)
+        self.chunk_size = int(min(max(target, self.min_chunk_size), self.max_chunk_size))
+
+    def hedge_delay(self)->Optional[float]:
+        """
+        seconds to wait for a fetch before hedging it, None while hedging is off or there are too few samples
+        """
+        if self.hedge_quantile is None or len(self._latencies) < 10:
+            return None
+        return float(np.quantile(np.fromiter(self._latencies, dtype=float), self.hedge_quantile))
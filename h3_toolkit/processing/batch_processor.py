@@ -0,0 +1,51 @@
+from typing import Iterator, Optional
+
+import numpy as np
+import polars as pl
+
+def group_boundaries(df:pl.DataFrame, group_col:Optional[str]=None)->np.ndarray:
+    """
+    return the row offsets where a new group starts (plus the total height at the end)
+    df: polars.DataFrame, the input dataframe, rows of the same group must be contiguous
+    group_col: str, the group column, if None every row is its own group
+    """
+    if group_col is None:
+        return np.arange(df.height + 1)
+
+    starts = (
+        df
+        .select(
+            (pl.col(group_col).rle_id().diff() != 0)
+            .fill_null(True)
+            .arg_true()
+        )
+        .to_series()
+        .to_numpy()
+    )
+    return np.append(starts, df.height)
+
+def iter_batches(df:pl.DataFrame,
+                 batch_size:int,
+                 group_col:Optional[str]=None
+                 )->Iterator[pl.DataFrame]:
+    """
+    slice the dataframe into batches of about `batch_size` rows without splitting a group
+    df: polars.DataFrame, the input dataframe
+    batch_size: int, the number of rows in each batch, a batch only grows beyond it to keep a group together
+    group_col: str, rows sharing the same value are always put in the same batch
+    """
+    if batch_size < 1:
+        raise ValueError("batch_size must be a positive integer")
+
+    if group_col is not None:
+        # 同一個group的row要連續才能切在同一個batch
+        df = df.sort(group_col, maintain_order=True, nulls_last=True)
+
+    bounds = group_boundaries(df, group_col)
+    start = 0
+    while start < df.height:
+        # 往後找到第一個 >= start + batch_size 的group邊界
+        idx = np.searchsorted(bounds, start + batch_size, side='left')
+        end = int(bounds[min(idx, len(bounds) - 1)])
+        yield df.slice(start, end - start)
+        start = end
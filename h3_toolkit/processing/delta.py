@@ -0,0 +1,92 @@
+from __future__ import annotations
+from pathlib import Path
+from typing import NamedTuple, Optional
+import uuid
+
+import polars as pl
+
+# manifest: 上一次處理過的每一個geometry
+# <id_col>: the id of the input row, fingerprint: hash of the wkb and the attributes,
+# group: the value of `agg_col`, cells: the cells covered by the geometry
+
+class Changeset(NamedTuple):
+    """
+    the result of an incremental run
+    upserts: the rows (hex_id, ...) to write, every other cell of the previous run is unchanged
+    deletes: the hex_ids (uint64 cells with the uint64 cell format) no longer covered by any geometry
+    manifest: the manifest after this run
+    stats: the number of new / changed / deleted / unchanged input rows and of the affected cells
+    """
+    upserts: pl.DataFrame
+    deletes: list[str] | list[int]
+    manifest: pl.DataFrame
+    stats: dict[str, int]
+
+def manifest_schema(id_col:str, id_dtype:pl.DataType, group_dtype:pl.DataType)->dict[str, pl.DataType]:
+    return {
+        id_col: id_dtype,
+        'fingerprint': pl.UInt64,
+        'group': group_dtype,
+        'cells': pl.List(pl.UInt64),
+    }
+
+def fingerprint(geom_col:str, attribute_cols:list[str])->pl.Expr:
+    """
+    hash of the wkb and the attributes of every row
+    the hash of polars is only stable within the same polars version, after an upgrade every row is
+    seen as changed once and the manifest is rebuilt
+    """
+    # struct不能hash，先hash每個column再hash整個list
+    return (
+        pl.concat_list([pl.col(col).hash(seed=0) for col in [geom_col, *attribute_cols]])
+        .hash(seed=0)
+        .alias('fingerprint')
+    )
+
+def read_manifest(path:str | Path, id_col:str, id_dtype:pl.DataType, group_dtype:pl.DataType)->pl.DataFrame:
+    schema = manifest_schema(id_col, id_dtype, group_dtype)
+    if not Path(path).exists():
+        return pl.DataFrame(schema=schema)
+    manifest = pl.read_parquet(path)
+    if id_col not in manifest.columns:
+        raise ValueError(f"The manifest {path} is not keyed by '{id_col}'")
+    return manifest.cast(schema)
+
+def write_manifest(manifest:pl.DataFrame, path:str | Path)->None:
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # 先寫到暫存檔再rename，中途失敗的話舊的manifest還在
+    tmp = path.parent / f".{path.name}.{uuid.uuid4().hex}.tmp"
+    manifest.write_parquet(tmp)
+    tmp.replace(path)
+
+def diff_manifest(current:pl.DataFrame, manifest:pl.DataFrame, id_col:str)->dict[str, pl.Series]:
+    """
+    compare the fingerprints of the current rows (id, fingerprint) with the manifest
+    return the ids of the new, changed, deleted and unchanged rows
+    """
+    joined = current.join(
+        manifest.select(id_col, pl.col('fingerprint').alias('previous')),
+        on=id_col,
+        how='full',
+        coalesce=True,
+    )
+    return {
+        'new': joined.filter(pl.col('previous').is_null())[id_col],
+        'changed': joined.filter(pl.col('fingerprint') != pl.col('previous'))[id_col],
+        'deleted': joined.filter(pl.col('fingerprint').is_null())[id_col],
+        'unchanged': joined.filter(pl.col('fingerprint') == pl.col('previous'))[id_col],
+    }
+
+def manifest_cells(manifest:pl.DataFrame, id_col:str, ids:Optional[pl.Series]=None)->pl.DataFrame:
+    """
+    (id, cell) of the geometries in the manifest, all of them if ids is None
+    """
+    if ids is not None:
+        manifest = manifest.filter(pl.col(id_col).is_in(ids))
+    return (
+        manifest
+        .select(id_col, pl.col('cells').alias('cell'))
+        .explode('cell')
+        .drop_nulls('cell')
+    )
@@ -0,0 +1,124 @@
+from typing import Callable, Optional
+
+import numpy as np
+import polars as pl
+import pyarrow as pa
+from h3ronpy import ContainmentMode as Cont
+from h3ronpy.arrow.vector import coordinates_to_cells, wkb_to_cells
+
+from h3_toolkit.tracing import Tracer
+
+# 每個wkb的種類
+POLYGON, POINT, LINE = 0, 1, 2
+
+# little endian的2D point: byte order(1) + type(4) + x(8) + y(8)
+_POINT_WKB_SIZE = 21
+_POINT_DTYPE = np.dtype([('byte_order', 'u1'), ('type', '<u4'), ('x', '<f8'), ('y', '<f8')])
+
+def points_to_wkb(x:np.ndarray, y:np.ndarray)->pa.Array:
+    """
+    the little endian wkb of 2D points, written with numpy instead of parsing every geometry with shapely
+    """
+    records = np.empty(len(x), dtype=_POINT_DTYPE)
+    records['byte_order'], records['type'], records['x'], records['y'] = 1, 1, x, y
+    offsets = np.arange(len(x) + 1, dtype=np.int64) * _POINT_WKB_SIZE
+    return pa.Array.from_buffers(
+        pa.large_binary(), len(x), [None, pa.py_buffer(offsets), pa.py_buffer(records.tobytes())]
+    )
+
+def _buffers(arr:pa.Array)->tuple[np.ndarray, np.ndarray]:
+    """
+    the data bytes and the offsets (len + 1) of a binary / large_binary array
+    """
+    offsets = np.frombuffer(arr.buffers()[1], dtype=np.int64 if pa.types.is_large_binary(arr.type) else np.int32)
+    data = arr.buffers()[2]
+    data = np.frombuffer(data, dtype=np.uint8) if data is not None else np.empty(0, dtype=np.uint8)
+    return data, offsets[arr.offset:arr.offset + len(arr) + 1].astype(np.int64)
+
+def wkb_kinds(arr:pa.Array)->np.ndarray:
+    """
+    POINT for the little endian 2D points, LINE for (multi)linestrings, POLYGON for everything else (nulls,
+    polygons, collections, 3D points), read from the header of every wkb without parsing it
+    """
+    data, offsets = _buffers(arr)
+    starts, sizes = offsets[:-1], np.diff(offsets)
+    kinds = np.full(len(arr), POLYGON, dtype=np.int8)
+    header = sizes >= 5
+    if not header.any():
+        return kinds
+
+    at = starts[header]
+    little = data[at] == 1
+    # type是uint32，byte order決定從哪一端讀
+    le = data[at + 1].astype(np.uint32) | data[at + 2].astype(np.uint32) << 8 \
+        | data[at + 3].astype(np.uint32) << 16 | data[at + 4].astype(np.uint32) << 24
+    be = data[at + 4].astype(np.uint32) | data[at + 3].astype(np.uint32) << 8 \
+        | data[at + 2].astype(np.uint32) << 16 | data[at + 1].astype(np.uint32) << 24
+    geometry_type = np.where(little, le, be)
+
+    header_kinds = np.full(len(at), POLYGON, dtype=np.int8)
+    header_kinds[np.isin(geometry_type, (2, 5))] = LINE
+    header_kinds[little & (geometry_type == 1) & (sizes[header] == _POINT_WKB_SIZE)] = POINT
+    kinds[header] = header_kinds
+    return kinds
+
+def wkb_points_to_cells(arr:pa.Array, rows:np.ndarray, resolution:int)->np.ndarray:
+    """
+    the cell of every point (`wkb_kinds` == POINT) in `rows`, the coordinates are read from the wkb bytes
+    """
+    data, offsets = _buffers(arr)
+    starts = offsets[rows]
+    if len(rows) and (np.diff(starts) == _POINT_WKB_SIZE).all():
+        # 連續的point可以直接reshape，不用一個一個byte gather
+        records = data[starts[0]:starts[0] + len(rows) * _POINT_WKB_SIZE].reshape(-1, _POINT_WKB_SIZE)
+    else:
+        records = data[starts[:, None] + np.arange(_POINT_WKB_SIZE)]
+    coords = np.ascontiguousarray(records[:, 5:]).view('<f8')
+    return np.asarray(coordinates_to_cells(coords[:, 1].copy(), coords[:, 0].copy(), resolution), dtype=np.uint64)
+
+def _one_cell_lists(name:str, cells:np.ndarray)->pl.Series:
+    offsets = pa.array(np.arange(len(cells) + 1, dtype=np.int64))
+    return pl.Series(name, pa.LargeListArray.from_arrays(offsets, pa.array(cells, type=pa.uint64())))
+
+def dispatch_wkb_to_cells(s:pl.Series,
+                          resolution:int,
+                          containment_mode:Cont,
+                          compact:bool,
+                          polyfill:Callable[[pl.Series], pl.Series],
+                          tracer:Optional[Tracer]=None,
+    )->pl.Series:
+    """
+    the cells of every wkb in `s` (a list per row), by geometry type:
+    points: the cell of the coordinates, vectorized over the whole batch
+    lines: h3ronpy's line cover (the cells along the line), in this process
+    polygons and everything else: `polyfill` (parallel workers / cache)
+    tracer: Tracer, record the points and the lines as the `polyfill_points` / `polyfill_lines` stages
+    """
+    tracer = tracer or Tracer()
+    arr = s.rechunk().to_arrow()
+    kinds = wkb_kinds(arr)
+    if (kinds == POLYGON).all():
+        return polyfill(s)
+
+    parts, order = [], []
+    rows = np.flatnonzero(kinds == POINT)
+    if len(rows):
+        with tracer.span('polyfill_points', rows=len(rows)):
+            parts.append(_one_cell_lists(s.name, wkb_points_to_cells(arr, rows, resolution)))
+        order.append(rows)
+    rows = np.flatnonzero(kinds == LINE)
+    if len(rows):
+        with tracer.span('polyfill_lines', rows=len(rows)):
+            lines = wkb_to_cells(arr.take(pa.array(rows)), resolution, containment_mode, compact, False)
+        parts.append(pl.Series(s.name, lines))
+        order.append(rows)
+    rows = np.flatnonzero(kinds == POLYGON)
+    if len(rows):
+        parts.append(polyfill(s.gather(rows)))
+        order.append(rows)
+
+    if len(parts) == 1:
+        return parts[0].alias(s.name)
+    # 照原本的順序排回去
+    cells = pl.concat([part.cast(pl.List(pl.UInt64)) for part in parts])
+    return cells.gather(np.argsort(np.concatenate(order), kind='stable')).alias(s.name)
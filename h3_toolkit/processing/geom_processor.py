@@ -1,9 +1,42 @@
+import json
+import logging
+from pathlib import Path
+from typing import Optional
+
+import pandas as pd
 import polars as pl
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 import geopandas as gpd
+import shapely
 from shapely import to_wkb
 from h3ronpy import ContainmentMode as Cont
 import h3ronpy.polars
 
+from h3_toolkit.processing.parallel import DEFAULT_PARTITION_BYTES
+from h3_toolkit.processing.geom_dispatch import points_to_wkb
+from h3_toolkit.cache import PolyfillCache
+from h3_toolkit.tracing import Tracer
+
+# 在compact模式下，每個cell代表幾個resolution的子cell (7^(resolution - cell resolution))
+CELL_WEIGHT = 'cell_weight'
+
+def geometry_to_wkb(values, name:str)->pl.Series:
+    """
+    the wkb of the shapely geometries, a layer of 2D points is written with numpy from the coordinates
+    (the same bytes as shapely) instead of encoding every point one by one
+    """
+    if (
+        len(values)
+        and (shapely.get_type_id(values) == 0).all()
+        and not shapely.is_empty(values).any()
+        and not shapely.has_z(values).any()
+    ):
+        xy = shapely.get_coordinates(values)
+        return pl.Series(name, points_to_wkb(xy[:, 0], xy[:, 1]))
+    return pl.Series(name, to_wkb(values), dtype=pl.Binary)
+
 def geom_to_wkb(df:gpd.GeoDataFrame, geometry:str)->pl.DataFrame:
     """
     convert GeoDataFrame to polars.DataFrame
@@ -16,32 +49,128 @@ def geom_to_wkb(df:gpd.GeoDataFrame, geometry:str)->pl.DataFrame:
         raise ValueError(f"Column '{geometry}' not found in the input GeoDataFrame")
 
     # 確保input跟output的geometry的column name不會改變，同時從geometry type 轉換成 wkb
-    df = (
-        df
-        .rename(columns={geometry: 'ready_to_convert'})
-        .assign(geometry_wkb = lambda df: to_wkb(df['ready_to_convert']))
-        .drop('ready_to_convert', axis=1)  # drop geometry column to convert geodataframe to dataframe  
-        .rename(columns={'geometry_wkb': geometry})
+    # 只有wkb會複製一次，其他column直接從pandas轉成polars
+    return (
+        pl.from_pandas(pd.DataFrame(df.drop(columns=geometry)))
+        .with_columns(
+            geometry_to_wkb(df[geometry].values, geometry)
+        )
+        .select(df.columns.tolist())
     )
-    
 
+def _is_wgs84(crs)->bool:
+    """
+    crs: the crs of GeoParquet / GeoArrow metadata, PROJJSON (dict or json string) or a "authority:code" string
+    """
+    if crs is None:
+        # GeoParquet沒寫crs的話預設是OGC:CRS84
+        return True
+    if isinstance(crs, str):
+        try:
+            crs = json.loads(crs)
+        except json.JSONDecodeError:
+            return crs.upper().replace('::', ':') in _WGS84
+    if isinstance(crs, dict):
+        crs_id = crs.get('id') or {}
+        return f"{crs_id.get('authority', '')}:{crs_id.get('code', '')}".upper() in _WGS84
+    return False
 
-    return (
-        # pandas to polars
-        pl.from_pandas(df)
-    )
+_WGS84 = {'EPSG:4326', 'OGC:CRS84', 'OGC:84'}
+
+def read_geoparquet(path:str | Path, geometry:str=None)->pl.LazyFrame:
+    """
+    scan a GeoParquet file lazily, the CRS is checked from the file metadata without loading any geometry
+    path: str | Path, the GeoParquet file
+    geometry: str, the geometry column, default is the primary column of the metadata
+    """
+    metadata = pq.read_schema(path).metadata or {}
+    if b'geo' not in metadata:
+        raise ValueError(f"'{path}' is not a GeoParquet file, the 'geo' metadata is missing")
+
+    geo = json.loads(metadata[b'geo'])
+    geometry = geometry or geo.get('primary_column')
+    column = geo.get('columns', {}).get(geometry)
+    if column is None:
+        raise ValueError(f"Column '{geometry}' not found in the GeoParquet metadata")
+    if column.get('encoding', 'WKB').upper() != 'WKB':
+        raise ValueError(f"Only WKB encoded GeoParquet is supported, got '{column.get('encoding')}'")
+    if not _is_wgs84(column.get('crs')):
+        raise ValueError("The input GeoParquet CRS must be in EPSG:4326")
+
+    # geopandas會把geoarrow.wkb extension的metadata寫進arrow schema，polars讀不了，
+    # 透過pyarrow dataset把field metadata拿掉之後就是binary，一樣是lazy並且可以pushdown
+    dataset = ds.dataset(path, format='parquet')
+    schema = pa.schema([field.remove_metadata() for field in dataset.schema])
+    return pl.scan_pyarrow_dataset(ds.dataset(path, format='parquet', schema=schema))
+
+def arrow_to_wkb(table:pa.Table | pa.RecordBatch, geometry:str)->pl.DataFrame:
+    """
+    convert a pyarrow Table with a WKB (or geoarrow.wkb) geometry column to polars.DataFrame without copying
+    """
+    if geometry not in table.schema.names:
+        raise ValueError(f"Column '{geometry}' not found in the input Table")
+
+    field = table.schema.field(geometry)
+    metadata = field.metadata or {}
+    column = table.column(geometry)
+    if isinstance(field.type, pa.ExtensionType):
+        # 有註冊geoarrow extension type的話，拿storage(binary)出來
+        name, extension_metadata = field.type.extension_name, field.type.__arrow_ext_serialize__()
+        column = pa.chunked_array([chunk.storage for chunk in column.chunks], type=field.type.storage_type) \
+            if isinstance(column, pa.ChunkedArray) else column.storage
+    else:
+        name, extension_metadata = metadata.get(b'ARROW:extension:name', b'geoarrow.wkb'), metadata.get(b'ARROW:extension:metadata')
+        name = name.decode() if isinstance(name, bytes) else name
+
+    if name not in ('geoarrow.wkb', 'ogc.wkb'):
+        raise ValueError(f"Only WKB encoded geometry is supported, got '{name}'")
+    if extension_metadata and not _is_wgs84(json.loads(extension_metadata).get('crs')):
+        raise ValueError("The input Table CRS must be in EPSG:4326")
+    if not pa.types.is_binary(column.type) and not pa.types.is_large_binary(column.type):
+        raise ValueError(f"Column '{geometry}' must be WKB binary, got {column.type}")
+
+    if isinstance(table, pa.RecordBatch):
+        table = pa.Table.from_batches([table])
+    return pl.from_arrow(table.set_column(table.schema.get_field_index(geometry), pa.field(geometry, column.type), column))
+
+def to_wkb_frame(data, geometry:str)->pl.DataFrame | pl.LazyFrame:
+    """
+    accept GeoDataFrame, GeoParquet path, pyarrow Table / RecordBatch, polars DataFrame / LazyFrame (geometry already in wkb)
+    and return a polars frame with the geometry in wkb
+    """
+    if isinstance(data, (pl.DataFrame, pl.LazyFrame)):
+        return data
+    if isinstance(data, gpd.GeoDataFrame):
+        logging.info("Converting GeoDataFrame to polars.DataFrame")
+        return geom_to_wkb(data, geometry)
+    if isinstance(data, (pa.Table, pa.RecordBatch)):
+        return arrow_to_wkb(data, geometry)
+    if isinstance(data, (str, Path)):
+        return read_geoparquet(data, geometry)
+    raise TypeError(f"Unsupported input type {type(data)}")
     
 def wkb_to_cells(df:pl.DataFrame, 
                  source_r:int, 
                  geom_col:str=None, 
                  selected_cols:list=[],
-                 mode:Cont=Cont.ContainsCentroid
+                 mode:Cont=Cont.ContainsCentroid,
+                 compact:bool=False,
+                 workers:int=1,
+                 partition_bytes:int=DEFAULT_PARTITION_BYTES,
+                 cache:Optional[PolyfillCache]=None,
+                 tracer:Optional[Tracer]=None,
                  )->pl.DataFrame:
     """
     convert geometry to h3 cells
     df: polars.DataFrame, the input dataframe
     source_r: int, the resolution of the source geometry
     selected_cols: list, the columns to be selected
+    compact: bool, keep the cells compacted (mixed resolutions), a `cell_weight` column with the number
+        of `source_r` cells represented by each cell is added
+    workers: int, the number of processes used to polyfill, see `parallel_wkb_to_cells`
+    partition_bytes: int, the wkb bytes of each partition sent to a worker
+    cache: PolyfillCache, reuse the cells of the geometries polyfilled before
+    tracer: Tracer, record the time of the polyfill
     """
     # 不需要對geometry進行處裡
     if geom_col is None:
@@ -58,12 +187,40 @@ def wkb_to_cells(df:pl.DataFrame,
             .custom.custom_wkb_to_cells(
                 resolution=source_r,
                 containment_mode=mode,
-                compact=False,
-                flatten=False
+                compact=compact,
+                flatten=False,
+                workers=workers,
+                partition_bytes=partition_bytes,
+                cache=cache,
+                tracer=tracer,
             ).alias('cell'),
             pl.col(selected_cols) if selected_cols else pl.exclude(geom_col)
         )
         .explode('cell')
+        .pipe(lambda df: df.with_columns(cells_weight(source_r)) if compact else df)
+    )
+
+def cells_weight(resolution:int)->pl.Expr:
+    """
+    the number of `resolution` cells inside every cell of the (compacted) cell column
+    """
+    return (
+        pl.lit(7.0)
+        .pow(pl.lit(resolution, pl.Int32) - pl.col('cell').h3.cells_resolution().cast(pl.Int32))
+        .alias(CELL_WEIGHT)
+    )
+
+def uncompact_cells(df:pl.DataFrame, resolution:int)->pl.DataFrame:
+    """
+    uncompact the cell column to `resolution`, every child cell gets the values of its compacted parent
+    """
+    return (
+        df
+        .with_columns(
+            pl.col('cell').custom.custom_change_resolution_list(resolution)
+        )
+        .explode('cell')
+        .select(pl.exclude(CELL_WEIGHT))
     )
 
 def cell_to_geom(df:pl.DataFrame)->gpd.GeoDataFrame:
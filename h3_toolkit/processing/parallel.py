@@ -0,0 +1,121 @@
+import atexit
+import logging
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import polars as pl
+import pyarrow as pa
+import pyarrow.compute as pc
+from h3ronpy import ContainmentMode as Cont
+from h3ronpy.arrow.vector import wkb_to_cells
+
+# 每個partition大概要有多少bytes的wkb，太小的話process之間傳資料的成本會比polyfill還高
+DEFAULT_PARTITION_BYTES = 8 * 1024 * 1024
+
+_executors: dict[int, ProcessPoolExecutor] = {}
+
+def _get_executor(workers:int)->ProcessPoolExecutor:
+    """
+    reuse the process pool between calls, starting a spawn process costs more than a small polyfill
+    """
+    if workers not in _executors:
+        # 用spawn，fork polars的threadpool可能會deadlock
+        _executors[workers] = ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context('spawn'))
+    return _executors[workers]
+
+@atexit.register
+def _shutdown_executors():
+    for executor in _executors.values():
+        executor.shutdown(wait=False, cancel_futures=True)
+    _executors.clear()
+
+def _to_ipc(arr:pa.Array)->pa.Buffer:
+    sink = pa.BufferOutputStream()
+    batch = pa.record_batch([arr], names=['values'])
+    with pa.ipc.new_stream(sink, batch.schema) as writer:
+        writer.write_batch(batch)
+    return sink.getvalue()
+
+def _from_ipc(buf)->pa.Array:
+    return pa.ipc.open_stream(buf).read_all().column('values').combine_chunks()
+
+def _polyfill_partition(shm_name:str,
+                        size:int,
+                        resolution:int,
+                        containment_mode:str,
+                        compact:bool,
+                        )->bytes:
+    """
+    worker: read the wkb partition from the shared memory without copying, polyfill and send back the cells as arrow ipc
+    containment_mode: str, the name of the ContainmentMode (the enum itself can not be pickled)
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        wkb = _from_ipc(pa.py_buffer(shm.buf[:size]))
+        cells = wkb_to_cells(wkb, resolution, getattr(Cont, containment_mode), compact, False)
+        del wkb  # the arrow buffers point into the shared memory, release them before closing it
+        return _to_ipc(cells).to_pybytes()
+    finally:
+        shm.close()
+
+def partition_bounds(arr:pa.Array, partition_bytes:int)->np.ndarray:
+    """
+    split the wkb array into partitions of about `partition_bytes` bytes, the size of a wkb is a better
+    estimate of the polyfill cost than the number of rows
+    return the row offsets, including 0 and len(arr)
+    """
+    sizes = pc.fill_null(pc.binary_length(arr), 0).to_numpy(zero_copy_only=False)
+    cumulative = np.cumsum(sizes)
+    cuts = np.searchsorted(cumulative, np.arange(partition_bytes, cumulative[-1] if len(cumulative) else 0, partition_bytes), side='right')
+    return np.unique(np.concatenate([[0], cuts, [len(arr)]]))
+
+def containment_mode_name(containment_mode:Cont)->str:
+    """
+    the name of the ContainmentMode, the enum itself can not be pickled or hashed
+    """
+    return str(containment_mode).rsplit('.', 1)[-1]
+
+def parallel_wkb_to_cells(s:pl.Series,
+                          resolution:int,
+                          containment_mode:Cont=Cont.ContainsCentroid,
+                          compact:bool=False,
+                          workers:int=1,
+                          partition_bytes:int=DEFAULT_PARTITION_BYTES,
+                          )->pl.Series:
+    """
+    polyfill the wkb series in a process pool, the cell lists are returned in the same order as the input
+    s: polars.Series, the wkb series
+    workers: int, the number of processes, 1 means polyfill in the current process
+    partition_bytes: int, the wkb bytes of each partition sent to a worker
+    """
+    arr = s.to_arrow()
+    if isinstance(arr, pa.ChunkedArray):
+        arr = arr.combine_chunks()
+
+    bounds = partition_bounds(arr, partition_bytes)
+    if workers <= 1 or len(bounds) <= 2:
+        return pl.Series(s.name, wkb_to_cells(arr, resolution, containment_mode, compact, False))
+
+    logging.info(f"Polyfill {len(arr)} geometries in {len(bounds) - 1} partitions with {workers} workers")
+    executor = _get_executor(workers)
+    mode_name = containment_mode_name(containment_mode)
+    blocks, futures = [], []
+    try:
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            buf = _to_ipc(arr.slice(start, end - start))
+            shm = shared_memory.SharedMemory(create=True, size=max(buf.size, 1))
+            blocks.append(shm)
+            shm.buf[:buf.size] = memoryview(buf).cast('B')
+            futures.append(
+                executor.submit(_polyfill_partition, shm.name, buf.size, resolution, mode_name, compact)
+            )
+        # future的順序跟partition的順序一樣，所以結果的順序不會亂掉
+        cells = pa.concat_arrays([_from_ipc(pa.py_buffer(future.result())) for future in futures])
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+    return pl.Series(s.name, cells)
@@ -0,0 +1,125 @@
+from pathlib import Path
+from typing import Iterator, Sequence
+
+import numpy as np
+import polars as pl
+from h3ronpy.arrow.raster import raster_to_dataframe, nearest_h3_resolution, Transform
+from h3ronpy.arrow.vector import cells_to_coordinates, coordinates_to_cells
+
+# 可以直接傳進aggregator的raster: 2D array (np.memmap也可以) 或是.npy檔 (用memory map打開)
+RasterInput = np.ndarray | str | Path
+
+# 每個row來自哪一個pixel (整張raster的row * width + col)
+PIXEL = '__pixel'
+
+def read_raster(raster:RasterInput)->np.ndarray:
+    """
+    the 2D array of the raster, a .npy file is memory-mapped, so only the tiles being processed are read
+    """
+    if isinstance(raster, (str, Path)):
+        raster = np.load(raster, mmap_mode='r')
+    if raster.ndim != 2:
+        raise ValueError(f"The raster must be a 2D array (rows, cols), got {raster.ndim} dimensions")
+    return raster
+
+def affine_coefficients(transform)->tuple[float, float, float, float, float, float]:
+    """
+    the (a, b, c, d, e, f) of the affine transform, x = a * col + b * row + c, y = d * col + e * row + f
+    transform: an `affine.Affine` (rasterio), or a 6-tuple in the GDAL order (c, a, b, f, d, e) like h3ronpy
+    """
+    if all(hasattr(transform, name) for name in 'abcdef'):
+        return tuple(float(getattr(transform, name)) for name in 'abcdef')
+    if isinstance(transform, Sequence) and len(transform) == 6:
+        c, a, b, f, d, e = transform
+        return float(a), float(b), float(c), float(d), float(e), float(f)
+    raise ValueError(f"Unsupported transform {transform!r}, use an affine.Affine or a GDAL geotransform")
+
+def window_coefficients(coefficients:tuple, row_off:int, col_off:int)->tuple:
+    """
+    the transform of the window starting at (row_off, col_off)
+    """
+    a, b, c, d, e, f = coefficients
+    return a, b, a * col_off + b * row_off + c, d, e, d * col_off + e * row_off + f
+
+def iter_windows(shape:tuple[int, int], tile_size:int)->Iterator[tuple[int, int, int, int]]:
+    """
+    (row_off, col_off, height, width) of the tiles covering the raster, row by row
+    """
+    rows, cols = shape
+    for row_off in range(0, rows, tile_size):
+        for col_off in range(0, cols, tile_size):
+            yield row_off, col_off, min(tile_size, rows - row_off), min(tile_size, cols - col_off)
+
+def samples_cells(shape:tuple[int, int], transform, resolution:int)->bool:
+    """
+    True when the cells at `resolution` are smaller than the pixels, every pixel is then covered by the cells
+    whose center is in it (h3ronpy's raster conversion), otherwise every pixel goes to the cell of its center
+    h3ronpy's conversion at the resolution closest to the pixel size misses some pixels, so it is only used
+    for finer resolutions
+    """
+    a, b, c, d, e, f = affine_coefficients(transform)
+    return resolution > nearest_h3_resolution(shape, Transform.from_rasterio([a, b, c, d, e, f]))
+
+def _valid(values:np.ndarray, nodata)->np.ndarray:
+    valid = np.ones(values.shape, dtype=bool)
+    if values.dtype.kind == 'f':
+        valid &= ~np.isnan(values)
+    if nodata is not None and not np.isnan(nodata):
+        valid &= values != nodata
+    return valid
+
+def tile_to_cells(tile:np.ndarray,
+                  transform:tuple,
+                  resolution:int,
+                  value_col:str,
+                  nodata=None,
+                  pixel_offset:tuple[int, int, int]=(0, 0, 0),
+                  sample:bool=False,
+    )->pl.DataFrame:
+    """
+    (cell, __pixel, value_col) of the valid pixels of one tile
+    transform: the (a, b, c, d, e, f) of the tile (`window_coefficients`)
+    pixel_offset: (row_off, col_off, width) of the tile in the raster, to number the pixels of the raster
+    sample: bool, sample the finer cells at their center (see `samples_cells`), a pixel is then on many rows
+    """
+    row_off, col_off, width = pixel_offset
+    a, b, c, d, e, f = transform
+    if sample:
+        cells = pl.from_arrow(raster_to_dataframe(
+            np.ascontiguousarray(tile), Transform.from_rasterio([a, b, c, d, e, f]), resolution,
+            nodata_value=None if nodata is None or np.isnan(nodata) else tile.dtype.type(nodata), compact=False,
+        ))
+        # 從cell的中心點反推它在哪一個pixel
+        coords = cells_to_coordinates(cells['cell'].to_arrow())
+        x, y = coords.column('lng').to_numpy() - c, coords.column('lat').to_numpy() - f
+        det = a * e - b * d
+        cols = np.clip(np.floor((e * x - b * y) / det), 0, tile.shape[1] - 1).astype(np.int64)
+        rows = np.clip(np.floor((a * y - d * x) / det), 0, tile.shape[0] - 1).astype(np.int64)
+        return (
+            cells
+            .select(
+                pl.col('cell'),
+                pl.Series(PIXEL, (rows + row_off) * width + cols + col_off, dtype=pl.UInt64),
+                pl.col('value').alias(value_col),
+            )
+            .filter(pl.Series(_valid(cells['value'].to_numpy(), nodata)))
+        )
+
+    rows, cols = np.nonzero(_valid(tile, nodata))
+    x = a * (cols + 0.5) + b * (rows + 0.5) + c
+    y = d * (cols + 0.5) + e * (rows + 0.5) + f
+    return pl.DataFrame({
+        'cell': pl.Series(coordinates_to_cells(y, x, resolution)).cast(pl.UInt64),
+        PIXEL: pl.Series((rows + row_off) * width + cols + col_off, dtype=pl.UInt64),
+        value_col: tile[rows, cols],
+    })
+
+def raster_categories(raster:np.ndarray, nodata=None, tile_size:int=1024)->list:
+    """
+    the distinct valid values of the raster, read tile by tile
+    """
+    values = set()
+    for row_off, col_off, height, width in iter_windows(raster.shape, tile_size):
+        tile = np.asarray(raster[row_off:row_off + height, col_off:col_off + width])
+        values.update(np.unique(tile[_valid(tile, nodata)]).tolist())
+    return sorted(values)
@@ -0,0 +1,226 @@
+import logging
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Iterator, Literal, Optional
+
+import numpy as np
+import polars as pl
+import pyarrow as pa
+import pyarrow.parquet as pq
+from h3ronpy.arrow import cells_to_string
+
+from h3_toolkit.tracing import Tracer
+
+# 'ipc'是沒有壓縮的Arrow IPC檔，下游可以直接memory map
+SinkFormat = Literal['parquet', 'ipc']
+
+# partition的column，檔案裡沒有這個column，只在hive目錄的名字 parent=<hex_id>
+PARENT = 'parent'
+
+_SUFFIX = {'parquet': '.parquet', 'ipc': '.arrow'}
+
+def _check_format(format:SinkFormat)->None:
+    if format not in _SUFFIX:
+        raise ValueError(f"Unknown format '{format}', use 'parquet' or 'ipc'")
+
+def parent_col(resolution:int)->pl.Expr:
+    """
+    the uint64 parent at `resolution` of the uint64 `cell`, as the `parent` column
+    """
+    return pl.col('cell').custom.custom_change_resolution(resolution).alias(PARENT)
+
+def _write(df:pl.DataFrame, file:Path, format:SinkFormat)->None:
+    file.parent.mkdir(parents=True, exist_ok=True)
+    if format == 'parquet':
+        df.write_parquet(file)
+    else:
+        df.write_ipc(file, compression='uncompressed')
+
+def sink_lazy(lf:pl.LazyFrame,
+              path:str | Path,
+              format:SinkFormat='parquet',
+              tracer:Optional[Tracer]=None,
+              stage:str='sink',
+    )->None:
+    """
+    write the query to one file with the streaming engine, the result is never collected as a whole
+    a query which can't run in the streaming engine (a python function over the whole column, window
+    functions) is collected as `stage` and written, with the same output
+    """
+    _check_format(format)
+    tracer = tracer or Tracer()
+    start = time.perf_counter()
+    try:
+        if format == 'parquet':
+            lf.sink_parquet(path)
+        else:
+            lf.sink_ipc(path, compression=None)
+    except pl.exceptions.InvalidOperationError:
+        logging.info(f"The query of {stage} can't be sunk with the streaming engine, collecting it first")
+    else:
+        tracer.record(stage, time.perf_counter() - start)
+        return
+    _write(tracer.collect(lf, stage, streaming=True), Path(path), format)
+
+def _iter_parent_batches(lf:pl.LazyFrame,
+                         tmp_dir:str | Path,
+                         tracer:Tracer,
+                         stage:str,
+                         batch_rows:int,
+    )->Iterator[pl.DataFrame]:
+    """
+    the rows of the query with the `parent` column, about `batch_rows` rows of whole parents at a time
+    the query is sunk sorted by parent to a temporary ipc file, which is memory-mapped, every batch is a
+    contiguous slice of it, only the parents and one batch are read into memory
+    """
+    tmp = Path(tmp_dir) / "partitions.arrow"
+    sink_lazy(lf.sort(PARENT, maintain_order=True), tmp, 'ipc', tracer, f'{stage}_split')
+    df = pl.read_ipc(tmp, memory_map=True, rechunk=False)
+    if df.is_empty():
+        return
+    parents = df[PARENT].to_numpy()
+    starts = np.flatnonzero(np.r_[True, parents[1:] != parents[:-1]])
+    counts = np.diff(np.r_[starts, len(parents)])
+    # 每batch_rows個row換一批，同一個parent一定在同一批
+    parent_batches = (np.cumsum(counts) - counts) // batch_rows
+    bounds = np.r_[starts[np.r_[True, parent_batches[1:] != parent_batches[:-1]]], len(parents)]
+    for offset, end in zip(bounds[:-1], bounds[1:]):
+        yield df.slice(int(offset), int(end - offset))
+
+def _write_partitions(df:pl.DataFrame, path:Path, format:SinkFormat)->list[Path]:
+    """
+    write the rows of every parent to `{path}/parent=<hex_id>/part-0`, without the `parent` column
+    """
+    files = []
+    for (parent,), rows in df.partition_by(PARENT, as_dict=True, include_key=False).items():
+        name = cells_to_string(pa.array([parent], type=pa.uint64()))[0].as_py()
+        file = path / f"{PARENT}={name}" / f"part-0{_SUFFIX[format]}"
+        _write(rows, file, format)
+        files.append(file)
+    return files
+
+@contextmanager
+def _replace_dir(path:Path)->Iterator[Path]:
+    """
+    the partitions are written to a new directory next to `path`, which replaces `path` when every partition
+    is written, so no `parent=<hex_id>` of an earlier run is left and a failed run keeps the old output
+    """
+    if path.is_file():
+        raise ValueError(f"{path} is a file, partitioned output is written to a directory")
+    if path.is_dir() and any(not (entry.is_dir() and entry.name.startswith(f'{PARENT}=')) for entry in path.iterdir()):
+        # 只取代之前寫的partition，其他的檔案不刪
+        raise ValueError(f"{path} has files other than the {PARENT}=<hex_id> partitions, use an empty directory")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    staging = Path(tempfile.mkdtemp(prefix=f'.{path.name}-', dir=path.parent))
+    try:
+        yield staging
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    if path.exists():
+        shutil.rmtree(path)
+    staging.rename(path)
+
+def sink_partitioned(lf:pl.LazyFrame,
+                     path:str | Path,
+                     format:SinkFormat='parquet',
+                     tracer:Optional[Tracer]=None,
+                     stage:str='sink',
+                     batch_rows:int=250_000,
+    )->list[Path]:
+    """
+    write the query with the `parent` column to the hive directory `{path}/parent=<hex_id>/part-0`,
+    the parent is only in the directory names, return the written files
+    the partitions of an earlier run in `path` are replaced
+    """
+    _check_format(format)
+    tracer = tracer or Tracer()
+    path = Path(path)
+    files = []
+    with _replace_dir(path) as staging, tempfile.TemporaryDirectory(dir=path.parent) as tmp_dir:
+        for batch in _iter_parent_batches(lf, tmp_dir, tracer, stage, batch_rows):
+            with tracer.span(f'{stage}_partition', rows=batch.height):
+                files.extend(_write_partitions(batch, staging, format))
+    return sorted(path / file.relative_to(staging) for file in files)
+
+def sink_to(lf:pl.LazyFrame,
+            path:str | Path,
+            format:SinkFormat='parquet',
+            partition_by_parent:Optional[int]=None,
+            finalize:Optional[Callable[[pl.LazyFrame], pl.LazyFrame]]=None,
+            tracer:Optional[Tracer]=None,
+            stage:str='sink',
+    )->list[Path]:
+    """
+    write the query (with the uint64 `cell`) to the file `path`, or partitioned by the parent of the cell at
+    `partition_by_parent` to the directory `path` (`sink_partitioned`), return the written files
+    finalize: the conversion of the output columns (hex_id), applied after the parent is computed
+    """
+    if partition_by_parent is not None:
+        lf = lf.with_columns(parent_col(partition_by_parent))
+    if finalize is not None:
+        lf = finalize(lf)
+    if partition_by_parent is None:
+        sink_lazy(lf, path, format, tracer, stage)
+        return [Path(path)]
+    return sink_partitioned(lf, path, format, tracer, stage)
+
+def sink_by_parent(source:pl.LazyFrame,
+                   path:str | Path,
+                   format:SinkFormat,
+                   resolution:int,
+                   query:Callable[[pl.LazyFrame], pl.LazyFrame],
+                   finalize:Optional[Callable[[pl.LazyFrame], pl.LazyFrame]]=None,
+                   tracer:Optional[Tracer]=None,
+                   stage:str='sink',
+                   batch_rows:int=250_000,
+    )->list[Path]:
+    """
+    split `source` (with the uint64 `cell`) by the parent at `resolution`, run `query` on about `batch_rows`
+    rows of whole parents at a time and write every parent to `{path}/parent=<hex_id>/part-0`, so the query
+    never holds more than one batch, the partitions of an earlier run in `path` are replaced
+    only exact when `query` never combines the cells of different parents (a rollup to `resolution` or finer)
+    """
+    _check_format(format)
+    tracer = tracer or Tracer()
+    finalize = finalize or (lambda df: df)
+    path = Path(path)
+    files = []
+    with _replace_dir(path) as staging, tempfile.TemporaryDirectory(dir=path.parent) as tmp_dir:
+        source = source.with_columns(parent_col(resolution))
+        for batch in _iter_parent_batches(source, tmp_dir, tracer, stage, batch_rows):
+            result = tracer.collect(
+                query(batch.drop(PARENT).lazy()).with_columns(parent_col(resolution)).pipe(finalize), stage
+            )
+            files.extend(_write_partitions(result, staging, format))
+    return sorted(path / file.relative_to(staging) for file in files)
+
+def sink_files(path:str | Path)->list[Path]:
+    """
+    the parquet / ipc files of `path`: the file itself, or every file in the (partitioned) directory
+    """
+    path = Path(path)
+    if path.is_file():
+        return [path]
+    files = sorted(file for file in path.rglob('*') if file.suffix in _SUFFIX.values() and file.is_file())
+    if not files:
+        raise FileNotFoundError(f"No parquet / ipc files in {path}")
+    return files
+
+def iter_file_batches(path:str | Path, batch_rows:int=500_000)->Iterator[pl.DataFrame]:
+    """
+    read the files of `path` (`sink_files`) `batch_rows` at a time, ipc files are memory-mapped and parquet
+    files are read by row group, so only one batch is in memory
+    """
+    for file in sink_files(path):
+        if file.suffix == _SUFFIX['ipc']:
+            # memory map的frame, slice不會複製資料
+            df = pl.read_ipc(file, memory_map=True, rechunk=False)
+            for offset in range(0, df.height, batch_rows):
+                yield df.slice(offset, batch_rows)
+        else:
+            for batch in pq.ParquetFile(file, memory_map=True).iter_batches(batch_rows):
+                yield pl.from_arrow(batch)
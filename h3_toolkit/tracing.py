@@ -0,0 +1,191 @@
+"""
+instrumentation hooks of `H3Aggregator`, `H3AggregatorUp` and `HBaseClient`
+
+    tracer = RecordingTracer(capture_plans=True)
+    aggregator.set_tracer(tracer)
+    client.set_tracer(tracer)
+    ...
+    print(tracer.report())
+
+a stage is recorded every time it runs, with its wall time, rows, the peak memory of the process so far,
+the bytes sent to / received from HBase and the retries. Stages inside one polars query (polyfill,
+cells_to_string) run in the query, their time is part of the time of the query
+"""
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator, NamedTuple, Optional
+
+import polars as pl
+
+class Span(NamedTuple):
+    stage: str
+    seconds: float
+    rows: Optional[int] = None
+    peak_mb: float = 0.0
+    bytes_sent: int = 0
+    bytes_received: int = 0
+    retries: int = 0
+
+def peak_memory_mb()->float:
+    # linux的ru_maxrss單位是KB, macOS是bytes
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+class Tracer:
+    """
+    the no-op tracer, subclass it and override `on_span` / `on_plan`, or use `RecordingTracer`
+    capture_plans: bool, pass the optimized plan of every collected query to `on_plan`
+    profile_queries: bool, run the queries with `LazyFrame.profile()` (in-memory engine) and record the time
+        of every node of the plan as `{stage}/{node}`
+    """
+    capture_plans:bool = False
+    profile_queries:bool = False
+
+    def on_span(self, span:Span)->None:
+        pass
+
+    def on_plan(self, stage:str, plan:str)->None:
+        pass
+
+    def record(self,
+               stage:str,
+               seconds:float,
+               rows:Optional[int]=None,
+               bytes_sent:int=0,
+               bytes_received:int=0,
+               retries:int=0,
+        )->None:
+        self.on_span(Span(stage, seconds, rows, peak_memory_mb(), bytes_sent, bytes_received, retries))
+
+    @contextmanager
+    def span(self, stage:str, **metrics)->Iterator[dict]:
+        """
+        time the block as `stage`, the block can set the other fields (rows, bytes_sent, ...) in the yielded dict
+        """
+        start = time.perf_counter()
+        try:
+            yield metrics
+        finally:
+            self.record(stage, time.perf_counter() - start, **metrics)
+
+    def wrap(self, stage:str, fn:Callable[[pl.Series], pl.Series])->Callable[[pl.Series], pl.Series]:
+        """
+        time every call of a `map_batches` function, rows are the rows of the input batch
+        """
+        def timed(s:pl.Series)->pl.Series:
+            start = time.perf_counter()
+            result = fn(s)
+            self.record(stage, time.perf_counter() - start, rows=len(s))
+            return result
+        return timed
+
+    def collect(self, lf:pl.LazyFrame, stage:str, streaming:bool=False)->pl.DataFrame:
+        """
+        collect the query as `stage`, with its plan and node timings when asked for
+        """
+        if self.capture_plans:
+            self.on_plan(stage, lf.explain(streaming=streaming))
+        start = time.perf_counter()
+        if self.profile_queries:
+            result, profile = lf.profile()
+            for node, node_start, node_end in profile.iter_rows():
+                # profile的時間單位是microseconds
+                self.record(f"{stage}/{node}", (node_end - node_start) / 1e6)
+        else:
+            result = lf.collect(streaming=streaming)
+        self.record(stage, time.perf_counter() - start, rows=result.height)
+        return result
+
+class CallbackTracer(Tracer):
+    """
+    call `callback(span)` for every recorded stage
+    """
+    def __init__(self, callback:Callable[[Span], None]):
+        self.callback = callback
+
+    def on_span(self, span:Span)->None:
+        self.callback(span)
+
+class RecordingTracer(Tracer):
+    """
+    keep every span and plan in memory, `summary()` / `report()` aggregate them per stage
+    """
+    def __init__(self, capture_plans:bool=False, profile_queries:bool=False):
+        self.capture_plans = capture_plans
+        self.profile_queries = profile_queries
+        self.spans:list[Span] = []
+        self.plans:dict[str, list[str]] = {}
+        # polyfill可能在polars的thread裡被呼叫
+        self._lock = threading.Lock()
+
+    def on_span(self, span:Span)->None:
+        with self._lock:
+            self.spans.append(span)
+
+    def on_plan(self, stage:str, plan:str)->None:
+        with self._lock:
+            self.plans.setdefault(stage, []).append(plan)
+
+    def clear(self)->None:
+        with self._lock:
+            self.spans.clear()
+            self.plans.clear()
+
+    def summary(self)->pl.DataFrame:
+        """
+        one row per stage, the slowest first
+        """
+        spans = pl.DataFrame(
+            self.spans,
+            schema={
+                'stage': pl.String, 'seconds': pl.Float64, 'rows': pl.Int64, 'peak_mb': pl.Float64,
+                'bytes_sent': pl.Int64, 'bytes_received': pl.Int64, 'retries': pl.Int64,
+            },
+            orient='row',
+        )
+        return (
+            spans
+            .group_by('stage', maintain_order=True)
+            .agg(
+                pl.len().alias('calls'),
+                pl.col('seconds').sum(),
+                pl.col('rows').sum(),
+                pl.col('peak_mb').max(),
+                pl.col('bytes_sent', 'bytes_received', 'retries').sum(),
+            )
+            .with_columns(
+                pl.when(pl.col('seconds') > 0).then(pl.col('rows') / pl.col('seconds')).alias('rows_per_second')
+            )
+            .sort('seconds', descending=True, maintain_order=True)
+        )
+
+    def report(self)->str:
+        """
+        the summary as a text table
+        """
+        lines = [
+            f"{'stage':<40} {'calls':>6} {'seconds':>9} {'rows':>11} {'rows/s':>12} "
+            f"{'peak MB':>8} {'sent MB':>8} {'recv MB':>8} {'retries':>7}"
+        ]
+        for row in self.summary().iter_rows(named=True):
+            lines.append(
+                f"{row['stage']:<40} {row['calls']:>6} {row['seconds']:>9.3f} {row['rows'] or 0:>11} "
+                f"{row['rows_per_second'] or 0:>12.0f} {row['peak_mb']:>8.0f} "
+                f"{row['bytes_sent'] / 1024 ** 2:>8.2f} {row['bytes_received'] / 1024 ** 2:>8.2f} {row['retries']:>7}"
+            )
+        return '\n'.join(lines)
+
+def as_tracer(tracer:Optional[Tracer | Callable[[Span], None]])->Tracer:
+    """
+    None -> the no-op tracer, a function -> `CallbackTracer`
+    """
+    if tracer is None:
+        return Tracer()
+    if isinstance(tracer, Tracer):
+        return tracer
+    if callable(tracer):
+        return CallbackTracer(tracer)
+    raise TypeError(f"Unsupported tracer {type(tracer)}")
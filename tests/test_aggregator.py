@@ -1,16 +1,119 @@
-from h3_toolkit.aggregation.strategy import _sum, _avg, _count, _major, _percentage
+import polars as pl
+import pytest
+import h3ronpy.polars
+
+from h3_toolkit.aggregation.strategy import (
+    AggregationStrategy,
+    SumAggregation,
+    SumAggregationUp,
+    AvgAggregation,
+    AvgAggregationUp,
+    CountAggregation,
+    MajorAggregation,
+    PercentageAggregation,
+    KRingAggregation,
+)
+
+def _cells() -> pl.LazyFrame:
+    # 三個geometry (district a 兩個, b 一個) polyfill之後的cell
+    return pl.LazyFrame({
+        'cell': pl.Series([1, 2, 3, 4, 5, 5], dtype=pl.UInt64),
+        'district': ['a', 'a', 'a', 'b', 'b', 'b'],
+        'pop': [30.0, 30.0, 6.0, 9.0, 9.0, 9.0],
+        'land_use': ['x', 'x', 'y', 'y', 'y', None],
+    })
 
 def test__sum():
-    pass
+    result = SumAggregation().apply(_cells(), ['pop'], 'district').collect()
+    # 每個district的第一個值平均分到district內的每個cell
+    assert result['pop'].to_list() == [10.0, 10.0, 10.0, 3.0, 3.0, 3.0]
+    assert result['pop'].sum() == pytest.approx(39.0)
+
+    with pytest.raises(ValueError):
+        SumAggregation().apply(_cells(), ['pop'], None)
+
+def test__sum_up():
+    result = (
+        SumAggregationUp()
+        .apply(_cells(), ['pop', 'not_fetched'], None)
+        .sort('cell')
+        .collect()
+    )
+    assert result.columns == ['cell', 'pop']
+    assert result['pop'].to_list() == [30.0, 30.0, 6.0, 9.0, 18.0]
+
+def test__merge_missing_state():
+    # merge只接受partial的結果，少了state column不能默默跳過
+    with pytest.raises(ValueError):
+        SumAggregationUp().merge(_cells(), ['pop'], None)
+
+def test__strategy_needs_apply_or_partial():
+    with pytest.raises(TypeError):
+        class Empty(AggregationStrategy):
+            pass
 
 def test__avg():
-    pass
+    result = AvgAggregation().apply(_cells(), ['pop'], None).collect()
+    assert result.equals(_cells().collect())
+
+def test__avg_up():
+    result = AvgAggregationUp().apply(_cells(), ['pop'], None).sort('cell').collect()
+    assert result['pop'].to_list() == [30.0, 30.0, 6.0, 9.0, 9.0]
 
 def test__count():
-    pass  
+    result = CountAggregation().apply(_cells(), ['land_use'], None).sort('cell').collect()
+    assert result.filter(pl.col('cell') == 5).select('y', 'null', 'total_count').row(0) == (1, 1, 2)
+    assert result['total_count'].sum() == 6
+
+def test__count_categories():
+    # category domain先給定，output schema固定，不在domain裡的只算進total_count
+    result = CountAggregation(['y', 'z']).apply(_cells(), ['land_use'], None).sort('cell').collect()
+    assert result.columns == ['cell', 'y', 'z', 'total_count']
+    assert result['z'].sum() == 0
+    assert result['total_count'].sum() == 6
 
-def test__major(): 
-    pass
+    prepared = CountAggregation().prepare(_cells(), ['land_use'], None)
+    assert prepared.categories == ['null', 'x', 'y']
+
+    result = CountAggregation([('y', 'b')]).apply(_cells(), ['land_use', 'district'], None).collect()
+    assert result['{"y","b"}'].sum() == 2
+
+def test__major():
+    df = pl.LazyFrame({
+        'cell': pl.Series([1, 1, 1, 2, 2, 3], dtype=pl.UInt64),
+        'land_use': ['y', 'x', None, 'y', 'x', None],
+    })
+    result = MajorAggregation().apply(df, ['land_use'], None).sort('cell').collect()
+    # 平手取category順序的第一個，全部都是null就是null
+    assert result['land_use'].to_list() == ['x', 'x', None]
+
+    result = MajorAggregation(['y', 'x']).apply(df, ['land_use'], None).sort('cell').collect()
+    assert result['land_use'].to_list() == ['y', 'y', None]
 
 def test__percentage():
-    pass
\ No newline at end of file
+    result = PercentageAggregation().apply(_cells(), ['land_use'], None).sort('cell').collect()
+    assert result.columns == ['cell', 'land_use_null', 'land_use_x', 'land_use_y']
+    assert result.filter(pl.col('cell') == 5).select('land_use_null', 'land_use_y').row(0) == (0.5, 0.5)
+    assert result.select(pl.sum_horizontal(pl.exclude('cell'))).to_series().to_list() == [1.0] * 5
+
+def test_kring_matches_the_disks():
+    center = pl.Series(['8c4ba0a415749ff']).h3.cells_parse()
+    ring1 = center.h3.grid_disk(1).explode()
+    cells = pl.LazyFrame({
+        'cell': pl.concat([center, center, ring1.filter(ring1 != center[0]).head(2)]),
+        'pop': [1.0, 3.0, 4.0, None],
+    })
+    # 中心cell的兩個row先合併，再加上距離1的鄰居(權重0.5)
+    result = dict(KRingAggregation(1, 'sum', [1.0, 0.5], batch_rows=7).apply(cells, ['pop']).collect().iter_rows())
+    assert result[center[0]] == pytest.approx(4.0 + 0.5 * 4.0)
+
+    result = dict(KRingAggregation(1, 'mean', lambda d: 1.0 / (d + 1)).apply(cells, ['pop']).collect().iter_rows())
+    assert result[center[0]] == pytest.approx((2.0 + 0.5 * 4.0) / 1.5)
+    # 沒有值的cell也會被鄰居平滑
+    assert len(result) == 3 and result[ring1.filter(ring1 != center[0])[1]] is not None
+
+    result = dict(KRingAggregation(1, 'max').apply(cells, ['pop']).collect().iter_rows())
+    assert result[center[0]] == 4.0
+
+    with pytest.raises(ValueError, match='k \\+ 1'):
+        KRingAggregation(2, 'sum', [1.0, 0.5])
@@ -0,0 +1,137 @@
+import json
+
+import geopandas as gpd
+import polars as pl
+from shapely.geometry import box
+
+from h3_toolkit.cache import ByteLRU, RowkeyCache, PolyfillCache
+from h3_toolkit.core import H3Aggregator
+from h3_toolkit.hbase.client import HBaseClient
+
+def _long(rows: list[str], qualifiers: list[str]) -> pl.DataFrame:
+    return pl.DataFrame(
+        [(row, cq, f'{row}-{cq}') for row in rows for cq in qualifiers],
+        schema=['row', 'qualifier', 'value'],
+        orient='row',
+    )
+
+def test_byte_lru_evicts_oldest():
+    lru = ByteLRU(max_bytes=10)
+    lru.put('a', 1, 4)
+    lru.put('b', 2, 4)
+    lru.get('a')
+    lru.put('c', 3, 4)
+    assert 'b' not in lru and 'a' in lru and 'c' in lru
+    assert lru.nbytes == 8
+
+def test_rowkey_cache_memory_and_disk(tmp_path):
+    cache = RowkeyCache(cache_dir=tmp_path)
+    cache.put('t', 'cf', ['a', 'b'], ['r1', 'r2', 'r3'], _long(['r1', 'r2'], ['a', 'b']))
+
+    found, missing = cache.lookup('t', 'cf', ['a', 'b'], ['r1', 'r2', 'r3', 'r4'])
+    assert missing == ['r4']
+    assert found.filter(pl.col('value').is_not_null()).height == 4
+    assert cache.stats()['memory_hits'] == 3
+
+    # a new cache on the same directory reads the memory-mapped segments
+    cache = RowkeyCache(cache_dir=tmp_path)
+    found, missing = cache.lookup('t', 'cf', ['a'], ['r1', 'r4'])
+    assert missing == ['r4'] and cache.disk_hits == 1
+
+    cache.invalidate('t')
+    _, missing = cache.lookup('t', 'cf', ['a'], ['r1'])
+    assert missing == ['r1']
+
+def test_rowkey_cache_compacts_the_disk_segments(tmp_path):
+    cache = RowkeyCache(cache_dir=tmp_path, max_segments=2)
+    for value in ('old', 'mid', 'new'):
+        cache.put('t', 'cf', ['a'], ['r1', 'r2'], _long(['r1', 'r2'], ['a']).with_columns(pl.lit(value).alias('value')))
+    # 第三個segment超過max_segments，合併成一個，只留最新的值
+    segments = list((tmp_path / 't' / 'cf').glob('*.arrow'))
+    assert len(segments) == 1 and pl.read_ipc(segments[0]).height == 2
+
+    found, missing = RowkeyCache(cache_dir=tmp_path).lookup('t', 'cf', ['a'], ['r1', 'r2'])
+    assert missing == [] and found['value'].to_list() == ['new', 'new']
+
+    expired = RowkeyCache(cache_dir=tmp_path, ttl=-1)
+    expired.compact()
+    assert list((tmp_path / 't' / 'cf').glob('*.arrow')) == []
+
+def test_rowkey_cache_lookup_only_touches_the_hit_segments():
+    sizing = RowkeyCache()
+    sizing.put('t', 'cf', ['a'], ['r1'], _long(['r1'], ['a']))
+    # memory tier放得下兩個segment
+    cache = RowkeyCache(max_memory_bytes=int(sizing.memory.nbytes * 2.5))
+    cache.put('t', 'cf', ['a'], ['r1'], _long(['r1'], ['a']))
+    cache.put('t', 'cf', ['a'], ['r2'], _long(['r2'], ['a']))
+    cache.lookup('t', 'cf', ['a'], ['r1'])
+    # r2的segment沒有被用到，先被淘汰
+    cache.put('t', 'cf', ['a'], ['r3'], _long(['r3'], ['a']))
+    _, missing = cache.lookup('t', 'cf', ['a'], ['r1', 'r2', 'r3'])
+    assert missing == ['r2']
+
+def test_rowkey_cache_ttl():
+    cache = RowkeyCache(ttl=-1)
+    cache.put('t', 'cf', ['a'], ['r1'], _long(['r1'], ['a']))
+    _, missing = cache.lookup('t', 'cf', ['a'], ['r1'])
+    assert missing == ['r1']
+
+def test_fetch_data_only_fetches_misses(monkeypatch):
+    requested = []
+
+    async def fake_fetch(session, form_data, url=None):
+        rowkeys = json.loads(form_data['rowkey'])
+        requested.append(sorted(rowkeys))
+        cells = [
+            {'row': row, 'properties': {'qualifier': cq, 'value': f'{row}-{cq}'}}
+            for row in rowkeys for cq in json.loads(form_data['column_qualifiers'])['cf']
+        ]
+        return json.dumps({'data': cells}).encode()
+
+    client = HBaseClient().set_cache(RowkeyCache())
+    monkeypatch.setattr(client, '_fetch_data', fake_fetch)
+    try:
+        first = client.fetch_data('t', 'cf', ['a'], ['r1', 'r2'])
+        second = client.fetch_data('t', 'cf', ['a'], ['r1', 'r2', 'r3'])
+    finally:
+        client.set_cache(None)
+
+    assert requested == [['r1', 'r2'], ['r3']]
+    assert first.height == 2 and second.height == 3
+
+def test_polyfill_cache(tmp_path):
+    boxes = gpd.GeoDataFrame(
+        {'value': [1.0, 2.0, 3.0]},
+        geometry=[box(121.5, 25.0, 121.51, 25.01), box(121.52, 25.0, 121.53, 25.01), box(121.5, 25.0, 121.51, 25.01)],
+        crs='epsg:4326',
+    )
+    expected = H3Aggregator().set_geometry('geometry').set_resolution(10).avg(['value']).process(boxes)
+
+    cache = PolyfillCache(cache_dir=tmp_path)
+    agg = H3Aggregator().set_geometry('geometry').set_resolution(10).avg(['value']).set_polyfill_cache(cache)
+    assert agg.process(boxes).equals(expected)
+    # 一樣的geometry只polyfill一次
+    assert cache.stats()['misses'] == 2
+    assert agg.process(boxes).equals(expected)
+    assert cache.stats()['memory_hits'] == 2
+
+    # 另一個process (新的cache) 從disk讀
+    other = PolyfillCache(cache_dir=tmp_path)
+    assert agg.set_polyfill_cache(other).process(boxes).equals(expected)
+    assert other.stats()['disk_hits'] == 2 and other.stats()['misses'] == 0
+
+    # 每次polyfill都寫一個segment，超過max_segments就合併
+    compacting = PolyfillCache(cache_dir=tmp_path / 'compact', max_segments=1)
+    agg.set_polyfill_cache(compacting).process(boxes.iloc[:1])
+    agg.set_polyfill_cache(PolyfillCache(cache_dir=tmp_path / 'compact', max_segments=1)).process(boxes.iloc[1:])
+    [segment] = (tmp_path / 'compact').glob('*/*.arrow')
+    assert pl.read_ipc(segment).height == 2
+    assert agg.set_polyfill_cache(PolyfillCache(cache_dir=tmp_path / 'compact')).process(boxes).equals(expected)
+
+def test_polyfill_cache_memory_counts_empty_results():
+    # 沒有cell的geometry也有固定成本，memory tier才有上限
+    cache = PolyfillCache(max_memory_bytes=10_000)
+    digests = [PolyfillCache.digest(bytes([i])) for i in range(100)]
+    cache.put(digests, pl.Series([[]] * 100, dtype=pl.List(pl.UInt64)), 10, 'ContainsCentroid', False)
+    assert 0 < len(cache.memory) < 30
+    assert cache.memory.nbytes <= 10_000
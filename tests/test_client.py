@@ -0,0 +1,221 @@
+import asyncio
+
+import polars as pl
+import pytest
+import h3ronpy.polars
+
+from h3_toolkit.core import H3AggregatorDown
+from h3_toolkit.hbase.client import HBaseClient
+from h3_toolkit.hbase.local_server import LocalHBaseServer
+from h3_toolkit.hbase.planner import plan_scan
+from h3_toolkit.hbase.scheduler import AdaptiveScheduler, TransferError, TransferReport
+from h3_toolkit.processing.delta import Changeset
+
+@pytest.fixture
+def client():
+    with LocalHBaseServer() as server:
+        client = HBaseClient()
+        # HBaseClient是singleton，測試完要把url改回來
+        urls, chunk_size = (client.fetch_url, client.send_url, client.delete_url), client.chunk_size
+        client.fetch_url, client.send_url, client.chunk_size = server.fetch_url, server.send_url, 3
+        client.delete_url = server.delete_url
+        client.server = server
+        try:
+            yield client
+        finally:
+            client.close()
+            client.fetch_url, client.send_url, client.delete_url = urls
+            client.chunk_size = chunk_size
+            del client.server
+
+def _data() -> pl.DataFrame:
+    return pl.DataFrame({
+        'hex_id': [f'8c4ba0a41574{i}ff' for i in range(8)],
+        'p_cnt': [float(i) for i in range(8)],
+        'h_cnt': [None if i % 3 == 0 else i for i in range(8)],
+    })
+
+def test_send_and_fetch_round_trip(client):
+    assert client.send_data(_data(), 'table', 'demographic', ['p_cnt', 'h_cnt']) == ['Success'] * 3
+
+    result = client.fetch_data('table', 'demographic', ['p_cnt', 'h_cnt'], _data()['hex_id'].to_list() + ['missing'])
+    expected = _data().select(
+        'hex_id', pl.col('p_cnt').cast(pl.String), pl.col('h_cnt').cast(pl.String)
+    )
+    assert result.select(expected.columns).sort('hex_id').equals(expected, null_equal=True)
+    assert client.server.requests['filterdata2'] == 3
+
+def test_fetch_data_iter_yields_every_chunk(client):
+    client.send_data(_data(), 'table', 'demographic', ['p_cnt'])
+    chunks = list(client.fetch_data_iter('table', 'demographic', ['p_cnt'], _data()['hex_id'].to_list()))
+    assert sorted(chunk.height for chunk in chunks) == [2, 3, 3]
+
+def test_sync_api_inside_running_loop(client):
+    client.send_data(_data(), 'table', 'demographic', ['p_cnt'])
+
+    async def main():
+        blocking = client.fetch_data('table', 'demographic', ['p_cnt'], ['8c4ba0a415741ff'])
+        async with client:
+            awaited = await client.afetch_data('table', 'demographic', ['p_cnt'], _data()['hex_id'].to_list())
+        return blocking, awaited
+
+    blocking, awaited = asyncio.run(main())
+    assert blocking.height == 1 and awaited.height == 8
+
+def test_send_changeset(client):
+    client.send_data(_data(), 'table', 'demographic', ['p_cnt', 'h_cnt'])
+    rowkeys = _data()['hex_id'].to_list()
+    changeset = Changeset(
+        upserts=_data().head(2).with_columns(pl.col('p_cnt') + 100),
+        deletes=rowkeys[5:],
+        manifest=pl.DataFrame(),
+        stats={},
+    )
+    outcomes = client.send_changeset(changeset, 'table', 'demographic', ['p_cnt', 'h_cnt'])
+    assert outcomes == {'upserts': ['Success'], 'deletes': ['Success']}
+
+    result = client.fetch_data('table', 'demographic', ['p_cnt'], rowkeys).sort('hex_id')
+    assert result['hex_id'].to_list() == rowkeys[:5]
+    assert result['p_cnt'].to_list() == ['100.0', '101.0', '2.0', '3.0', '4.0']
+
+def test_uint64_cells_are_stringified_only_in_the_client(client):
+    cells = pl.Series('cell', ['8c4ba0a415749ff']).h3.cells_parse().h3.grid_disk(2).explode().head(8).rename('cell')
+    data = _data().drop('hex_id').with_columns(cells)
+    assert client.send_data(data, 'table', 'demographic', ['p_cnt'], rowkey_col='cell') == ['Success'] * 3
+    # HBase裡的rowkey還是hex string
+    assert client.fetch_data('table', 'demographic', ['p_cnt'], cells.h3.cells_to_string().to_list()).height == 8
+
+    result = client.fetch_data('table', 'demographic', ['p_cnt'], data['cell'])
+    assert result.schema['cell'] == pl.UInt64
+    assert result.sort('cell')['cell'].equals(data['cell'].sort())
+    assert client.fetch_data('table', 'demographic', ['p_cnt'], data['cell'].clear()).columns == ['cell']
+
+    assert client.delete_data('table', 'demographic', data['cell'].head(2)) == ['Success']
+    assert client.fetch_data('table', 'demographic', ['p_cnt'], data['cell']).height == 6
+
+def test_fetch_ranges(client):
+    client.scan_url, client.ranges_per_request = client.server.scan_url, 2
+    try:
+        parent = pl.Series(['8a4ba0a41577fff']).h3.cells_parse()
+        children = parent.h3.change_resolution_list(12).explode().sort().rename('cell')
+        other = pl.Series(['8c4ba0a41cda7ff']).h3.cells_parse().rename('cell')
+        data = pl.DataFrame({'cell': pl.concat([children, other]), 'p_cnt': list(range(50))})
+        client.send_data(data, 'table', 'demographic', ['p_cnt'], rowkey_col='cell')
+
+        # 49個cell compact成一個res 10的cell + 一個res 12的cell，兩段range
+        ranges = plan_scan(data['cell'], 12)
+        assert ranges.height == 2
+        result = client.fetch_ranges('table', 'demographic', ['p_cnt'], ranges, as_cells=True)
+        assert result.sort('cell')['cell'].equals(data['cell'].sort())
+        assert client.server.requests['scandata'] == 1
+
+        ranges = plan_scan(children.head(10), 12)
+        result = client.fetch_ranges('table', 'demographic', ['p_cnt'], ranges)
+        assert sorted(result['hex_id']) == sorted(children.head(10).h3.cells_to_string())
+
+        # 合併range之後會多拿到不在cover裡的cell
+        merged = plan_scan(pl.concat([children.head(10), other]), 12, max_ranges=1)
+        assert merged.height == 1
+        assert client.fetch_ranges('table', 'demographic', ['p_cnt'], merged).height > 11
+    finally:
+        client.scan_url, client.ranges_per_request = None, 100
+
+def test_retries_with_backoff_and_failure_report(client):
+    client.backoff_base = 0.01
+    try:
+        # 暫時失敗的chunk重試之後成功
+        client.server.fail_next = 1
+        assert client.send_data(_data(), 'table', 'demographic', ['p_cnt']) == ['Success'] * 3
+        assert client.last_report.summary()['retries'] == 1
+
+        # 一直失敗的chunk不會被默默丟掉
+        client.server.fail_next = 100
+        with pytest.raises(TransferError) as error:
+            client.fetch_data('table', 'demographic', ['p_cnt'], _data()['hex_id'].to_list())
+        assert sorted(error.value.report.failed_keys) == sorted(_data()['hex_id'])
+        assert error.value.report.to_frame()['attempts'].to_list() == [3, 3, 3]
+
+        outcomes = client.send_data(_data(), 'table', 'demographic', ['p_cnt'])
+        assert outcomes == ['Failed'] * 3
+        assert sorted(outcome.start for outcome in client.last_report.failed) == [0, 3, 6]
+    finally:
+        client.server.fail_next = 0
+        client.backoff_base = 0.5
+
+def test_adaptive_scheduler():
+    scheduler = AdaptiveScheduler(chunk_size=1000, concurrency=2, target_seconds=1.0, max_payload_bytes=10_000)
+    scheduler.observe(1000, 0.1, 1000, ok=True)
+    # 很快就回來: chunk變兩倍, 多一個in-flight
+    assert (scheduler.chunk_size, scheduler.concurrency) == (2000, 3)
+    scheduler.observe(2000, 0.2, 40_000, ok=True)
+    # payload超過上限
+    assert scheduler.chunk_size == 1000
+    scheduler.observe(1000, 1.0, 1000, ok=True)
+    # 每個row的時間變成10倍，gateway在排隊
+    assert scheduler.concurrency == 3
+    scheduler.observe(1000, 1.0, 1000, ok=False)
+    assert (scheduler.chunk_size, scheduler.concurrency) == (1000, 1)
+
+def test_hedged_request(client):
+    scheduler = AdaptiveScheduler(hedge_quantile=0.5)
+    for _ in range(10):
+        scheduler.observe(100, 0.01, 0, ok=True)
+    calls = []
+
+    async def request():
+        calls.append(len(calls))
+        if len(calls) == 1:
+            await asyncio.sleep(10)
+        return b'{}'
+
+    client.set_scheduler(scheduler)
+    try:
+        report = TransferReport('fetch')
+        result = asyncio.run(client._run_chunk(report, 0, 100, 0, request, hedge=True))
+    finally:
+        client.set_scheduler(None)
+    assert result == b'{}' and len(calls) == 2
+    assert report.outcomes[0].hedged
+
+def test_disaggregate_with_hbase_weights(client):
+    client.scan_url = client.server.scan_url
+    try:
+        parents = pl.DataFrame({'cell': pl.Series(['8a4ba0a41577fff', '8a4ba0a41cdffff']).h3.cells_parse(), 'pop': [49.0, 7.0]})
+        children = parents['cell'].head(1).h3.change_resolution_list(11).explode().rename('cell')
+        weights = pl.DataFrame({'cell': children.head(2), 'buildings': [1, 6]})
+        client.send_data(weights, 'table', 'building', ['buildings'], rowkey_col='cell')
+
+        aggregator = (
+            H3AggregatorDown()
+            .set_client(client)
+            .set_resolution_source(10)
+            .set_resolution_target(11)
+            .set_batch_size(7)
+            .set_cell_format('uint64')
+            .sum(['pop'])
+            .set_hbase_weights('table', 'building', 'buildings')
+        )
+        result = aggregator.process(parents)
+        assert client.server.requests['scandata'] == 2
+        values = dict(zip(result['cell'].to_list(), result['pop'].to_list()))
+        assert values[children[0]] == pytest.approx(7.0)
+        assert values[children[1]] == pytest.approx(42.0)
+        assert result['pop'].sum() == pytest.approx(56.0)
+
+        # 兩個batch各7個child，每個chunk 3個row
+        assert aggregator.send_hbase_data(parents, 'table', 'demographic') == ['Success'] * 6
+    finally:
+        client.scan_url = None
+
+def test_send_files(client, tmp_path):
+    (tmp_path / 'parent=a').mkdir()
+    (tmp_path / 'parent=b').mkdir()
+    _data().head(5).write_ipc(tmp_path / 'parent=a' / 'part-0.arrow')
+    _data().tail(3).write_parquet(tmp_path / 'parent=b' / 'part-0.parquet')
+
+    # 每個檔案讀2個row就送一次，每次分成chunk_size=3的chunk
+    statuses = client.send_files(tmp_path, 'table', 'demographic', ['p_cnt', 'h_cnt'], batch_rows=2)
+    assert statuses == ['Success'] * 5
+
+    result = client.fetch_data('table', 'demographic', ['p_cnt'], _data()['hex_id'].to_list())
+    assert result.sort('hex_id')['p_cnt'].to_list() == [str(float(i)) for i in range(8)]
@@ -0,0 +1,42 @@
+import json
+
+import polars as pl
+
+from h3_toolkit.hbase.codec import decode_response, to_wide, encode_put_payload
+
+def test_decode_response_to_wide():
+    body = json.dumps({
+        'data': [
+            {'row': 'r1', 'properties': {'family': 'cf', 'qualifier': 'a', 'value': '1', 'timestamp': 1}},
+            {'row': 'r1', 'properties': {'family': 'cf', 'qualifier': 'b', 'value': '2', 'timestamp': 1}},
+            {'row': 'r2', 'properties': {'family': 'cf', 'qualifier': 'a', 'value': '3', 'timestamp': 1}},
+        ],
+        'empty': [],
+    }).encode()
+
+    wide = to_wide(decode_response(body)).sort('hex_id')
+    assert wide.columns == ['hex_id', 'a', 'b']
+    assert wide.rows() == [('r1', '1', '2'), ('r2', '3', None)]
+
+def test_decode_empty_response():
+    assert decode_response(b'{}').is_empty()
+    assert to_wide(decode_response(b'{"data": []}')).schema == {'hex_id': pl.String}
+
+def test_encode_put_payload_matches_row_by_row():
+    df = pl.DataFrame({
+        'hex_id': ['8c4ba0a415749ff', 'quote"back\\slash'],
+        'p_cnt': [1.5, None],
+        'h_cnt': [1, 2],
+        'flag': [True, None],
+        'note': ['line\nbreak', None],
+    })
+    cq_list = ['p_cnt', 'h_cnt', 'flag', 'note']
+    expected = {
+        'cells': [
+            {'rowkey': row['hex_id'], 'datas': {'cf': {cq: str(row[cq]) for cq in cq_list if row[cq] is not None}}}
+            for row in df.iter_rows(named=True)
+        ],
+        'tablename': 'table',
+        'timestamp': '',
+    }
+    assert json.loads(encode_put_payload(df, 'table', 'cf', cq_list, 'hex_id')) == expected
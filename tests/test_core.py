@@ -0,0 +1,349 @@
+import geopandas as gpd
+import polars as pl
+import pytest
+import shapely
+import h3ronpy.polars
+from shapely.geometry import box
+
+from h3_toolkit.core import H3Aggregator, H3AggregatorUp, H3AggregatorDown
+
+def _boxes() -> gpd.GeoDataFrame:
+    return gpd.GeoDataFrame(
+        {
+            'district': ['a', 'b', 'a', 'c', 'b', 'c'],
+            'pop': [100.0, 50.0, 3.0, 4.0, 5.0, 6.0],
+            'land_use': ['x', 'y', 'x', 'z', 'y', 'x'],
+        },
+        geometry=[box(121.5 + 0.01 * i, 25.0, 121.51 + 0.01 * i, 25.01) for i in range(6)],
+        crs='epsg:4326',
+    )
+
+def test_process_chunked_sum_matches_process():
+    agg = H3Aggregator().set_geometry('geometry').set_resolution(9).sum(['pop'], 'district')
+    expected = agg.process(_boxes()).sort('hex_id')
+
+    parts = list(agg.process_chunked(_boxes(), batch_size=2))
+    assert len(parts) == 3
+    assert pl.concat(parts).select(expected.columns).sort('hex_id').equals(expected)
+
+    parts = list(agg.process_chunked(_boxes(), memory_budget=10_000_000))
+    assert pl.concat(parts).select(expected.columns).sort('hex_id').equals(expected)
+
+def test_process_chunked_count_sink(tmp_path):
+    agg = H3Aggregator().set_geometry('geometry').set_resolution(9).count(['land_use'])
+    expected = agg.process(_boxes()).sort('hex_id').fill_null(0)
+
+    sink = tmp_path / 'count.parquet'
+    agg.process_chunked(_boxes(), batch_size=1, sink=sink)
+    result = pl.read_parquet(sink).select(expected.columns).sort('hex_id').fill_null(0)
+    assert result.equals(expected, null_equal=True)
+
+@pytest.mark.parametrize('how', ['major', 'percentage'])
+def test_process_chunked_categories_sink(tmp_path, how):
+    # 相鄰的box在不同batch會有一樣的cell，要merge count再算major / percentage
+    agg = getattr(H3Aggregator().set_geometry('geometry').set_resolution(9), how)(['land_use'])
+    expected = agg.process(_boxes()).sort('hex_id')
+
+    sink = tmp_path / f'{how}.parquet'
+    agg.process_chunked(_boxes(), batch_size=1, sink=sink)
+    result = pl.read_parquet(sink).select(expected.columns).sort('hex_id')
+    assert result.equals(expected, null_equal=True)
+
+def _nan_codes() -> pl.DataFrame:
+    # NaN在aggregate之前會變成0，找category的時候也要一樣
+    return pl.DataFrame({
+        'geometry': shapely.to_wkb(_boxes().geometry.iloc[:3].values),
+        'code': [1.0, float('nan'), 2.0],
+    })
+
+def test_count_categories_fill_nan():
+    result = H3Aggregator().set_geometry('geometry').set_resolution(9).count(['code']).process(_nan_codes())
+    assert result.columns == ['hex_id', '0.0', '1.0', '2.0', 'total_count']
+    assert result.select(pl.sum_horizontal('0.0', '1.0', '2.0') == pl.col('total_count')).to_series().all()
+
+def test_major_and_percentage_categories_fill_nan():
+    agg = H3Aggregator().set_geometry('geometry').set_resolution(9)
+    result = agg.major(['code']).process(_nan_codes())
+    assert result['code'].unique().sort().to_list() == ['0.0', '1.0', '2.0']
+
+    result = agg.percentage(['code']).process(_nan_codes())
+    assert result.columns == ['hex_id', 'code_0.0', 'code_1.0', 'code_2.0']
+    assert (result.select(pl.sum_horizontal(pl.exclude('hex_id'))).to_series() - 1.0).abs().max() < 1e-9
+
+def test_compact_sum_matches_uncompacted():
+    gdf = gpd.GeoDataFrame(
+        {'district': ['a', 'b', 'a'], 'pop': [100.0, 50.0, 7.0]},
+        geometry=[box(121.5, 25.0, 121.55, 25.05), box(121.56, 25.0, 121.6, 25.03), box(121.5, 25.0, 121.53, 25.03)],
+        crs='epsg:4326',
+    )
+    agg = H3Aggregator().set_geometry('geometry').set_resolution(11).sum(['pop'], 'district')
+    expected = agg.process(gdf).sort(pl.all())
+
+    result = agg.set_compact().process(gdf).select(expected.columns).sort(pl.all())
+    assert result.height == expected.height
+    assert (result['pop'] - expected['pop']).abs().max() < 1e-9
+
+    compacted = agg.set_compact(keep_compacted=True).process(gdf)
+    assert compacted.height < expected.height
+
+def test_parallel_polyfill_keeps_order():
+    agg = H3Aggregator().set_geometry('geometry').set_resolution(10).sum(['pop'], 'district')
+    expected = agg.process(_boxes())
+
+    result = agg.set_workers(2, partition_bytes=100).process(_boxes())
+    assert result.equals(expected)
+
+def test_process_pyramid_avg_is_weighted():
+    cells = (
+        H3Aggregator().set_geometry('geometry').set_resolution(10)
+        .process(_boxes().iloc[:2])
+        .select('hex_id', pl.int_range(pl.len()).cast(pl.Float64).alias('pop'))
+    )
+    up = H3AggregatorUp().set_resolution_source(10).avg(['pop'])
+    up.data = cells
+
+    pyramid = up.process_pyramid([8, 7])
+    for resolution in (8, 7):
+        expected = up.set_resolution_target(resolution).process().sort('hex_id')
+        result = pyramid[resolution].select(expected.columns).sort('hex_id')
+        assert result['hex_id'].equals(expected['hex_id'])
+        assert (result['pop'] - expected['pop']).abs().max() < 1e-9
+
+def test_process_pyramid_major_and_percentage():
+    cells = (
+        H3Aggregator().set_geometry('geometry').set_resolution(10)
+        .process(_boxes())
+        .select('hex_id', 'land_use')
+    )
+    for method in ('major', 'percentage'):
+        up = getattr(H3AggregatorUp().set_resolution_source(10), method)(['land_use'])
+        up.data = cells
+        pyramid = up.process_pyramid([9, 7])
+        for resolution in (9, 7):
+            expected = up.set_resolution_target(resolution).process().sort('hex_id')
+            assert pyramid[resolution].select(expected.columns).sort('hex_id').equals(expected)
+
+def test_finalize_states_of_shards_matches_process():
+    cells = (
+        H3Aggregator().set_geometry('geometry').set_resolution(10)
+        .process(_boxes())
+        .select('hex_id', pl.int_range(pl.len()).cast(pl.Float64).alias('pop'))
+    )
+    up = H3AggregatorUp().set_resolution_source(10).set_resolution_target(9).stats(['pop'])
+    up.data = cells
+    expected = up.process().sort('hex_id')
+
+    # 切成三份各自算state，合併之後要跟一次算完一樣
+    states = []
+    for i in range(3):
+        up.data = cells.gather_every(3, offset=i)
+        states.append(up.process_state())
+    result = up.finalize_states(states).select(expected.columns).sort('hex_id')
+    assert result['hex_id'].equals(expected['hex_id'])
+    for col in ('pop_mean', 'pop_std', 'pop_min', 'pop_max'):
+        assert ((result[col] - expected[col]).abs() < 1e-9).all()
+
+    # state也可以直接合併到更粗的resolution
+    up.data = cells
+    coarse = up.set_resolution_target(7).process().sort('hex_id')
+    merged = up.finalize_states(states, resolution=7).select(coarse.columns).sort('hex_id')
+    assert ((merged['pop_mean'] - coarse['pop_mean']).abs() < 1e-9).all()
+
+def test_process_delta_matches_full_process(tmp_path):
+    manifest = tmp_path / 'manifest.parquet'
+    boxes = _boxes().assign(pid=range(6))
+    agg = H3Aggregator().set_geometry('geometry').set_resolution(9).sum(['pop'], 'district')
+    first = agg.process_delta(boxes, manifest, 'pid')
+    previous = agg.process(boxes)
+    assert first.upserts.sort(previous.columns).equals(previous.sort(previous.columns))
+    assert agg.process_delta(boxes, manifest, 'pid').upserts.is_empty()
+
+    changed = boxes.drop(index=[4])
+    changed.loc[1, 'pop'] = 10.0
+    changed.loc[2, 'geometry'] = box(121.52, 25.02, 121.53, 25.03)
+    changeset = agg.process_delta(changed, manifest, 'pid')
+    assert changeset.stats['changed'] == 2 and changeset.stats['deleted'] == 1
+    # group b的cell都要重算，沒變的district c不用
+    assert changeset.upserts['district'].unique().sort().to_list() == ['a', 'b']
+
+    expected = agg.process(changed)
+    touched = changeset.upserts['hex_id'].to_list() + changeset.deletes
+    result = pl.concat([
+        previous.filter(~pl.col('hex_id').is_in(touched)),
+        changeset.upserts.select(previous.columns),
+    ])
+    assert result.sort(expected.columns).equals(expected.sort(expected.columns))
+
+def test_process_wide_matches_process():
+    gdf = _boxes().assign(households=[40.0, 20.0, 1.0, 2.0, 2.0, 3.0], area=[0.25, 0.5, 0.1, 0.2, 0.3, 0.4])
+    cols = ['pop', 'households', 'area']
+    agg = H3Aggregator().set_geometry('geometry').set_resolution(9).sum(cols, 'district')
+    expected = agg.process(gdf)
+
+    parts = list(agg.process_wide(gdf, column_batch=2))
+    assert [part.columns for part in parts] == [['hex_id', 'district', 'pop', 'households'], ['hex_id', 'district', 'area']]
+    result = pl.concat([parts[0], parts[1].select('area')], how='horizontal')
+    assert result.cast({col: pl.Float64 for col in cols}).equals(expected)
+
+    agg.avg(cols)
+    parts = list(agg.process_wide(gdf, column_batch=3))
+    # 整數的值存成UInt32，0.1放不進float32所以area維持Float64
+    assert parts[0].schema['households'] == pl.UInt32
+    assert parts[0].schema['area'] == pl.Float64
+    assert parts[0].cast({col: pl.Float64 for col in cols}).equals(agg.process(gdf))
+
+def test_uint64_cell_format():
+    agg = H3Aggregator().set_geometry('geometry').set_resolution(9).sum(['pop'], 'district')
+    expected = agg.process(_boxes())
+
+    result = agg.set_cell_format('uint64').process(_boxes())
+    assert result.schema['cell'] == pl.UInt64
+    assert result.select(pl.col('cell').h3.cells_to_string().alias('hex_id'), 'district', 'pop').equals(expected)
+
+    up = H3AggregatorUp().set_resolution_source(9).set_resolution_target(7).sum(['pop'])
+    up.data = expected.select('hex_id', 'pop')
+    rolled = up.process().sort('hex_id')
+    up.set_cell_format('uint64').data = result.select('cell', 'pop')
+    assert up.process().sort('cell').select(pl.col('cell').h3.cells_to_string().alias('hex_id'), 'pop').equals(rolled)
+
+def _parents() -> pl.DataFrame:
+    return pl.DataFrame({'hex_id': ['894ba0a4157ffff', '894ba0a41cfffff'], 'pop': [490.0, 70.0], 'rate': [0.5, 0.25]})
+
+def test_disaggregate_sum_and_avg_in_batches(tmp_path):
+    agg = H3AggregatorDown().set_resolution_source(9).set_resolution_target(11).sum(['pop']).set_batch_size(49)
+    result = agg.process(_parents())
+    assert result.height == 2 * 49
+    # 每個parent的值平均分給49個child
+    assert sorted(result['pop'].unique().to_list()) == [pytest.approx(70 / 49), pytest.approx(10.0)]
+    assert result['pop'].sum() == pytest.approx(560.0)
+
+    sink = tmp_path / 'children.parquet'
+    agg.process(_parents(), sink=sink)
+    assert pl.read_parquet(sink).sort('hex_id').equals(result.sort('hex_id'))
+
+    avg = H3AggregatorDown().set_resolution_source(9).set_resolution_target(11).avg(['rate']).set_cell_format('uint64')
+    result = avg.process(_parents())
+    assert result.columns == ['cell', 'rate']
+    assert sorted(result['rate'].unique().to_list()) == [0.25, 0.5]
+
+    with pytest.raises(ValueError, match='resolution_source'):
+        H3AggregatorDown().set_resolution_source(8).sum(['pop']).process(_parents())
+
+def test_disaggregate_empty_parents(tmp_path):
+    agg = H3AggregatorDown().set_resolution_source(9).set_resolution_target(11).sum(['pop'])
+    result = agg.process(_parents().clear())
+    assert result.is_empty() and result.columns == ['hex_id', 'pop']
+
+    sink = tmp_path / 'children.parquet'
+    agg.process(_parents().clear(), sink=sink)
+    assert pl.read_parquet(sink).schema == result.schema
+
+def test_disaggregate_by_weights():
+    children = pl.Series(['894ba0a4157ffff']).h3.cells_parse().h3.change_resolution_list(10).explode()
+    weights = pl.DataFrame({'cell': children.head(2), 'buildings': [3, 1]})
+    result = (
+        H3AggregatorDown()
+        .set_resolution_source(9)
+        .set_resolution_target(10)
+        .sum(['pop'])
+        .set_weights(weights, 'buildings')
+        .set_cell_format('uint64')
+        .process(_parents())
+    )
+    values = dict(zip(result['cell'].to_list(), result['pop'].to_list()))
+    assert values[children[0]] == pytest.approx(367.5)
+    assert values[children[1]] == pytest.approx(122.5)
+    assert values[children[2]] == 0.0
+    # 沒有權重的parent平均分配
+    assert result['pop'].sum() == pytest.approx(560.0)
+    assert result.filter((pl.col('pop') - 10.0).abs() < 1e-9).height == 7
+
+def test_kring_from_both_aggregators():
+    agg = H3Aggregator().set_geometry('geometry').set_resolution(9).kring(['pop'], 1, how='sum', agg_col='district')
+    result = agg.process(_boxes())
+    plain = H3Aggregator().set_geometry('geometry').set_resolution(9).sum(['pop'], 'district').process(_boxes())
+    assert set(result['hex_id']) == set(plain['hex_id'])
+    assert result['pop'].sum() >= plain['pop'].sum()
+
+    up = H3AggregatorUp().set_resolution_source(9).set_resolution_target(8).kring(['pop'], 1, how='mean')
+    up.data = plain
+    smoothed = up.process()
+    rolled = up.avg(['pop']).process()
+    assert set(smoothed['hex_id']) == set(rolled['hex_id'])
+
+def test_kring_skips_geometries_without_cells():
+    # 很小的box在res 8沒有包含任何cell的中心點，polyfill出來的cell是null
+    gdf = gpd.GeoDataFrame(
+        {'v': [1.0, 2.0]},
+        geometry=[box(121.5, 25.0, 121.6, 25.1), box(121.7, 25.2, 121.7001, 25.2001)],
+        crs='epsg:4326',
+    )
+    agg = H3Aggregator().set_geometry('geometry').set_resolution(8)
+    result = agg.kring(['v'], 1).process(gdf)
+    assert set(result['hex_id']) == set(agg.avg(['v']).process(gdf)['hex_id'].drop_nulls())
+    assert result['hex_id'].null_count() == 0
+
+def test_kring_rejects_batches(tmp_path):
+    # batch邊界的cell會少掉其他batch的鄰居
+    agg = H3Aggregator().set_geometry('geometry').set_resolution(9).kring(['pop'], 1, how='sum', agg_col='district')
+    with pytest.raises(ValueError):
+        agg.process_chunked(_boxes(), batch_size=2)
+    with pytest.raises(ValueError):
+        agg.process_to(_boxes(), tmp_path / 'kring.parquet', batch_size=2)
+    with pytest.raises(ValueError):
+        agg.process_delta(_boxes().assign(pid=range(6)), tmp_path / 'manifest.parquet', 'pid')
+
+def test_process_to_partitions_by_parent(tmp_path):
+    agg = H3Aggregator().set_geometry('geometry').set_resolution(10).sum(['pop'], 'district')
+    expected = agg.process(_boxes()).sort('hex_id')
+
+    files = agg.process_to(_boxes(), tmp_path / 'sum', 'ipc', partition_by_parent=7)
+    assert all(file.parent.name.startswith('parent=') for file in files)
+    result = pl.scan_ipc(tmp_path / 'sum' / '**' / '*.arrow', hive_partitioning=True).collect()
+    assert result.drop('parent').select(expected.columns).sort('hex_id').equals(expected)
+    # 每個cell都在自己parent的目錄裡
+    parents = result['hex_id'].h3.cells_parse().h3.change_resolution(7).h3.cells_to_string()
+    assert parents.equals(result['parent'], check_names=False)
+
+    [file] = agg.process_to(_boxes(), tmp_path / 'sum.parquet')
+    assert pl.read_parquet(file).sort('hex_id').equals(expected)
+
+    agg = H3Aggregator().set_geometry('geometry').set_resolution(9).count(['land_use'])
+    expected = agg.process(_boxes()).sort('hex_id').fill_null(0)
+    agg.process_to(_boxes(), tmp_path / 'count', 'parquet', partition_by_parent=6, batch_size=2)
+    result = pl.read_parquet(tmp_path / 'count' / '**' / '*.parquet', hive_partitioning=False)
+    assert result.select(expected.columns).sort('hex_id').fill_null(0).equals(expected)
+
+    with pytest.raises(ValueError):
+        agg.process_to(_boxes(), tmp_path / 'finer', partition_by_parent=10)
+
+@pytest.mark.parametrize('how', ['major', 'percentage'])
+def test_process_to_batched_categories(tmp_path, how):
+    agg = getattr(H3Aggregator().set_geometry('geometry').set_resolution(9), how)(['land_use'])
+    expected = agg.process(_boxes()).sort('hex_id')
+
+    [file] = agg.process_to(_boxes(), tmp_path / f'{how}.parquet', batch_size=1)
+    assert pl.read_parquet(file).select(expected.columns).sort('hex_id').equals(expected, null_equal=True)
+
+    agg.process_to(_boxes(), tmp_path / how, 'ipc', partition_by_parent=6, memory_budget=10_000)
+    result = pl.scan_ipc(tmp_path / how / '**' / '*.arrow', hive_partitioning=False).collect()
+    assert result.select(expected.columns).sort('hex_id').equals(expected, null_equal=True)
+
+def test_rollup_process_to_matches_process(tmp_path):
+    cells = (
+        H3Aggregator().set_geometry('geometry').set_resolution(10)
+        .process(_boxes())
+        .select('hex_id', 'pop', 'land_use')
+    )
+    for method, cols in (('avg', ['pop']), ('major', ['land_use']), ('kring', ['pop'])):
+        up = H3AggregatorUp().set_resolution_source(10).set_resolution_target(8)
+        up = up.kring(cols, 1) if method == 'kring' else getattr(up, method)(cols)
+        up.data = cells
+        expected = up.process().sort('hex_id')
+
+        [file] = up.process_to(tmp_path / f'{method}.arrow', 'ipc')
+        assert pl.read_ipc(file, memory_map=True).sort('hex_id').equals(expected)
+
+        files = up.process_to(tmp_path / method, 'parquet', partition_by_parent=6)
+        result = pl.concat([pl.read_parquet(file) for file in files]).sort('hex_id')
+        assert result.equals(expected)
@@ -0,0 +1,68 @@
+import geopandas as gpd
+import polars as pl
+import pyarrow as pa
+import pytest
+from h3ronpy.polars.vector import wkb_to_cells
+from shapely import to_wkb
+from shapely.geometry import box, LineString, Point
+
+from h3_toolkit.processing.geom_processor import geom_to_wkb, read_geoparquet, arrow_to_wkb, to_wkb_frame
+from h3_toolkit.processing.geom_dispatch import wkb_kinds, POINT, LINE, POLYGON
+from h3_toolkit.tracing import RecordingTracer
+
+def _gdf(crs: str = 'epsg:4326') -> gpd.GeoDataFrame:
+    return gpd.GeoDataFrame(
+        {'district': ['a', 'b'], 'pop': [1.0, 2.0]},
+        geometry=[box(121.5, 25.0, 121.51, 25.01), box(121.52, 25.0, 121.53, 25.01)],
+        crs='epsg:4326',
+    ).to_crs(crs)
+
+def test_geom_to_wkb_keeps_column_order():
+    df = geom_to_wkb(_gdf(), 'geometry')
+    assert df.columns == ['district', 'pop', 'geometry']
+    assert df.schema['geometry'] == pl.Binary
+
+def test_read_geoparquet_matches_geodataframe(tmp_path):
+    path = tmp_path / 'boundary.parquet'
+    _gdf().to_parquet(path)
+
+    lazy = read_geoparquet(path)
+    assert isinstance(lazy, pl.LazyFrame)
+    assert lazy.collect().equals(geom_to_wkb(_gdf(), 'geometry'))
+
+    _gdf('epsg:3826').to_parquet(path)
+    with pytest.raises(ValueError, match='EPSG:4326'):
+        read_geoparquet(path)
+
+def test_arrow_to_wkb_geoarrow_table():
+    table = pa.table(_gdf().to_arrow(geometry_encoding='WKB'))
+    assert arrow_to_wkb(table, 'geometry').equals(geom_to_wkb(_gdf(), 'geometry'))
+    assert to_wkb_frame(table, 'geometry').schema['geometry'] == pl.Binary
+
+    with pytest.raises(ValueError, match='EPSG:4326'):
+        arrow_to_wkb(pa.table(_gdf('epsg:3826').to_arrow(geometry_encoding='WKB')), 'geometry')
+
+def test_point_wkb_is_the_same_as_shapely():
+    points = gpd.GeoDataFrame({'id': [1, 2]}, geometry=[Point(121.5, 25.0), Point(121.6, 25.1)], crs='epsg:4326')
+    assert geom_to_wkb(points, 'geometry')['geometry'].to_list() == list(to_wkb(points.geometry.values))
+
+def test_points_and_lines_bypass_the_polyfill():
+    mixed = gpd.GeoDataFrame(
+        {'id': [1, 2, 3, 4, 5]},
+        geometry=[
+            Point(121.5, 25.0),
+            box(121.5, 25.0, 121.51, 25.01),
+            LineString([(121.5, 25.0), (121.52, 25.01)]),
+            None,
+            Point(121.6, 25.1),
+        ],
+        crs='epsg:4326',
+    )
+    wkb = geom_to_wkb(mixed, 'geometry')['geometry']
+    assert wkb_kinds(wkb.to_arrow()).tolist() == [POINT, POLYGON, LINE, POLYGON, POINT]
+
+    tracer = RecordingTracer()
+    cells = wkb.to_frame().select(pl.col('geometry').custom.custom_wkb_to_cells(10, tracer=tracer)).to_series()
+    # 跟全部用h3ronpy polyfill的結果一樣
+    assert cells.to_list() == wkb_to_cells(wkb, 10).to_list()
+    assert {span.stage: span.rows for span in tracer.spans} == {'polyfill_points': 2, 'polyfill_lines': 1, 'polyfill': 2}
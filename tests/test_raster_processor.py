@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from h3_toolkit.core import H3Aggregator
+from h3_toolkit.processing.raster_processor import affine_coefficients, iter_windows, samples_cells
+
+# 0.001度的pixel (~100m)
+_TRANSFORM = (121.5, 0.001, 0.0, 25.1, 0.0, -0.001)
+
+def _raster() -> np.ndarray:
+    return np.random.default_rng(0).integers(0, 100, (90, 120)).astype(np.float32)
+
+def test_windows_cover_the_raster():
+    windows = list(iter_windows((90, 120), 50))
+    assert len(windows) == 6
+    assert sum(height * width for _, _, height, width in windows) == 90 * 120
+    assert affine_coefficients(_TRANSFORM) == (0.001, 0.0, 121.5, 0.0, -0.001, 25.1)
+
+@pytest.mark.parametrize('resolution', [8, 11])
+def test_raster_sum_keeps_the_total_for_any_tile_size(resolution):
+    raster = _raster()
+    assert samples_cells(raster.shape, _TRANSFORM, resolution) == (resolution == 11)
+
+    agg = H3Aggregator().set_resolution(resolution).sum(['pop'], None)
+    expected = agg.process_raster(raster, _TRANSFORM, tile_size=1000).sort('hex_id')
+    assert expected['hex_id'].is_unique().all()
+    assert expected['pop'].sum() == pytest.approx(float(raster.sum()))
+
+    tiled = agg.process_raster(raster, _TRANSFORM, tile_size=32).sort('hex_id')
+    assert tiled['hex_id'].equals(expected['hex_id'])
+    assert np.allclose(tiled['pop'].to_numpy(), expected['pop'].to_numpy())
+
+def test_raster_avg_and_count_from_memmap(tmp_path):
+    raster = _raster()
+    path = tmp_path / 'raster.npy'
+    np.save(path, raster)
+
+    avg = H3Aggregator().set_resolution(11).avg(['height']).set_cell_format('uint64')
+    result = avg.process_raster(path, _TRANSFORM, tile_size=40)
+    # 比pixel還小的cell直接取pixel的值
+    assert set(result['height'].unique().to_list()) <= set(raster.ravel().tolist())
+
+    classes = (raster % 3).astype(np.uint8)
+    classes[0, :] = 255
+    count = H3Aggregator().set_resolution(8).count(['land_use']).process_raster(
+        classes, _TRANSFORM, nodata=255, tile_size=40
+    )
+    assert count.columns == ['hex_id', '0', '1', '2', 'total_count']
+    assert count['total_count'].sum() == classes.size - classes.shape[1]
+    assert count['0'].sum() == (classes == 0).sum()
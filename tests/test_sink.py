@@ -0,0 +1,61 @@
+import numpy as np
+import polars as pl
+import pytest
+import h3ronpy.polars
+from h3ronpy.arrow.vector import coordinates_to_cells
+
+from h3_toolkit.processing.sink import iter_file_batches, sink_by_parent, sink_lazy, sink_to
+from h3_toolkit.tracing import RecordingTracer
+
+def _cells(n:int=200) -> pl.DataFrame:
+    rng = np.random.default_rng(0)
+    cells = coordinates_to_cells(rng.uniform(25.0, 25.3, n), rng.uniform(121.4, 121.7, n), 10)
+    return pl.DataFrame({'cell': pl.Series(cells).cast(pl.UInt64), 'value': rng.random(n)})
+
+def _rollup(df:pl.LazyFrame) -> pl.LazyFrame:
+    return (
+        df
+        .with_columns(pl.col('cell').h3.change_resolution(8))
+        .group_by('cell')
+        .agg(pl.col('value').sum())
+    )
+
+def test_sink_lazy_collects_a_query_which_cant_be_streamed(tmp_path):
+    tracer = RecordingTracer()
+    # h3的change_resolution不是elementwise，不能在streaming engine裡跑
+    sink_lazy(_rollup(_cells().lazy()), tmp_path / 'rollup.arrow', 'ipc', tracer, 'rollup')
+
+    expected = _rollup(_cells().lazy()).collect().sort('cell')
+    assert pl.read_ipc(tmp_path / 'rollup.arrow', memory_map=True).sort('cell').equals(expected)
+    assert [span.rows for span in tracer.spans if span.stage == 'rollup'] == [expected.height]
+
+    with pytest.raises(ValueError):
+        sink_lazy(_cells().lazy(), tmp_path / 'cells.csv', 'csv')
+
+def test_sink_by_parent_matches_the_whole_query(tmp_path):
+    expected = _rollup(_cells().lazy()).collect().sort('cell')
+
+    files = sink_by_parent(_cells().lazy(), tmp_path / 'rollup', 'ipc', 6, _rollup, batch_rows=20)
+    assert len(files) == len({file.parent.name for file in files})
+    result = pl.concat([batch for batch in iter_file_batches(tmp_path / 'rollup', batch_rows=3)])
+    assert result.sort('cell').equals(expected)
+
+    files = sink_to(_cells().lazy(), tmp_path / 'cells', 'parquet', partition_by_parent=6)
+    assert sorted(file.parent.name for file in files) == sorted(file.parent.name for file in tmp_path.glob('rollup/*/*'))
+    assert pl.concat(iter_file_batches(tmp_path / 'cells')).sort('cell').equals(_cells().sort('cell'))
+
+def test_sink_to_replaces_the_partitions_of_an_earlier_run(tmp_path):
+    sink_to(_cells().lazy(), tmp_path / 'cells', 'ipc', partition_by_parent=6)
+    # 第二次只剩一個parent，之前的parent=<hex_id>不能留著
+    first = _cells().filter(pl.col('cell') == pl.col('cell').first())
+    files = sink_to(first.lazy(), tmp_path / 'cells', 'ipc', partition_by_parent=6)
+    assert len(files) == 1 and files[0].is_file()
+    assert [path.name for path in (tmp_path / 'cells').iterdir()] == [files[0].parent.name]
+    assert pl.concat(iter_file_batches(tmp_path / 'cells')).equals(first)
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['cells']
+
+    (tmp_path / 'other').mkdir()
+    (tmp_path / 'other' / 'keep.txt').write_text('not a partition')
+    with pytest.raises(ValueError):
+        sink_by_parent(_cells().lazy(), tmp_path / 'other', 'ipc', 6, _rollup)
+    assert (tmp_path / 'other' / 'keep.txt').exists()
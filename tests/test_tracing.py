@@ -0,0 +1,59 @@
+import geopandas as gpd
+import polars as pl
+from shapely.geometry import box
+
+from h3_toolkit.core import H3Aggregator
+from h3_toolkit.hbase.client import HBaseClient
+from h3_toolkit.hbase.local_server import LocalHBaseServer
+from h3_toolkit.tracing import RecordingTracer, Span
+
+def _boxes() -> gpd.GeoDataFrame:
+    return gpd.GeoDataFrame(
+        {'district': ['a', 'b', 'a'], 'pop': [100.0, 50.0, 3.0]},
+        geometry=[box(121.5 + 0.01 * i, 25.0, 121.51 + 0.01 * i, 25.01) for i in range(3)],
+        crs='epsg:4326',
+    )
+
+def test_process_records_every_stage():
+    tracer = RecordingTracer(capture_plans=True)
+    agg = H3Aggregator().set_geometry('geometry').set_resolution(9).sum(['pop'], 'district').set_tracer(tracer)
+    result = agg.process(_boxes())
+
+    summary = tracer.summary()
+    stages = set(summary['stage'])
+    assert {'to_wkb', 'polyfill', 'cells_to_string', 'process'} <= stages
+    process = summary.filter(pl.col('stage') == 'process').row(0, named=True)
+    assert process['calls'] == 1 and process['rows'] == result.height
+    assert len(tracer.plans['process']) == 1
+    assert 'process' in tracer.report()
+
+def test_profile_records_the_nodes():
+    tracer = RecordingTracer(profile_queries=True)
+    agg = H3Aggregator().set_geometry('geometry').set_resolution(9).sum(['pop'], 'district').set_tracer(tracer)
+    expected = H3Aggregator().set_geometry('geometry').set_resolution(9).sum(['pop'], 'district').process(_boxes())
+
+    assert agg.process(_boxes()).sort('hex_id').equals(expected.sort('hex_id'))
+    assert any(span.stage.startswith('process/') for span in tracer.spans)
+
+def test_callback_tracer_on_client():
+    spans:list[Span] = []
+    data = pl.DataFrame({'hex_id': [f'8c4ba0a41574{i}ff' for i in range(5)], 'p_cnt': [1.0] * 5})
+    with LocalHBaseServer() as server:
+        client = HBaseClient()
+        urls, chunk_size = (client.fetch_url, client.send_url), client.chunk_size
+        client.fetch_url, client.send_url, client.chunk_size = server.fetch_url, server.send_url, 2
+        try:
+            client.set_tracer(spans.append)
+            client.send_data(data, 'table', 'demographic', ['p_cnt'])
+            client.fetch_data('table', 'demographic', ['p_cnt'], data['hex_id'].to_list())
+        finally:
+            client.set_tracer(None)
+            client.close()
+            client.fetch_url, client.send_url = urls
+            client.chunk_size = chunk_size
+
+    fetches = [span for span in spans if span.stage == 'hbase_fetch']
+    assert len(fetches) == 3 and sum(span.rows for span in fetches) == 5
+    assert all(span.bytes_sent > 0 and span.bytes_received > 0 for span in fetches)
+    assert sum(span.rows for span in spans if span.stage == 'hbase_encode') == 5
+    assert {'hbase_send', 'hbase_decode', 'hbase_pivot'} <= {span.stage for span in spans}